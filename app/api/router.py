@@ -6,32 +6,106 @@
 
 from __future__ import annotations
 
-from dataclasses import asdict
-from typing import Annotated, Any
+from datetime import datetime
+from typing import Annotated, Any, Callable, Iterator, TypeVar
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
 
 from .schemas import (
     Task,
     TaskCreate,
+    TaskItem,
     TaskListResponse,
     TaskUpdateRequest,
     ServerStatus,
     HTCJobEvent,
+    HTCJobEventListResponse,
     HTCJobEventPost,
     LogEntryCreate,
     HTCCluster,
     HTCClusterCreate,
+    HTCClusterProcListResponse,
     HTCClusterWithTask,
     REMOVE_OPERATION_ID_AND_SUMMARY,
 )
 from ..common import db_ops
+from ..common.db_executor import DBBusyError, DBStream, db_executor
 from ..common import models as msm_models
+from ..common import serialization
 from ..common.models import SchemaInstances
 
 
 router = APIRouter()
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_RESPONSE = {"content": {NDJSON_MEDIA_TYPE: {}}}
+
+# seconds a client rejected by the admission control should wait (the
+# tracker submits the queued tasks in cycles of a few seconds at most)
+QUEUE_FULL_RETRY_AFTER = 5
+
+
+def wants_ndjson(request: Request) -> bool:
+    """Check if the client asked for a newline-delimited JSON stream."""
+
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+T = TypeVar("T")
+
+
+async def run_db(func: Callable[..., T], *args: Any) -> T:
+    """Run a blocking db_ops call on the DB executor (off the event loop)."""
+
+    try:
+        return await db_executor.run(func, *args)
+    except DBBusyError as e:
+        raise make_db_busy_error() from e
+
+
+def make_db_busy_error() -> HTTPException:
+    """503 response to a call rejected by the DB executor backpressure"""
+
+    return HTTPException(
+        status_code=503, detail="db-busy", headers={"Retry-After": "1"}
+    )
+
+
+class DBStreamingResponse(StreamingResponse):
+    """StreamingResponse of a DBStream, closed even if the client is gone
+    before the stream starts"""
+
+    body_iterator: DBStream
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+
+async def ndjson_response(iterator: Iterator[bytes]) -> StreamingResponse:
+    """Stream a db_ops NDJSON iterator on the DB executor (it counts as one
+    pending DB call until the stream ends)."""
+
+    try:
+        stream = await db_executor.open_stream(iterator)
+    except DBBusyError as e:
+        raise make_db_busy_error() from e
+    return DBStreamingResponse(stream, media_type=NDJSON_MEDIA_TYPE)
+
+
+def json_response(content: bytes) -> Response:
+    """Response with a body that is already serialized
+
+    Returning a Response skips the response_model validation, which is only
+    used for the OpenAPI spec (see `app.common.serialization`).
+    """
+
+    return Response(content=content, media_type="application/json")
+
 
 @router.get(
     "/status",
@@ -42,7 +116,9 @@ router = APIRouter()
 async def get_server_status():
     "Server status"
 
-    return asdict(db_ops.get_status())
+    return json_response(
+        serialization.dump_server_status(await run_db(db_ops.get_status))
+    )
 
 
 @router.post(
@@ -58,40 +134,17 @@ async def htc_cluster_collection_post(new_htc_cluster: HTCClusterCreate):
     new_htc_cluster_msm: msm_models.HTCCluster = htc_cluster_create_schema.loads(
         new_htc_cluster.model_dump_json()
     )  # type: ignore
-    htc_cluster = db_ops.create_htc_cluster(new_htc_cluster_msm)
+    htc_cluster = await run_db(db_ops.create_htc_cluster, new_htc_cluster_msm)
 
-    if db_ops.update_cluster_task(htc_cluster.id):  # type: ignore
+    if await run_db(db_ops.update_cluster_task, htc_cluster.id):  # type: ignore
         # task_update_status = "task_updated"
         print("task updated")
 
-    htc_cluster_schema = SchemaInstances.get_htc_cluster_schema()
-
-    return htc_cluster_schema.dumps(htc_cluster)
-
-
-def get_cluster_with_task(*, cluster_id: int | None = None) -> dict[str, Any]:
-    """Get a cluster and the corresponding task object."""
-
-    if cluster_id is None:
-        return {"cluster": None, "task": None}
-
-    db_htc_cluster = db_ops.get_db_htc_cluster_by_id(cluster_id)
-    if db_htc_cluster is None:
-        return {"cluster": None, "task": None}
-    htc_cluster = db_htc_cluster.dump_obj()
-    task_id: str | None = db_htc_cluster.task_id  # type: ignore
-
-    if task_id is not None and task_id != "-":
-        db_task = db_ops.get_task_by_id(task_id)
-        if db_task is not None:
-            task_dict = asdict(db_task)  # pyright: ignore[reportOptionalMemberAccess]
-        else:
-            task_dict = None
-    else:
-        db_task = None
-        task_dict = None
-
-    return {"cluster": htc_cluster, "task": task_dict, "extra": {}}
+    return json_response(
+        serialization.dump_htc_cluster(
+            serialization.htc_cluster_obj_to_dict(htc_cluster)
+        )
+    )
 
 
 @router.get(
@@ -105,43 +158,101 @@ async def get_htc_cluster(
 ):
     """Show HTC Cluster"""
 
-    cluster_with_task = get_cluster_with_task(cluster_id=cluster_id)
+    cluster_with_task_json = await run_db(
+        db_ops.get_htc_cluster_with_task_json, cluster_id
+    )
+    if cluster_with_task_json is None:
+        raise HTTPException(status_code=404, detail="not-found")
+
+    return json_response(cluster_with_task_json)
+
+
+@router.get(
+    "/htc-clusters/{cluster_id}/procs",
+    tags=["HTCondor"],
+    response_model=HTCClusterProcListResponse,
+    openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
+)
+async def get_htc_cluster_procs(
+    cluster_id: Annotated[int, Path(description="The identifier of the cluster.")],
+    offset: Annotated[int, Query(ge=0, description="Index of the first proc.")] = 0,
+    limit: Annotated[int, Query(ge=1, le=10000, description="Page size.")] = 1000,
+):
+    """HTC Cluster proc states (paginated)"""
 
-    if cluster_with_task["cluster"] is None:
+    procs_json = await run_db(
+        db_ops.get_htc_cluster_procs_json, cluster_id, offset, limit
+    )
+    if procs_json is None:
         raise HTTPException(status_code=404, detail="not-found")
 
-    htc_cluster_with_task_schema = SchemaInstances.get_htc_cluster_with_task_schema()
-    return htc_cluster_with_task_schema.dump(cluster_with_task)
+    return json_response(procs_json)
 
 
 @router.get(
     "/tasks",
     tags=["Tasks"],
     response_model=TaskListResponse,
+    responses={200: NDJSON_RESPONSE},
     openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
 )
-async def task_collection():
-    "Tasks (all)"
-
-    task_list_response = db_ops.get_tasks_all()
-    response_schema = SchemaInstances.get_task_list_response_schema()
-    print(task_list_response)
-    return response_schema.dump(task_list_response)
+async def task_collection(
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=1000, description="Page size.")] = 100,
+    cursor: Annotated[
+        str | None, Query(description="The `nextCursor` of the previous page.")
+    ] = None,
+    state: Annotated[
+        list[int] | None, Query(description="Task states to include.")
+    ] = None,
+    cluster_id: Annotated[int | None, Query(alias="clusterId")] = None,
+    created_after: Annotated[datetime | None, Query(alias="createdAfter")] = None,
+    created_before: Annotated[datetime | None, Query(alias="createdBefore")] = None,
+    state_date_after: Annotated[
+        datetime | None, Query(alias="stateDateAfter")
+    ] = None,
+    state_date_before: Annotated[
+        datetime | None, Query(alias="stateDateBefore")
+    ] = None,
+):
+    """Tasks (all)
+
+    With `Accept: application/x-ndjson`, all the matching tasks (starting
+    after `cursor`) are streamed one per line and `limit` is ignored.
+    """
+
+    query = msm_models.TaskListQuery(
+        states=state,
+        cluster_id=cluster_id,
+        created_after=created_after,
+        created_before=created_before,
+        state_date_after=state_date_after,
+        state_date_before=state_date_before,
+        cursor=cursor,
+        limit=limit,
+    )
+    try:
+        if wants_ndjson(request):
+            return await ndjson_response(db_ops.iter_tasks_ndjson(query))
+        return json_response(await run_db(db_ops.get_tasks_all_json, query))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="invalid-cursor") from e
 
 
 @router.get(
     "/tasks-completed",
     tags=["Tasks"],
-    responses={200: {"model": TaskListResponse}},
+    responses={200: {"model": TaskListResponse, **NDJSON_RESPONSE}},
     openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
 )
-async def get_tasks_completed():
+async def get_tasks_completed(request: Request):
     "Tasks completed"
 
-    task_list_response = db_ops.get_tasks_completed()
-    response_schema = SchemaInstances.get_task_list_response_schema()
-    print(task_list_response)
-    return response_schema.dump(task_list_response)
+    if wants_ndjson(request):
+        query = msm_models.TaskListQuery(states=[msm_models.TaskStates.COMPLETED])
+        return await ndjson_response(db_ops.iter_tasks_ndjson(query))
+
+    return json_response(await run_db(db_ops.get_tasks_completed_json))
 
 
 @router.get(
@@ -153,10 +264,7 @@ async def get_tasks_completed():
 async def get_tasks_queued():
     "Tasks queued"
 
-    task_list_response = db_ops.get_tasks_queued()
-    response_schema = SchemaInstances.get_task_list_response_schema()
-    print(task_list_response)
-    return response_schema.dump(task_list_response)
+    return json_response(await run_db(db_ops.get_tasks_queued_json))
 
 
 @router.post(
@@ -164,10 +272,14 @@ async def get_tasks_queued():
     operation_id=None,
     summary=None,
     tags=["Tasks"],
-    responses={200: {"description": "Created Task", "model": Task}},
+    responses={
+        200: {"description": "Created Task", "model": Task},
+        422: {"description": "More procs than the queued tasks limit"},
+        429: {"description": "Too many queued tasks, retry after `Retry-After`"},
+    },
     openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
 )
-async def task_collection_post(new_task: TaskCreate):
+async def task_collection_post(request: Request, new_task: TaskCreate):
     "Create Task"
 
     task_create_schema = SchemaInstances.get_task_create_schema()
@@ -175,11 +287,23 @@ async def task_collection_post(new_task: TaskCreate):
         new_task.model_dump_json(),
     )  # type: ignore
 
-    task = db_ops.create_task(new_task_msm)
-
-    task_schema = SchemaInstances.get_task_schema()
-
-    return task_schema.dump(task)
+    try:
+        task = await run_db(
+            db_ops.create_task,
+            new_task_msm,
+            request.app.state.max_queued_tasks,
+            request.app.state.owner_max_queued_tasks,
+        )
+    except db_ops.QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail="queue-full",
+            headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER)},
+        ) from e
+    except db_ops.TaskTooLargeError as e:
+        raise HTTPException(status_code=422, detail="task-too-large") from e
+
+    return json_response(serialization.dump_task(serialization.task_obj_to_dict(task)))
 
 
 @router.get(
@@ -193,14 +317,34 @@ async def get_task(
 ):
     "Show Task"
 
-    print(f"get task {task_id}")
-    task = db_ops.get_task_by_id(task_id)
-    if task is None:
+    task_json = await run_db(db_ops.get_task_json, task_id)
+    if task_json is None:
         raise HTTPException(status_code=404, detail="not-found")
 
-    task_schema = SchemaInstances.get_task_schema()
+    return json_response(task_json)
+
+
+@router.get(
+    "/tasks/{task_id}/items/{item_index}",
+    tags=["Tasks"],
+    response_model=TaskItem,
+    openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
+)
+async def get_task_item(
+    task_id: Annotated[str, Path(description="The identifier of the Task.")],
+    item_index: Annotated[
+        int, Path(ge=0, description="The index of the array task item.")
+    ],
+):
+    "Show Array Task Item"
+
+    task_item = await run_db(db_ops.get_task_item, task_id, item_index)
+    if task_item is None:
+        raise HTTPException(status_code=404, detail="not-found")
 
-    return task_schema.dump(task)
+    return json_response(
+        serialization.dump_task_item(serialization.task_item_obj_to_dict(task_item))
+    )
 
 
 @router.post(
@@ -219,11 +363,11 @@ async def update_task(
     task_update_request: msm_models.TaskUpdateRequest = (
         task_update_request_schema.loads(task_update.model_dump_json())
     )  # type: ignore
-    task = db_ops.update_task(task_id, task_update_request)
-
-    task_schema = SchemaInstances.get_task_schema()
+    task = await run_db(db_ops.update_task, task_id, task_update_request)
+    if task is None:
+        raise HTTPException(status_code=404, detail="not-found")
 
-    return task_schema.dump(task)
+    return json_response(serialization.dump_task(serialization.task_obj_to_dict(task)))
 
 
 @router.delete(
@@ -236,11 +380,44 @@ async def delete_task(
 ):
     "Delete Task"
 
-    deleted_flag = db_ops.delete_task(task_id)
+    deleted_flag = await run_db(db_ops.delete_task, task_id)
 
     return {"deleted_flag": deleted_flag}
 
 
+@router.get(
+    "/htc-job-events",
+    tags=["HTCondor"],
+    response_model=HTCJobEventListResponse,
+    responses={200: NDJSON_RESPONSE},
+    openapi_extra=REMOVE_OPERATION_ID_AND_SUMMARY,
+)
+async def htc_job_events_collection(
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=1000, description="Page size.")] = 100,
+    cursor: Annotated[
+        str | None, Query(description="The `nextCursor` of the previous page.")
+    ] = None,
+    cluster_id: Annotated[int | None, Query(alias="clusterId")] = None,
+):
+    """HTC job events
+
+    With `Accept: application/x-ndjson`, all the matching events (starting
+    after `cursor`) are streamed one per line and `limit` is ignored.
+    """
+
+    try:
+        if wants_ndjson(request):
+            return await ndjson_response(
+                db_ops.iter_htc_job_events_ndjson(cluster_id, cursor)
+            )
+        return json_response(
+            await run_db(db_ops.get_htc_job_events_json, cluster_id, cursor, limit)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="invalid-cursor") from e
+
+
 @router.post(
     "/htc-job-events",
     tags=["HTCondor"],
@@ -253,9 +430,15 @@ async def htc_job_events_post(log_entry: HTCJobEventPost):
     log_entry_create = SchemaInstances.get_htc_job_event_create_schema().loads(
         log_entry.model_dump_json()
     )
-    log_entry = db_ops.post_htc_job_event(log_entry_create)  # type: ignore
+    htc_job_event = await run_db(
+        db_ops.post_htc_job_event, log_entry_create  # type: ignore
+    )
 
-    return SchemaInstances.get_htc_job_event_schema().dump(log_entry)
+    return json_response(
+        serialization.dump_htc_job_event(
+            serialization.htc_job_event_obj_to_dict(htc_job_event)
+        )
+    )
 
 
 @router.get(
@@ -6,7 +6,7 @@
 from datetime import datetime
 from typing import Any, Dict, List, Annotated, Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 
 OPENAPI_TAGS = [
@@ -28,6 +28,10 @@ def delete_title(schema):
         field_props.pop("title", None)  # remove title of fields
 
 
+# max number of items (procs) of an array task
+MAX_TASK_ITEMS = 100_000
+
+
 REMOVE_OPERATION_ID_AND_SUMMARY = {
     "operationId": None,
     "summary": None,
@@ -57,6 +61,7 @@ class HTCClusterCreate(BaseModel):
     firstProc: int = 0
     numProcs: int
     status: HTCClusterStatusPartial
+    scheddName: str | None = None
 
     @staticmethod
     def _schema_extra(schema):
@@ -77,6 +82,7 @@ class HTCCluster(BaseModel):
     firstProc: int
     numProcs: int
     status: HTCClusterStatusPartial
+    scheddName: str | None = None
 
     @staticmethod
     def _schema_extra(schema):
@@ -88,6 +94,32 @@ class HTCCluster(BaseModel):
     model_config = {"json_schema_extra": _schema_extra}
 
 
+class HTCProc(BaseModel):
+    index: int
+    state: int
+    exitCode: int | None = None
+
+    model_config = {"json_schema_extra": delete_title}
+
+
+class HTCClusterProcListResponse(BaseModel):
+    kind: Annotated[
+        Literal["htc-cluster-proc-list"],
+        Field(default_factory=lambda: "htc-cluster-proc-list"),
+    ]
+    responseDate: datetime
+    clusterId: int
+    clusterState: int | None = None
+    firstProc: int
+    numProcs: int
+    nProcsOk: int
+    nProcsError: int
+    offset: int
+    items: list[HTCProc]
+
+    model_config = {"json_schema_extra": delete_title}
+
+
 class HTCClusterWithTask(BaseModel):
     kind: Annotated[
         Literal["htc-cluster-with-task"],
@@ -126,6 +158,18 @@ class HTCJobEvent(BaseModel):
     model_config = {"json_schema_extra": _schema_extra}
 
 
+class HTCJobEventListResponse(BaseModel):
+    kind: Annotated[
+        Literal["htc-job-event-list"],
+        Field(default_factory=lambda: "htc-job-event-list"),
+    ]
+    responseDate: datetime
+    items: list[HTCJobEvent]
+    nextCursor: str | None = None
+
+    model_config = {"json_schema_extra": delete_title}
+
+
 class HTCJobEventPost(BaseModel):
     clusterId: int
     procId: int
@@ -190,6 +234,74 @@ class TaskCreate(BaseModel):
     state: int = 0
     subParams: Dict[str, str] = Field(default_factory=lambda: {})
     retriesLeft: int = 2
+    count: Annotated[
+        int | None,
+        Field(
+            ge=1,
+            le=MAX_TASK_ITEMS,
+            description="Array task: number of procs to queue.",
+        ),
+    ] = None
+    itemData: Annotated[
+        list[Dict[str, str]] | None,
+        Field(
+            min_length=1,
+            max_length=MAX_TASK_ITEMS,
+            description="Array task: submit variables of each proc "
+            "(`queue ... from` itemdata).",
+        ),
+    ] = None
+    backend: Annotated[
+        Literal["htcondor", "local"] | None,
+        Field(
+            description="Execution backend: HTCondor (the default), or local "
+            "processes of the tracker for short tasks.",
+        ),
+    ] = None
+    bundleable: Annotated[
+        bool | None,
+        Field(
+            description="The task may be run with other tiny tasks in a single "
+            "HTCondor job.",
+        ),
+    ] = None
+    reuseResult: Annotated[
+        bool | None,
+        Field(
+            description="Complete the task with the result of an identical task "
+            "(same subParams, items and input files) that completed successfully, "
+            "instead of running it.",
+        ),
+    ] = None
+    inputFiles: Annotated[
+        list[str] | None,
+        Field(
+            description="Absolute paths of the input files of the task: their "
+            "content is part of the identity of the task for reuseResult.",
+        ),
+    ] = None
+    priority: Annotated[
+        int | None,
+        Field(
+            description="Among the queued tasks of the owner, the ones with a "
+            "higher priority are submitted first (default: 0).",
+        ),
+    ] = None
+    owner: Annotated[
+        str | None,
+        Field(
+            max_length=64,
+            description="Owner (user or tenant) of the task: the owners share "
+            "the submissions by weighted fair share.",
+        ),
+    ] = None
+
+    @model_validator(mode="after")
+    def check_array_form(self) -> "TaskCreate":
+        """Only one of count and itemData"""
+        if self.count is not None and self.itemData is not None:
+            raise ValueError("count and itemData are mutually exclusive")
+        return self
 
     model_config = {"json_schema_extra": delete_title}
 
@@ -205,6 +317,12 @@ class Task(BaseModel):
     procId: int | None = None
     expirationDate: datetime | None = None
     latestSubId: str | None = None
+    numItems: int | None = None
+    backend: str | None = None
+    bundleable: bool | None = None
+    resultTaskId: str | None = None
+    priority: int | None = None
+    owner: str | None = None
 
     @staticmethod
     def _schema_extra(schema):
@@ -216,6 +334,16 @@ class Task(BaseModel):
     model_config = {"json_schema_extra": _schema_extra}
 
 
+class TaskItem(BaseModel):
+    index: int
+    procId: int | None = None
+    state: int
+    exitCode: int | None = None
+    itemData: Dict[str, str] | None = None
+
+    model_config = {"json_schema_extra": delete_title}
+
+
 class TaskUpdateRequest(BaseModel):
     state: int
     retriesLeft: int
@@ -239,5 +367,6 @@ class TaskListResponse(BaseModel):
     ]
     responseDate: datetime
     items: list[Task]
+    nextCursor: str | None = None
 
     model_config = {"json_schema_extra": delete_title}
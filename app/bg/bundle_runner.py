@@ -0,0 +1,69 @@
+"""
+Task bundle runner
+
+The executable of a task bundle job (see task_bundle): runs the tasks of the
+bundle manifest, `parallel` at a time, and appends the exit code of each task
+to the results file as soon as it completes. Standalone (standard library
+only), as it runs on the execute node:
+
+    python3 bundle_runner.py <manifest>
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import subprocess
+import sys
+import threading
+from typing import Any, Optional
+
+
+def _open_output(stack: contextlib.ExitStack, filename: Optional[str]) -> Any:
+    if not filename:
+        return subprocess.DEVNULL
+    return stack.enter_context(open(filename, "ab"))
+
+
+def run_task(entry: dict) -> Optional[int]:
+    """Run a task of the manifest, returns its exit code (None if it could not
+    be started, negative if killed by a signal)"""
+    with contextlib.ExitStack() as stack:
+        try:
+            completed = subprocess.run(
+                entry["args"],
+                cwd=entry.get("initialdir"),
+                stdin=subprocess.DEVNULL,
+                stdout=_open_output(stack, entry.get("output")),
+                stderr=_open_output(stack, entry.get("error")),
+                check=False,
+            )
+        except (OSError, ValueError) as e:
+            print(f"task {entry['taskId']} could not be started: {e}", file=sys.stderr)
+            return None
+    return completed.returncode
+
+
+def main(argv: list[str]) -> int:
+    """Run the bundle of the manifest `argv[1]`"""
+    with open(argv[1], encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    lock = threading.Lock()
+    with open(manifest["results"], "a", encoding="utf-8") as results:
+
+        def _run(entry: dict) -> None:
+            exit_code = run_task(entry)
+            with lock:
+                results.write(
+                    json.dumps({"taskId": entry["taskId"], "exitCode": exit_code})
+                    + "\n"
+                )
+                results.flush()
+
+        with ThreadPoolExecutor(max_workers=manifest.get("parallel", 1)) as executor:
+            list(executor.map(_run, manifest["tasks"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
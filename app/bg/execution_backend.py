@@ -0,0 +1,44 @@
+"""
+Execution backends other than HTCondor
+
+The HTCTracker submits the tasks opted in to a backend (Task.backend) to that
+backend instead of the schedd pool. A backend runs each task as a cluster of
+procs, with cluster ids in a slot of its own (see models.make_cluster_id), and
+reports the lifecycle job events a schedd would write to the user log (SUBMIT,
+EXECUTE, JOB_TERMINATED), which the tracker ingests like the HTCondor ones.
+"""
+
+# pylint: disable=no-member
+
+import threading
+from typing import Optional
+
+import htcondor
+
+from ..common.models import HTCCluster, HTCJobEvent, Task
+
+
+SUBMIT_EVENT = str(htcondor.JobEventType.SUBMIT)
+EXECUTE_EVENT = str(htcondor.JobEventType.EXECUTE)
+JOB_TERMINATED_EVENT = str(htcondor.JobEventType.JOB_TERMINATED)
+
+
+class ExecutionBackend:
+    """Base class of the execution backends"""
+
+    # the Task.backend value of the tasks run by the backend
+    name: str
+
+    def my_init(self, wake_event: threading.Event) -> None:
+        """Start the backend, `wake_event` is set when job events are ready"""
+
+    def my_close(self) -> None:
+        """Stop the backend"""
+
+    def submit_tasks(self, tasks: list[Task]) -> list[Optional[HTCCluster]]:
+        """Start the tasks, one cluster each (None if a task can't be run)"""
+        raise NotImplementedError
+
+    def pop_job_events(self, max_events: int) -> list[HTCJobEvent]:
+        """Up to `max_events` of the job events not read yet, oldest first"""
+        raise NotImplementedError
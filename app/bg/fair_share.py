@@ -0,0 +1,60 @@
+"""
+Fair-share ordering of the task submissions
+
+The queued tasks of an owner are submitted by decreasing priority (then by
+creation date), and the owners share the submissions of a cycle in proportion
+to their weights: each submission goes to the owner with the lowest weighted
+usage (its submitted procs plus the ones already picked in the cycle, divided
+by its weight), so that an owner with a large backlog can't starve the others.
+An array task counts for all its procs.
+"""
+
+import heapq
+from typing import Callable, Iterable, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+
+def allocate_fair_share(
+    queues: dict[Optional[str], Iterable[T]],
+    usage: dict[Optional[str], int],
+    weights: Optional[dict[str, float]],
+    max_items: int,
+    get_cost: Callable[[T], int] = lambda item: 1,
+    max_usage: Optional[int] = None,
+) -> list[T]:
+    """The next (at most `max_items`) items of the owners' queues, in order
+
+    `usage` is the current usage of each owner, `weights` its share (default
+    1, tasks without an owner form an owner of their own) and `get_cost` the
+    usage of an item. An owner gets no more items once its next one would
+    bring its usage over `max_usage` (an item over the limit by itself is
+    only picked when the owner has no usage).
+    """
+    heap = []
+    iterators = {}
+    for owner, queue in queues.items():
+        weight = (weights or {}).get(owner or "", 1.0)
+        if weight <= 0:
+            continue
+        used = usage.get(owner, 0)
+        # ties go by owner name, the tasks without an owner first
+        name = (owner is not None, owner or "")
+        iterators[owner] = iter(queue)
+        heap.append((used / weight, name, owner, used, weight))
+    heapq.heapify(heap)
+
+    picks: list[T] = []
+    while heap and len(picks) < max_items:
+        _, name, owner, used, weight = heapq.heappop(heap)
+        item = next(iterators[owner], None)
+        if item is None:
+            continue
+        cost = get_cost(item)
+        if max_usage is not None and used > 0 and used + cost > max_usage:
+            continue
+        picks.append(item)
+        used += cost
+        heapq.heappush(heap, (used / weight, name, owner, used, weight))
+    return picks
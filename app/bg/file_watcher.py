@@ -0,0 +1,130 @@
+"""
+File change notification
+
+Wakes up a thread (sets a threading.Event) when a file is written, created,
+or replaced. Uses Linux inotify (through libc, no extra dependency) and falls
+back to polling the file's stat() where inotify is not available.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from typing import Optional
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def inotify_init(dir_name: str) -> Optional[int]:
+    """inotify fd watching the writes to the files in `dir_name`, None if
+    inotify is not available"""
+
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(dir_name), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify_names(fd: int) -> set[bytes]:
+    """Names of the files in the pending inotify events"""
+
+    names = set()
+    try:
+        buf = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return names
+    pos = 0
+    while pos + _EVENT_HEADER.size <= len(buf):
+        _wd, _mask, _cookie, name_len = _EVENT_HEADER.unpack_from(buf, pos)
+        pos += _EVENT_HEADER.size
+        names.add(buf[pos : pos + name_len].rstrip(b"\0"))
+        pos += name_len
+    return names
+
+
+def get_file_stat_key(filename: str) -> Optional[tuple]:
+    """What changes when the file is written or replaced"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class FileWatcher(threading.Thread):
+    """Sets `change_event` when the watched file changes"""
+
+    filename: str
+    change_event: threading.Event
+    stop_event: threading.Event
+    poll_interval: float
+    logger: logging.Logger
+
+    def __init__(
+        self,
+        filename: str,
+        change_event: threading.Event,
+        poll_interval: float = 1.0,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.change_event = change_event
+        self.stop_event = threading.Event()
+        self.poll_interval = poll_interval
+        if logger is None:
+            logger = logging.getLogger(f"{self.__class__.__name__}.{self.name}")
+        self.logger = logger
+
+    def stop(self) -> None:
+        """Request thread stop."""
+        self.stop_event.set()
+
+    def _watch_inotify(self, fd: int) -> None:
+        base_name = os.fsencode(os.path.basename(self.filename))
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([fd], [], [], self.poll_interval)
+            if readable and base_name in read_inotify_names(fd):
+                self.change_event.set()
+
+    def _watch_polling(self) -> None:
+        stat_key = get_file_stat_key(self.filename)
+        while not self.stop_event.wait(self.poll_interval):
+            new_stat_key = get_file_stat_key(self.filename)
+            if new_stat_key != stat_key:
+                stat_key = new_stat_key
+                self.change_event.set()
+
+    def run(self) -> None:
+        fd = inotify_init(os.path.dirname(os.path.abspath(self.filename)))
+        if fd is None:
+            self.logger.debug("inotify not available, polling %s", self.filename)
+            self._watch_polling()
+            return
+
+        try:
+            self._watch_inotify(fd)
+        finally:
+            os.close(fd)
@@ -2,35 +2,48 @@
 HTCondor task tracking
 """
 
-# pylint: disable=no-member
+# pylint: disable=no-member,catching-non-exception
 
-import dataclasses
-from datetime import datetime, timezone
-import json
+from collections import deque
+import functools
+import hashlib
+import itertools
+import math
 import os
 import random
 import threading
 import time
-from typing import Optional
+from typing import Any, Callable, Iterator, Optional
 
 
 import htcondor
 
 
-from ..common.models import HTCCluster, Task, HTCJobEvent, TaskStates
-from ..common import db_models as dbm
+from ..common.models import (
+    HTCCluster,
+    Task,
+    TaskStates,
+    HTCJobEvent,
+    HTCLogCheckpoint,
+    make_cluster_id,
+)
 from ..common import db_ops
-
-
-@dataclasses.dataclass
-class SubmitResult:
-    """SubmitResult"""
-
-    creation_date: datetime
-    cluster_id: int
-    cluster_ad: dict
-    first_proc: int
-    num_procs: int
+from .execution_backend import ExecutionBackend
+from .fair_share import allocate_fair_share
+from .file_watcher import FileWatcher
+from .schedd_client import (
+    CONNECTION_ERRORS,
+    ScheddCallTimeoutError,
+    ScheddUnavailableError,
+    SubmitResult,
+)
+from .schedd_pool import LOCAL_SCHEDD_NAME, ScheddPool, ScheddTarget
+from .task_bundle import (
+    get_bundle_manifest_filename,
+    read_bundle_exit_codes,
+    write_bundle,
+)
+from .token_bucket import TokenBucket
 
 
 def get_tasks_to_run():
@@ -38,52 +51,287 @@ def get_tasks_to_run():
     return []
 
 
-def htc_submit_task(task: Task) -> Optional[SubmitResult]:
-    """HTCondor submit task"""
+def get_task_procs(task: Task) -> int:
+    """Number of HTCondor procs of the task (the items of an array task)"""
+    return task.num_items or 1
+
+
+def htc_submit_task(schedd: Any, task: Task) -> Optional[SubmitResult]:
+    """HTCondor submit task (`schedd` is an HTCondorSchedd)
+
+    Returns None if the task can't be submitted; the schedd connection errors
+    are raised.
+    """
     try:
-        submit = htcondor.Submit(task.sub_params)
-        result = htcondor.Schedd().submit(submit)
+        return schedd.submit(
+            task.sub_params, count=task.num_items or 1, item_data=task.item_data
+        )
+    except CONNECTION_ERRORS:
+        raise
     except htcondor.HTCondorException as e:
         print(e)
         return None
 
-    sub_result = SubmitResult(
-        creation_date=datetime.now(timezone.utc),
-        cluster_id=result.cluster(),
-        cluster_ad=json.loads(result.clusterad().printJson()),
-        first_proc=result.first_proc(),
-        num_procs=result.num_procs(),
+
+def htc_submit_tasks(schedd: Any, tasks: list[Task]) -> list[Optional[SubmitResult]]:
+    """HTCondor submit tasks, one cluster (Schedd.submit call) per task
+
+    A bad task only fails itself. If the schedd connection fails after some
+    clusters were submitted, returns the results of these only (the other
+    tasks stay queued), otherwise the connection errors are raised. The
+    clusters of the batch are recorded in a single DB transaction by the
+    caller.
+    """
+    results = []
+    for task in tasks:
+        try:
+            results.append(htc_submit_task(schedd, task))
+        except CONNECTION_ERRORS:
+            if not results:
+                raise
+            break
+    return results
+
+
+def htc_event_to_job_event(
+    event: htcondor.JobEvent, schedd_slot: int = 0
+) -> HTCJobEvent:
+    """HTCondor job event (from the log of the schedd `schedd_slot`) as an
+    HTCJobEvent"""
+    details = {}
+    for key, value in event.items():
+        details[key] = value
+    return HTCJobEvent(
+        cluster_id=make_cluster_id(schedd_slot, event.cluster),
+        proc_id=event.proc,
+        timestamp=event.timestamp,
+        event_type=str(event.type),
+        details=details,
     )
-    return sub_result
+
+
+# number of bytes before the checkpoint offset used to fingerprint the log
+LOG_FINGERPRINT_SIZE = 4096
+
+
+def get_log_file_id(log_filename: str) -> Optional[str]:
+    """Identity of the log file (device and inode), None if it is missing"""
+    try:
+        st = os.stat(log_filename)
+    except OSError:
+        return None
+    return f"{st.st_dev}:{st.st_ino}"
+
+
+def get_log_fingerprint(log_filename: str, offset: int) -> Optional[str]:
+    """Digest of the log bytes just before `offset`, None if they can't be read"""
+    start = max(0, offset - LOG_FINGERPRINT_SIZE)
+    try:
+        with open(log_filename, "rb") as f:
+            f.seek(start)
+            data = f.read(offset - start)
+    except OSError:
+        return None
+    if len(data) != offset - start:
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+# the line ending each event of a (classic format) job event log
+LOG_EVENT_SEPARATOR = b"...\n"
+
+
+def get_jel_state(jel: htcondor.JobEventLog) -> Optional[tuple]:
+    """Pickle state of the job event log, None if its layout is not the
+    expected one (it is not documented, the offset of the next event is its
+    last item)"""
+    state = jel.__getstate__()
+    if (
+        isinstance(state, tuple)
+        and len(state) == 3
+        and isinstance(state[2], int)
+        and state[2] >= 0
+    ):
+        return state
+    return None
+
+
+def get_jel_offset(jel: htcondor.JobEventLog) -> Optional[int]:
+    """Offset of the next event to be read from the job event log, None if
+    unknown"""
+    state = get_jel_state(jel)
+    if state is None:
+        return None
+    return state[2]
+
+
+def set_jel_offset(jel: htcondor.JobEventLog, offset: int) -> bool:
+    """Seek the job event log to the event starting at `offset`, returns
+    False if it can't"""
+    state = get_jel_state(jel)
+    if state is None:
+        return False
+    jel.__setstate__((state[0], state[1], offset))
+    return True
+
+
+def is_log_event_start(log_filename: str, offset: int) -> bool:
+    """True if an event of the log starts at `offset` (the previous one
+    ends just before)"""
+    if offset == 0:
+        return True
+    start = offset - len(LOG_EVENT_SEPARATOR)
+    try:
+        with open(log_filename, "rb") as f:
+            f.seek(max(start, 0))
+            data = f.read(len(LOG_EVENT_SEPARATOR))
+    except OSError:
+        return False
+    return start >= 0 and data == LOG_EVENT_SEPARATOR
 
 
 class HTCTracker(threading.Thread):
     """HTCondor task tracker thread"""
 
     stop_event: threading.Event
+    wake_event: threading.Event
+    schedd_pool: ScheddPool
     log_filename: str
     task_root_dir: str
-    jel: htcondor.JobEventLog
+    max_batch_size: int
+    max_submit_batch_size: int
+    max_interval: float
+    debounce_delay: float
+    partition: int
+    num_partitions: int
+    max_bundle_size: int
+    max_bundle_delay: float
+    bundle_parallelism: int
+    max_submit_per_cycle: int
+    owner_max_submitted: Optional[int]
+    owner_weights: Optional[dict[str, float]]
+    max_idle_jobs: Optional[int]
+    submit_rate: float
+    # throttles the HTCondor submissions (with max_idle_jobs)
+    submit_bucket: Optional[TokenBucket]
+    # the job event log of each schedd of the pool, by slot
+    jels: dict[int, htcondor.JobEventLog]
+    # the execution backends other than HTCondor, by Task.backend
+    backends: dict[str, ExecutionBackend]
 
     def __init__(self) -> None:
         super().__init__(daemon=False)
         self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.jels = {}
+        self.backends = {}
+        # time.monotonic() since when a partial bundle is held back
+        self._partial_bundle_since: Optional[float] = None
+        # True if tasks were held back in this cycle for lack of submit tokens
+        self._submit_throttled = False
+        # the tasks of the schedd calls that timed out (see call_submit)
+        self._submitting_task_ids: set[str] = set()
+        self._late_submissions: deque = deque()
 
-    def init_app(self, log_filename: str, task_root_dir: str = "./taskroot") -> None:
+    def init_app(
+        self,
+        log_filename: str,
+        task_root_dir: str = "./taskroot",
+        max_batch_size: int = 1000,
+        max_submit_batch_size: int = 100,
+        max_interval: Optional[float] = None,
+        debounce_delay: float = 0.05,
+        schedd_names: Optional[list[str]] = None,
+        schedd_pool: Optional[ScheddPool] = None,
+        partition: int = 0,
+        num_partitions: int = 1,
+        backends: Optional[list[ExecutionBackend]] = None,
+        max_bundle_size: int = 50,
+        max_bundle_delay: float = 1.0,
+        bundle_parallelism: int = 1,
+        max_submit_per_cycle: int = 1000,
+        owner_max_submitted: Optional[int] = None,
+        owner_weights: Optional[dict[str, float]] = None,
+        max_idle_jobs: Optional[int] = None,
+        submit_rate: float = 100.0,
+    ) -> None:
         """
         Initializes the app variables.
+
+        `max_batch_size` is the max number of job events ingested per DB
+        transaction, `max_submit_batch_size` the max number of tasks submitted
+        per schedd call. The tracker runs a cycle when woken up (new queued
+        tasks, user log writes), `debounce_delay` seconds after the first
+        wakeup so that bursts coalesce, and at least every `max_interval`
+        seconds.
+
+        The tasks are submitted to the least loaded schedd of `schedd_names`
+        (default: the local schedd, see ScheddPool.create), each schedd with
+        its own user log derived from `log_filename`. `schedd_pool` replaces
+        the pool (e.g. one with fake schedds).
+
+        With `num_partitions` > 1 the tracker only submits the tasks of its
+        `partition` (see models.get_task_shard), `log_filename` must then be
+        specific to the partition, so that it only ingests the events of the
+        clusters it submitted.
+
+        The tasks opted in to one of `backends` (Task.backend) are run by that
+        backend, the other ones are submitted to HTCondor.
+
+        The bundleable tasks are submitted in bundles (see task_bundle) of up
+        to `max_bundle_size` tasks, running `bundle_parallelism` tasks at a
+        time. A partial bundle is submitted once it has waited
+        `max_bundle_delay` seconds for more tasks. A `max_bundle_size` of 1
+        disables the bundling.
+
+        At most `max_submit_per_cycle` queued tasks are submitted per cycle,
+        shared between the owners (Task.owner) by weighted fair share (see
+        fair_share, `owner_weights` by owner name, default 1), each owner
+        with at most `owner_max_submitted` submitted procs (split evenly
+        between the partitions, an array task counts for its items). The
+        tasks of an owner are submitted by decreasing priority.
+
+        With `max_idle_jobs`, the HTCondor submissions are throttled by a
+        token bucket of procs (one per proc of a task, one per bundle job)
+        refilled at up to `submit_rate` procs per second (with bursts of
+        `max_submit_batch_size` procs), slowed down in proportion to the idle
+        jobs of the schedds, and stopped when they reach `max_idle_jobs`.
         """
 
         self.task_root_dir = task_root_dir
+        self.max_batch_size = max_batch_size
+        self.max_submit_batch_size = max_submit_batch_size
+        if max_interval is None:
+            max_interval = 11.5 + random.random()
+        self.max_interval = max_interval
+        self.debounce_delay = debounce_delay
+        self.partition = partition
+        self.num_partitions = num_partitions
         self.log_filename = log_filename  # f"{self.app.instance_path}/htc-log/0.log"
+        if schedd_pool is None:
+            schedd_pool = ScheddPool.create(log_filename, schedd_names)
+        self.schedd_pool = schedd_pool
+        self.backends = {backend.name: backend for backend in backends or []}
+        self.max_bundle_size = max_bundle_size
+        self.max_bundle_delay = max_bundle_delay
+        self.bundle_parallelism = bundle_parallelism
+        self.max_submit_per_cycle = max_submit_per_cycle
+        self.owner_max_submitted = owner_max_submitted
+        self.owner_weights = owner_weights
+        self.max_idle_jobs = max_idle_jobs
+        self.submit_rate = submit_rate
+        self.submit_bucket = None
+        if max_idle_jobs is not None:
+            self.submit_bucket = TokenBucket(submit_rate, max_submit_batch_size)
 
     def stop(self) -> None:
         """Request thread stop."""
         self.stop_event.set()
+        self.wake_event.set()
 
-    def submit_task(self, task: Task) -> None:
-        """Submit task to HTCondor"""
-        inject_params = {"log": self.log_filename}
+    def prepare_task(self, task: Task, log_filename: Optional[str] = None) -> None:
+        """Inject the log (of the target schedd) and initialdir submit params"""
+        inject_params = {"log": log_filename or self.log_filename}
         initialdir = f"{self.task_root_dir}/{task.id}"
         try:
             os.makedirs(initialdir, exist_ok=True)
@@ -91,74 +339,455 @@ class HTCTracker(threading.Thread):
         except OSError:
             pass
 
-        sub_params = {
+        task.sub_params = {
             **inject_params,
             **task.sub_params,  # type: ignore
         }
-        task.sub_params = sub_params
-        sub_result = htc_submit_task(task)
+
+    def call_submit(
+        self,
+        target: ScheddTarget,
+        tasks: list[Task],
+        submitted_tasks: list[Task],
+        on_submitted: Callable[[list[Optional[SubmitResult]]], None],
+    ) -> None:
+        """Submit `submitted_tasks` (`tasks` or their bundle) to `target`,
+        then record the results with `on_submitted`
+
+        The tasks stay queued if the schedd is unavailable. If the call times
+        out, the submission may still complete: the tasks are not submitted
+        again until its results are recorded, late, by a later cycle (see
+        record_late_submissions).
+        """
+        task_ids = {task.id for task in tasks}
+        self._submitting_task_ids.update(task_ids)  # type: ignore
+
+        def on_late_result(results: Optional[list[Optional[SubmitResult]]]):
+            self._late_submissions.append((task_ids, on_submitted, results))
+            self.wake_event.set()
+
+        try:
+            results = target.client.call(
+                htc_submit_tasks, submitted_tasks, on_late_result=on_late_result
+            )
+        except ScheddCallTimeoutError as e:
+            print(f"schedd {target.name or LOCAL_SCHEDD_NAME} call pending: {e}")
+            return
+        except ScheddUnavailableError as e:
+            # the tasks stay queued, they are submitted in a later cycle (to
+            # another schedd if this one stays unavailable)
+            print(f"schedd {target.name or LOCAL_SCHEDD_NAME} unavailable: {e}")
+            self._submitting_task_ids.difference_update(task_ids)  # type: ignore
+            return
+        self._submitting_task_ids.difference_update(task_ids)  # type: ignore
+        on_submitted(results)
+
+    def record_late_submissions(self) -> None:
+        """Record the results of the submissions that completed after their
+        call timed out (the tasks of a failed one are submitted again)"""
+        while self._late_submissions:
+            task_ids, on_submitted, results = self._late_submissions.popleft()
+            if results is not None:
+                on_submitted(results)
+            self._submitting_task_ids.difference_update(task_ids)
+
+    def submit_tasks(self, tasks: list[Task]) -> None:
+        """Submit tasks to HTCondor in one call to the least loaded
+        schedd"""
+        target = self.schedd_pool.pick()
+        if target is None:
+            # the tasks stay queued, they are submitted in a later cycle
+            return
+        for task in tasks:
+            self.prepare_task(task, target.log_filename)
+        self.call_submit(
+            target,
+            tasks,
+            tasks,
+            functools.partial(self.record_submitted_tasks, target, tasks),
+        )
+
+    def record_submitted_tasks(
+        self,
+        target: ScheddTarget,
+        tasks: list[Task],
+        sub_results: list[Optional[SubmitResult]],
+    ) -> None:
+        """Create the clusters of the tasks submitted to `target`"""
+        htc_clusters = []
+        for task, sub_result in zip(tasks, sub_results):
+            if sub_result is None:
+                db_ops.set_task_submission_failed(task.id)  # type: ignore
+                continue
+
+            htc_clusters.append(
+                HTCCluster(
+                    id=make_cluster_id(target.slot, sub_result.cluster_id),
+                    task_id=task.id,
+                    sub_params=task.sub_params,
+                    cluster_ad=sub_result.cluster_ad,
+                    first_proc=sub_result.first_proc,
+                    num_procs=sub_result.num_procs,
+                    schedd_name=target.name,
+                )
+            )
+        if not htc_clusters:
+            return
+
+        self.schedd_pool.add_submitted(
+            target, sum(htc_cluster.num_procs or 0 for htc_cluster in htc_clusters)
+        )
+        db_ops.create_submitted_htc_clusters(htc_clusters)
+
+    def submit_task(self, task: Task) -> None:
+        """Submit task to HTCondor"""
+        self.submit_tasks([task])
+
+    def submit_backend_tasks(self, backend: ExecutionBackend, tasks: list[Task]):
+        """Run tasks with an execution backend other than HTCondor"""
+        for task in tasks:
+            self.prepare_task(task)
+        htc_clusters = []
+        for task, htc_cluster in zip(tasks, backend.submit_tasks(tasks)):
+            if htc_cluster is None:
+                db_ops.set_task_submission_failed(task.id)  # type: ignore
+                continue
+            htc_clusters.append(htc_cluster)
+        if htc_clusters:
+            db_ops.create_submitted_htc_clusters(htc_clusters)
+
+    def submit_bundle(self, tasks: list[Task]) -> None:
+        """Submit tasks as one bundle job to the least loaded schedd"""
+        target = self.schedd_pool.pick()
+        if target is None:
+            return
+        for task in tasks:
+            self.prepare_task(task)
+        try:
+            bundle_task = write_bundle(
+                f"{self.task_root_dir}/_bundles",
+                tasks,
+                self.bundle_parallelism,
+                target.log_filename,
+            )
+        except OSError as e:
+            # the tasks stay queued
+            print(f"can't write the task bundle: {e}")
+            return
+        self.call_submit(
+            target,
+            tasks,
+            [bundle_task],
+            functools.partial(self.record_submitted_bundle, target, tasks, bundle_task),
+        )
+
+    def record_submitted_bundle(
+        self,
+        target: ScheddTarget,
+        tasks: list[Task],
+        bundle_task: Task,
+        sub_results: list[Optional[SubmitResult]],
+    ) -> None:
+        """Create the cluster of the bundle of `tasks` submitted to `target`"""
+        (sub_result,) = sub_results
         if sub_result is None:
-            with dbm.db_rlock:
-                db_task: Optional[dbm.Task] = dbm.Task.query.get(task.id)
-                if db_task is None:
-                    return
-                db_task.state = TaskStates.COMPLETED_WITH_ERROR
-                db_task.state_date = datetime.now(timezone.utc)
-                dbm.db.session.add(db_task)
-                dbm.db.session.commit()
+            for task in tasks:
+                db_ops.set_task_submission_failed(task.id)  # type: ignore
+            return
+
+        self.schedd_pool.add_submitted(target, sub_result.num_procs)
+        # each task of the bundle gets the time it would have alone
+        ttl = db_ops.SUBMITTED_TASK_TTL * math.ceil(
+            len(tasks) / self.bundle_parallelism
+        )
+        db_ops.create_submitted_bundle(
+            HTCCluster(
+                id=make_cluster_id(target.slot, sub_result.cluster_id),
+                task_id="-",
+                sub_params=bundle_task.sub_params,
+                cluster_ad=sub_result.cluster_ad,
+                first_proc=sub_result.first_proc,
+                num_procs=sub_result.num_procs,
+                schedd_name=target.name,
+            ),
+            [task.id for task in tasks],  # type: ignore
+            ttl,
+        )
+
+    def submit_bundles(self, tasks: list[Task]) -> None:
+        """Submit the bundleable tasks, holding back a partial bundle until
+        it has waited `max_bundle_delay` seconds"""
+        n_bundles = len(tasks) // self.max_bundle_size
+        n_allowed = self.take_submit_tokens([1] * n_bundles)
+        for index in range(n_allowed):
+            offset = index * self.max_bundle_size
+            self.submit_bundle(tasks[offset : offset + self.max_bundle_size])
+        if n_allowed < n_bundles:
+            # the rest waits for the next tokens
+            return
+
+        rest = tasks[n_bundles * self.max_bundle_size :]
+        if not rest:
+            self._partial_bundle_since = None
             return
+        now = time.monotonic()
+        if self._partial_bundle_since is None:
+            self._partial_bundle_since = now
+        if now - self._partial_bundle_since >= self.max_bundle_delay:
+            if self.take_submit_tokens([1]):
+                self._partial_bundle_since = None
+                self.submit_bundle(rest)
 
-        htc_cluster = HTCCluster(
-            id=sub_result.cluster_id,
-            task_id=task.id,
-            sub_params=task.sub_params,
-            cluster_ad=sub_result.cluster_ad,
-            first_proc=sub_result.first_proc,
-            num_procs=sub_result.num_procs,
+    def is_bundleable(self, task: Task) -> bool:
+        """True if the task is submitted in a bundle (a bundleable single job)"""
+        return (
+            bool(task.bundleable)
+            and self.max_bundle_size > 1
+            and not task.item_data
+            and (task.num_items or 1) == 1
+        )
+
+    def take_submit_tokens(self, costs: list[int]) -> int:
+        """Number of the next HTCondor jobs (of `costs` procs each) that may
+        be submitted now (see `max_idle_jobs`)"""
+        if self.submit_bucket is None or self.max_idle_jobs is None:
+            return len(costs)
+        headroom = 1.0 - self.schedd_pool.get_idle_jobs() / max(self.max_idle_jobs, 1)
+        self.submit_bucket.set_rate(self.submit_rate * max(headroom, 0.0))
+        for index, cost in enumerate(costs):
+            if not self.submit_bucket.take(cost):
+                self._submit_throttled = True
+                return index
+        return len(costs)
+
+    def iter_owner_tasks_queued(
+        self, owner: Optional[str], page_size: int
+    ) -> Iterator[Task]:
+        """The queued tasks of the owner (in this partition), fetched by pages
+        of `page_size` tasks as they are consumed"""
+        offset = 0
+        while True:
+            tasks = db_ops.get_owner_tasks_queued(
+                owner, page_size, offset, self.partition, self.num_partitions
+            )
+            yield from tasks
+            if len(tasks) < page_size:
+                return
+            offset += page_size
+
+    def get_tasks_to_submit(self) -> list[Task]:
+        """The queued tasks to submit in this cycle, in fair-share order"""
+        partition_args = (self.partition, self.num_partitions)
+        queued = db_ops.get_owner_proc_counts(TaskStates.QUEUED, *partition_args)
+        if not queued:
+            return []
+        submitted = db_ops.get_owner_proc_counts(TaskStates.SUBMITTED, *partition_args)
+
+        cap = None
+        if self.owner_max_submitted is not None:
+            # the cap of an owner is shared by the partitions
+            cap = math.ceil(self.owner_max_submitted / self.num_partitions)
+        # each owner's expected share of the cycle
+        page_size = max(math.ceil(self.max_submit_per_cycle / len(queued)), 1)
+        return allocate_fair_share(
+            {owner: self.iter_owner_tasks_queued(owner, page_size) for owner in queued},
+            submitted,
+            self.owner_weights,
+            self.max_submit_per_cycle,
+            get_cost=get_task_procs,
+            max_usage=cap,
         )
-        with dbm.job_state_lock:
-            with dbm.db_rlock:
-                htc_cluster = db_ops.create_htc_cluster(htc_cluster)
-                db_ops.update_cluster_task(htc_cluster.id)  # type: ignore
 
     def check_for_new_tasks(self) -> None:
         """Check the DB for new tasks."""
-        task_list_response = db_ops.get_tasks_queued()
-        for task in task_list_response.items:
-            self.submit_task(task)
+        if not self.backends and self.schedd_pool.pick() is None:
+            return
+        self._submit_throttled = False
+        self.record_late_submissions()
+        tasks = [
+            task
+            for task in self.get_tasks_to_submit()
+            if task.id not in self._submitting_task_ids
+        ]
+
+        htc_tasks = []
+        bundle_tasks = []
+        backend_tasks: dict[str, list[Task]] = {}
+        for task in tasks:
+            if task.backend in self.backends:
+                backend_tasks.setdefault(task.backend, []).append(task)  # type: ignore
+            elif self.is_bundleable(task):
+                bundle_tasks.append(task)
+            else:
+                htc_tasks.append(task)
+        for name, tasks in backend_tasks.items():
+            self.submit_backend_tasks(self.backends[name], tasks)
+
+        if self.schedd_pool.pick() is not None:
+            self.submit_bundles(bundle_tasks)
+            costs = [get_task_procs(task) for task in htc_tasks]
+            htc_tasks = htc_tasks[: self.take_submit_tokens(costs)]
+            for offset in range(0, len(htc_tasks), self.max_submit_batch_size):
+                batch = htc_tasks[offset : offset + self.max_submit_batch_size]
+                self.submit_tasks(batch)
+
+        if len(tasks) >= self.max_submit_per_cycle and not self._submit_throttled:
+            # more tasks may be waiting, run the next cycle without delay
+            self.wake_event.set()
+
+    def open_job_event_log(self, log_filename: str) -> htcondor.JobEventLog:
+        """Open the job event log at the saved checkpoint
+
+        Falls back to reading the log from the beginning if there is no
+        checkpoint or the log was rotated (new file) or truncated/rewritten
+        (the bytes before the offset don't match the saved fingerprint), or
+        if the offset is not the start of an event.
+        """
+        jel = htcondor.JobEventLog(log_filename)
+        checkpoint = db_ops.get_htc_log_checkpoint(log_filename)
+        if checkpoint is None or checkpoint.offset <= 0:
+            return jel
+
+        if (
+            checkpoint.file_id != get_log_file_id(log_filename)
+            or checkpoint.fingerprint
+            != get_log_fingerprint(log_filename, checkpoint.offset)
+        ):
+            print(f"{log_filename} rotated or truncated, reading it from the beginning")
+            return jel
+
+        # an offset that is not an event start (e.g. the offset in the
+        # JobEventLog state changed meaning with the bindings) is not used,
+        # the events already ingested are skipped when read again
+        if not is_log_event_start(
+            log_filename, checkpoint.offset
+        ) or not set_jel_offset(jel, checkpoint.offset):
+            print(
+                f"{log_filename} can't resume at offset {checkpoint.offset}, "
+                "reading it from the beginning"
+            )
+            return htcondor.JobEventLog(log_filename)
+
+        print(f"{log_filename} resuming at offset {checkpoint.offset}")
+        return jel
+
+    def get_log_checkpoint(
+        self, target: ScheddTarget, last_event_id: Optional[str]
+    ) -> HTCLogCheckpoint:
+        """Checkpoint of the current read position in the job event log of
+        `target`"""
+        # without a known offset, the log is read again from the beginning
+        # after a restart
+        offset = get_jel_offset(self.jels[target.slot]) or 0
+        return HTCLogCheckpoint(
+            log_filename=target.log_filename,
+            offset=offset,
+            file_id=get_log_file_id(target.log_filename),
+            fingerprint=get_log_fingerprint(target.log_filename, offset),
+            last_event_id=last_event_id,
+        )
+
+    def complete_bundled_tasks(self, batch: list[HTCJobEvent]) -> None:
+        """Complete the tasks of the bundle jobs terminated in `batch`
+
+        Runs before the batch is ingested (and the log checkpoint saved), so
+        that the results of a bundle are not lost if the tracker stops in
+        between; completing the tasks again is a no-op.
+        """
+        cluster_ids = [
+            event.cluster_id for event in batch if event.event_type == "JOB_TERMINATED"
+        ]
+        if not cluster_ids:
+            return
+        sub_params = db_ops.get_taskless_htc_cluster_sub_params(cluster_ids)
+        for cluster_id, cluster_sub_params in sub_params.items():
+            manifest_filename = get_bundle_manifest_filename(cluster_sub_params)
+            if manifest_filename is None:
+                continue
+            db_ops.complete_bundled_tasks(
+                cluster_id, read_bundle_exit_codes(manifest_filename)
+            )
 
     def process_job_events(self) -> None:
         """Process HTCondor job events and update the DB accordingly."""
-        with dbm.job_state_lock:
-            for event in self.jel.events(stop_after=0):
-                details = {}
-                for key, value in event.items():
-                    details[key] = value
-                htc_job_event = HTCJobEvent(
-                    cluster_id=event.cluster,
-                    proc_id=event.proc,
-                    timestamp=event.timestamp,
-                    event_type=str(event.type),
-                    details=details,
-                )
-                db_ops.post_htc_job_event(htc_job_event)
+        for target in self.schedd_pool.targets:
+            events = self.jels[target.slot].events(stop_after=0)
+            while True:
+                batch = [
+                    htc_event_to_job_event(event, target.slot)
+                    for event in itertools.islice(events, self.max_batch_size)
+                ]
+                if not batch:
+                    break
+                self.complete_bundled_tasks(batch)
+                checkpoint = self.get_log_checkpoint(target, batch[-1].gen_entry_id())
+                db_ops.post_htc_job_events(batch, checkpoint)
+
+        # the clusters of a backend are created (in submit_backend_tasks)
+        # before their events are ingested here, by the same thread
+        for backend in self.backends.values():
+            while True:
+                batch = backend.pop_job_events(self.max_batch_size)
+                if not batch:
+                    break
+                db_ops.post_htc_job_events(batch)
+
+    def get_wait_timeout(self) -> float:
+        """Time until the next cycle (if not woken up): `max_interval`, or
+        until a partial bundle held back is due, or until the next submit
+        token if tasks are held back for lack of tokens"""
+        timeout = self.max_interval
+        if self._partial_bundle_since is not None:
+            due = self._partial_bundle_since + self.max_bundle_delay
+            timeout = min(timeout, max(due - time.monotonic(), 0.0))
+        if self._submit_throttled and self.submit_bucket is not None:
+            timeout = min(timeout, self.submit_bucket.get_wait_time())
+        return timeout
 
     def run(self) -> None:
         try:
             os.makedirs(self.task_root_dir, exist_ok=True)
+            os.makedirs(os.path.dirname(self.log_filename), exist_ok=True)
+            for target in self.schedd_pool.targets:
+                with open(target.log_filename, "a", encoding="utf-8"):
+                    pass
         except OSError:
             pass
-        self.jel = htcondor.JobEventLog(self.log_filename)
-        print("htc thread starting")
-        interval = 11.5 + random.random()
+        for target in self.schedd_pool.targets:
+            self.jels[target.slot] = self.open_job_event_log(target.log_filename)
+        print(f"htc thread starting (partition {self.partition}/{self.num_partitions})")
+        n_clusters = db_ops.warm_cluster_index()
+        print(f"cluster index warmed with {n_clusters} active clusters")
         self.stop_event.clear()
-        count_at = time.monotonic()
+        self.schedd_pool.my_init(refresh_load=self.submit_bucket is not None)
+        for backend in self.backends.values():
+            backend.my_init(self.wake_event)
+        db_ops.tasks_queued.connect(self.wake_event)
+        log_watchers = [
+            FileWatcher(target.log_filename, self.wake_event)
+            for target in self.schedd_pool.targets
+        ]
+        for log_watcher in log_watchers:
+            log_watcher.start()
         while not self.stop_event.is_set():
-            time.sleep(1)
-            current_t = time.monotonic()
-            if current_t > count_at:
-                self.check_for_new_tasks()
-                self.process_job_events()
-                count_at = time.monotonic() + interval
+            self.wake_event.clear()
+            self.check_for_new_tasks()
+            self.process_job_events()
+
+            # woken up early by db_ops.tasks_queued or the log watcher
+            self.wake_event.wait(self.get_wait_timeout())
+            # coalesce bursts of wakeups into one cycle
+            self.stop_event.wait(self.debounce_delay)
 
+        for log_watcher in log_watchers:
+            log_watcher.stop()
+        for log_watcher in log_watchers:
+            log_watcher.join()
+        db_ops.tasks_queued.disconnect(self.wake_event)
+        for backend in self.backends.values():
+            backend.my_close()
+        # ingest the events of the procs that ran until the backends closed
+        self.record_late_submissions()
+        self.process_job_events()
+        self.schedd_pool.my_close()
         print("htc thread exiting")
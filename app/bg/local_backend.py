@@ -0,0 +1,225 @@
+"""
+Local execution backend
+
+Runs the tasks opted in with `backend: local` as processes of the tracker
+host, `max_workers` at a time, instead of submitting them to a schedd: a short
+task completes in milliseconds rather than after a negotiation cycle.
+
+The submit params are interpreted like HTCondor does for the vanilla universe
+basics: `executable`, `arguments` (split like a shell), `initialdir` (the
+working dir of the process, and the base of a relative `executable` and of
+relative `output`/`error` paths). The `$(Cluster)`, `$(Process)` (and
+`$(ClusterId)`, `$(ProcId)`) macros and the item data variables of array tasks
+are expanded. The other params are ignored.
+
+The job events are kept in memory until the tracker ingests them. If the
+tracker dies with procs still running, their tasks are retried once their
+expiration date passes (see TaskExpirationTracker).
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from typing import Any, Optional
+
+from ..common import db_ops
+from ..common.models import (
+    HTCCluster,
+    HTCJobEvent,
+    Task,
+    TaskBackends,
+    make_cluster_id,
+)
+from .execution_backend import (
+    EXECUTE_EVENT,
+    JOB_TERMINATED_EVENT,
+    SUBMIT_EVENT,
+    ExecutionBackend,
+)
+
+
+_MACRO_RE = re.compile(r"\$\((\w+)\)")
+
+
+def get_local_backend_name(partition: int) -> str:
+    """Name (as a schedd of the pool, for its cluster id slot) of the local
+    backend of the tracker `partition`"""
+    return f"local-processes-{partition}"
+
+
+def expand_macros(value: str, macros: dict[str, str]) -> str:
+    """Replace the `$(name)` macros defined in `macros`, keep the other ones"""
+    return _MACRO_RE.sub(lambda m: macros.get(m.group(1), m.group(0)), value)
+
+
+def _open_output(
+    stack: contextlib.ExitStack, initialdir: str, filename: Optional[str]
+) -> Any:
+    if not filename:
+        return subprocess.DEVNULL
+    return stack.enter_context(open(os.path.join(initialdir, filename), "wb"))
+
+
+def run_proc(params: dict[str, str], max_run_time: Optional[float]) -> dict:
+    """Run the proc of the (expanded) submit params and wait for it
+
+    Returns the JOB_TERMINATED event details. A proc running longer than
+    `max_run_time` seconds is killed.
+    """
+    initialdir = os.path.abspath(params.get("initialdir") or os.getcwd())
+    args = [
+        os.path.join(initialdir, params["executable"]),
+        *shlex.split(params.get("arguments", "")),
+    ]
+    with contextlib.ExitStack() as stack:
+        try:
+            completed = subprocess.run(
+                args,
+                cwd=initialdir,
+                stdin=subprocess.DEVNULL,
+                stdout=_open_output(stack, initialdir, params.get("output")),
+                stderr=_open_output(stack, initialdir, params.get("error")),
+                timeout=max_run_time,
+                check=False,
+            )
+        except subprocess.TimeoutExpired:
+            return {
+                "TerminatedNormally": False,
+                "Reason": f"max run time of {max_run_time}s exceeded",
+            }
+        except (OSError, ValueError) as e:
+            return {"TerminatedNormally": False, "Reason": str(e)}
+
+    if completed.returncode < 0:
+        return {
+            "TerminatedNormally": False,
+            "TerminatedBySignal": -completed.returncode,
+        }
+    return {"TerminatedNormally": True, "ReturnValue": completed.returncode}
+
+
+class LocalBackend(ExecutionBackend):
+    """Runs the tasks as local processes, on a bounded pool of workers"""
+
+    name = TaskBackends.LOCAL
+
+    schedd_name: str
+    schedd_slot: int
+    max_workers: int
+    max_run_time: Optional[float]
+
+    def __init__(
+        self,
+        schedd_name: str,
+        schedd_slot: int,
+        max_workers: Optional[int] = None,
+        max_run_time: Optional[float] = 60.0,
+    ) -> None:
+        self.schedd_name = schedd_name
+        self.schedd_slot = schedd_slot
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_run_time = max_run_time
+        self._lock = threading.Lock()
+        self._events: deque[HTCJobEvent] = deque()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._wake_event: Optional[threading.Event] = None
+        self._last_cluster_id = 0
+
+    @classmethod
+    def create(cls, partition: int = 0, **kwargs) -> "LocalBackend":
+        """Local backend of the tracker `partition`, with its own cluster id
+        slot (allocated in the DB like a schedd's)"""
+        schedd_name = get_local_backend_name(partition)
+        return cls(schedd_name, db_ops.get_schedd_slot(schedd_name), **kwargs)
+
+    def my_init(self, wake_event: threading.Event) -> None:
+        """Start the worker pool, numbering the clusters after the last one"""
+
+        self._wake_event = wake_event
+        self._last_cluster_id = db_ops.get_last_cluster_id(self.schedd_slot)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=self.schedd_name
+        )
+
+    def my_close(self) -> None:
+        """Drop the procs not started yet and wait for the running ones"""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _add_event(
+        self, cluster_id: int, proc_id: int, event_type: str, details: dict
+    ) -> None:
+        with self._lock:
+            self._events.append(
+                HTCJobEvent(
+                    cluster_id=cluster_id,
+                    proc_id=proc_id,
+                    timestamp=time.time(),
+                    event_type=event_type,
+                    details=details,
+                )
+            )
+        if self._wake_event is not None:
+            self._wake_event.set()
+
+    def _run_proc(self, cluster_id: int, proc_id: int, params: dict) -> None:
+        self._add_event(cluster_id, proc_id, EXECUTE_EVENT, {})
+        details = run_proc(params, self.max_run_time)
+        self._add_event(cluster_id, proc_id, JOB_TERMINATED_EVENT, details)
+
+    def submit_tasks(self, tasks: list[Task]) -> list[Optional[HTCCluster]]:
+        assert self._executor is not None, "the backend is not started"
+
+        htc_clusters: list[Optional[HTCCluster]] = []
+        for task in tasks:
+            sub_params = task.sub_params or {}
+            if not sub_params.get("executable"):
+                print(f"task {task.id} has no executable")
+                htc_clusters.append(None)
+                continue
+
+            self._last_cluster_id += 1
+            cluster_id = make_cluster_id(self.schedd_slot, self._last_cluster_id)
+            items = task.item_data or [{}] * (task.num_items or 1)
+            for proc_id, item in enumerate(items):
+                macros = {
+                    **item,
+                    "Cluster": str(self._last_cluster_id),
+                    "ClusterId": str(self._last_cluster_id),
+                    "Process": str(proc_id),
+                    "ProcId": str(proc_id),
+                }
+                params = {
+                    key: expand_macros(str(value), macros)
+                    for key, value in sub_params.items()
+                }
+                self._add_event(cluster_id, proc_id, SUBMIT_EVENT, {})
+                self._executor.submit(self._run_proc, cluster_id, proc_id, params)
+
+            htc_clusters.append(
+                HTCCluster(
+                    id=cluster_id,
+                    task_id=task.id,
+                    sub_params=sub_params,
+                    cluster_ad={},
+                    first_proc=0,
+                    num_procs=len(items),
+                    schedd_name=self.schedd_name,
+                )
+            )
+        return htc_clusters
+
+    def pop_job_events(self, max_events: int) -> list[HTCJobEvent]:
+        with self._lock:
+            return [
+                self._events.popleft()
+                for _ in range(min(max_events, len(self._events)))
+            ]
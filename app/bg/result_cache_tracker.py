@@ -0,0 +1,129 @@
+"""
+The ResultCacheTracker extension
+
+Stores a copy of the result dir of the newly cached task results (see
+result_cache) and evicts the cached results, least recently used first, when
+their copies exceed the disk budget (and the ones older than
+RESULT_REUSE_TTL, which are no longer reused).
+"""
+
+from datetime import datetime, timezone
+import logging
+import os
+import shutil
+import threading
+from typing import Optional
+
+from ..common import db_ops
+from ..common.models import TaskResult
+from ..common.result_cache import RESULT_REUSE_TTL, TASK_ROOT_DIR, get_results_dir
+
+
+def get_dir_size(dirname: str) -> int:
+    """Total size of the files under `dirname` (links not followed)"""
+    size = 0
+    for root, dirnames, filenames in os.walk(dirname):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class ResultCacheTracker(threading.Thread):
+    """ResultCacheTracker background thread extension"""
+
+    stop_event: threading.Event
+    wake_event: threading.Event
+    logger: logging.Logger
+    task_root_dir: str
+    max_bytes: int
+    interval: float
+
+    def __init__(
+        self,
+        logger: Optional[logging.Logger] = None,
+        task_root_dir: str = TASK_ROOT_DIR,
+        max_bytes: int = 1 << 30,
+        interval: float = 5,
+    ) -> None:
+        super().__init__(daemon=False)
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.task_root_dir = task_root_dir
+        self.max_bytes = max_bytes
+        self.interval = interval
+        if logger is None:
+            logger = logging.getLogger(f"{self.__class__.__name__}.{self.name}")
+        self.logger = logger
+
+    def stop(self) -> None:
+        """Stop the ResultCacheTracker thread"""
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def get_result_dir(self, task_result: TaskResult) -> str:
+        """Dir of the stored copy of a cached result"""
+        return os.path.join(get_results_dir(self.task_root_dir), task_result.key)
+
+    def store_result(self, task_result: TaskResult) -> int:
+        """Copy the result dir of the task, returns the size of the copy
+
+        A task without a dir under the task root (its initialdir was set by
+        the client) has nothing to copy.
+        """
+        task_dir = os.path.join(self.task_root_dir, task_result.task_id)
+        if not os.path.isdir(task_dir):
+            return 0
+        result_dir = self.get_result_dir(task_result)
+        tmp_dir = f"{result_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(task_dir, tmp_dir, symlinks=True)
+        # replaces the copy of an older result of the same key
+        shutil.rmtree(result_dir, ignore_errors=True)
+        os.rename(tmp_dir, result_dir)
+        return get_dir_size(result_dir)
+
+    def store_new_results(self) -> None:
+        """Store the copies of the new cached results"""
+
+        for task_result in db_ops.get_unstored_task_results():
+            try:
+                size = self.store_result(task_result)
+            except OSError as e:
+                self.logger.warning(
+                    "can't store the result %s: %s", task_result.key, e
+                )
+                continue
+            db_ops.set_task_result_size(task_result, size)
+
+    def evict_results(self) -> None:
+        """Evict the least recently used results over the disk budget, and
+        the expired ones"""
+
+        expired_date = datetime.now(timezone.utc) - RESULT_REUSE_TTL
+        expired_date = expired_date.replace(tzinfo=None)
+        total_size = 0
+        evicted = []
+        for task_result in db_ops.get_stored_task_results():
+            if task_result.completion_date < expired_date:  # type: ignore
+                evicted.append(task_result)
+                continue
+            total_size += task_result.size or 0
+            if total_size > self.max_bytes:
+                evicted.append(task_result)
+
+        for task_result in db_ops.delete_task_results(evicted):
+            shutil.rmtree(self.get_result_dir(task_result), ignore_errors=True)
+        if evicted:
+            self.logger.info("evicted %d cached results", len(evicted))
+
+    def run(self) -> None:
+        self.logger.debug("thread starting")
+
+        self.stop_event.clear()
+        while not self.stop_event.is_set():
+            self.wake_event.clear()
+            self.store_new_results()
+            self.evict_results()
+            self.wake_event.wait(self.interval)
+
+        self.logger.debug("thread exiting")
@@ -0,0 +1,279 @@
+"""
+Managed HTCondor schedd client
+
+Keeps the located schedd between calls, runs the schedd calls on a small
+worker pool with a per-call timeout, and stops calling the schedd for a while
+(circuit breaker) after repeated connection failures, so that a slow or dead
+schedd does not block the HTCTracker loop.
+
+The calls go through the HTCondorSchedd interface (submit a cluster, query
+the load), which a fake schedd implements in tests.
+"""
+
+# pylint: disable=no-member,catching-non-exception
+
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+import dataclasses
+from datetime import datetime, timezone
+import functools
+import json
+import threading
+import time
+from typing import Any, Callable, Optional, TypeVar
+
+import htcondor
+
+
+T = TypeVar("T")
+
+# errors meaning the schedd (not the submitted job) is the problem
+CONNECTION_ERRORS = (htcondor.HTCondorLocateError, htcondor.HTCondorIOError)
+
+
+@dataclasses.dataclass
+class SubmitResult:
+    """SubmitResult"""
+
+    creation_date: datetime
+    cluster_id: int
+    cluster_ad: dict
+    first_proc: int
+    num_procs: int
+
+
+def make_submit_result(result: htcondor.SubmitResult) -> SubmitResult:
+    """SubmitResult from the HTCondor one"""
+    return SubmitResult(
+        creation_date=datetime.now(timezone.utc),
+        cluster_id=result.cluster(),
+        cluster_ad=json.loads(result.clusterad().printJson()),
+        first_proc=result.first_proc(),
+        num_procs=result.num_procs(),
+    )
+
+
+class HTCondorSchedd:
+    """The schedd operations used by the trackers, on an htcondor.Schedd
+
+    A stand-in implementing the same methods (e.g. a local fake schedd in
+    tests) can be returned by the `schedd_factory` of a ScheddClient. Both
+    raise CONNECTION_ERRORS when the schedd can't be reached, and other
+    htcondor.HTCondorException errors when a submission is rejected.
+    """
+
+    schedd: htcondor.Schedd
+
+    def __init__(self, schedd: Optional[htcondor.Schedd] = None) -> None:
+        if schedd is None:
+            schedd = htcondor.Schedd()
+        self.schedd = schedd
+
+    def submit(
+        self, sub_params: dict, count: int = 1, item_data: Optional[list[dict]] = None
+    ) -> SubmitResult:
+        """Submit one cluster (`count` procs, or one proc per item of
+        `item_data`)"""
+        submit = htcondor.Submit(sub_params)
+        if item_data:
+            result = self.schedd.submit(submit, itemdata=iter(item_data))
+        else:
+            result = self.schedd.submit(submit, count=count)
+        return make_submit_result(result)
+
+    def get_load(self) -> tuple[int, int]:
+        """Number of idle and running jobs (summary-only query, no job ads)"""
+        ads = self.schedd.query(opts=htcondor.QueryOpts.SummaryOnly)
+        if not ads:
+            return 0, 0
+        return int(ads[0].get("Idle", 0)), int(ads[0].get("Running", 0))
+
+
+class ScheddUnavailableError(Exception):
+    """Raised when the schedd can't be called (circuit open, timeout, no
+    free worker, connection failure)"""
+
+
+class ScheddCallTimeoutError(ScheddUnavailableError):
+    """Raised when a schedd call times out (it may still complete later)"""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures
+
+    While open, calls are rejected. After `reset_timeout` seconds one call is
+    let through (half-open): if it succeeds the breaker closes, if it fails
+    it opens again.
+    """
+
+    failure_threshold: int
+    reset_timeout: float
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._half_open_call = False
+
+    @property
+    def is_open(self) -> bool:
+        """True if calls are currently rejected"""
+        with self._lock:
+            return self._opened_at is not None and (
+                self._half_open_call
+                or time.monotonic() - self._opened_at < self.reset_timeout
+            )
+
+    def allow(self) -> bool:
+        """True if a call may be made now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._half_open_call:
+                return False
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._half_open_call = True
+            return True
+
+    def record_success(self) -> None:
+        """Close the breaker"""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open_call = False
+
+    def record_failure(self) -> None:
+        """Count a failure, opens the breaker at the threshold"""
+        with self._lock:
+            self._failures += 1
+            if self._half_open_call or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._half_open_call = False
+
+
+def _call_with_late_result(
+    on_late_result: Callable[[Optional[T]], None], future: Future
+) -> None:
+    try:
+        result = future.result()
+    except Exception:  # pylint: disable=broad-exception-caught
+        result = None
+    on_late_result(result)
+
+
+class ScheddClient:
+    """Runs calls on a cached schedd handle
+
+    `schedd_factory` locates the schedd and returns an HTCondorSchedd (the
+    local schedd by default) or a stand-in with the same methods (e.g. a
+    local fake schedd in tests). The handle is dropped and located again
+    after a connection error or timeout.
+    """
+
+    schedd_factory: Callable[[], Any]
+    call_timeout: float
+    breaker: CircuitBreaker
+
+    def __init__(
+        self,
+        schedd_factory: Callable[[], Any] = HTCondorSchedd,
+        max_workers: int = 2,
+        call_timeout: float = 60.0,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+    ) -> None:
+        self.schedd_factory = schedd_factory
+        self.call_timeout = call_timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._schedd: Any = None
+        self._running = 0
+
+    def my_init(self) -> None:
+        """Start the worker threads"""
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="schedd-client"
+        )
+
+    def my_close(self) -> None:
+        """Stop the worker threads (without waiting for hanging calls)"""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_schedd(self) -> Any:
+        with self._lock:
+            if self._schedd is None:
+                self._schedd = self.schedd_factory()
+            return self._schedd
+
+    def _reset_schedd(self) -> None:
+        with self._lock:
+            self._schedd = None
+
+    def _run(self, func: Callable[..., T], args: tuple) -> T:
+        try:
+            return func(self._get_schedd(), *args)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def call(
+        self,
+        func: Callable[..., T],
+        *args: Any,
+        on_late_result: Optional[Callable[[Optional[T]], None]] = None,
+    ) -> T:
+        """Run `func(schedd, *args)` on a worker thread
+
+        Errors raised by `func` other than the connection errors are passed
+        through (and don't count as schedd failures). If the call times out
+        (ScheddCallTimeoutError), `on_late_result` is called (on the worker
+        thread) with its result once it completes, or with None if it fails.
+        """
+
+        if self._executor is None:
+            raise RuntimeError("ScheddClient is not initialized")
+        if not self.breaker.allow():
+            raise ScheddUnavailableError("schedd circuit breaker is open")
+
+        with self._lock:
+            # workers stuck in hanging calls are not available
+            if self._running >= self._max_workers:
+                self.breaker.record_failure()
+                raise ScheddUnavailableError("no free schedd worker")
+            self._running += 1
+
+        future = self._executor.submit(self._run, func, args)
+        try:
+            result = future.result(timeout=self.call_timeout)
+        except FutureTimeoutError as e:
+            self._reset_schedd()
+            self.breaker.record_failure()
+            if on_late_result is not None:
+                future.add_done_callback(
+                    functools.partial(_call_with_late_result, on_late_result)
+                )
+            raise ScheddCallTimeoutError(
+                f"schedd call timed out after {self.call_timeout}s"
+            ) from e
+        except CONNECTION_ERRORS as e:
+            self._reset_schedd()
+            self.breaker.record_failure()
+            raise ScheddUnavailableError(str(e)) from e
+        except Exception:
+            self.breaker.record_success()
+            raise
+
+        self.breaker.record_success()
+        return result
@@ -0,0 +1,196 @@
+"""
+Pool of HTCondor schedds
+
+Places each submission on the least loaded available schedd. The load (idle
+and running jobs) of each schedd is cached, refreshed in the background every
+`refresh_interval` seconds with a summary-only query (no job ads), and
+increased locally by the submitted procs in between, so that consecutive
+submissions spread over the schedds.
+
+Each schedd of the pool has its own user log, the job events of a log are
+therefore known to come from that schedd (see models.make_cluster_id).
+"""
+
+# pylint: disable=no-member
+
+import dataclasses
+import functools
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import htcondor
+
+from ..common import db_ops
+from .schedd_client import HTCondorSchedd, ScheddClient, ScheddUnavailableError
+
+
+# the name of the local (default) schedd in the pool configuration
+LOCAL_SCHEDD_NAME = "local"
+
+
+def locate_schedd(schedd_name: str) -> HTCondorSchedd:
+    """Schedd handle of the named schedd (located through the collector)"""
+    schedd_ad = htcondor.Collector().locate(htcondor.DaemonTypes.Schedd, schedd_name)
+    return HTCondorSchedd(htcondor.Schedd(schedd_ad))
+
+
+def get_schedd_load(schedd: Any) -> tuple[int, int]:
+    """Number of idle and running jobs of the schedd (an HTCondorSchedd)"""
+    return schedd.get_load()
+
+
+def get_schedd_log_filename(log_filename: str, schedd_name: Optional[str]) -> str:
+    """User log of the clusters submitted to `schedd_name`
+
+    The local schedd uses `log_filename`, the other ones a log next to it
+    named after the schedd (e.g. `htc-log/0.schedd2.example.org.log`).
+    """
+    if schedd_name is None:
+        return log_filename
+    root, ext = os.path.splitext(log_filename)
+    safe_name = re.sub(r"[^\w.@-]", "_", schedd_name)
+    return f"{root}.{safe_name}{ext}"
+
+
+@dataclasses.dataclass
+class ScheddTarget:
+    """A schedd of the pool"""
+
+    # None for the local schedd
+    name: Optional[str]
+    slot: int
+    client: ScheddClient
+    log_filename: str
+    n_idle: int = 0
+    n_running: int = 0
+    # time.monotonic() of the last load refresh, None if never refreshed
+    refresh_time: Optional[float] = None
+
+    @property
+    def load(self) -> int:
+        """Number of active (idle or running) jobs"""
+        return self.n_idle + self.n_running
+
+    @property
+    def is_available(self) -> bool:
+        """False while the schedd client rejects calls (circuit breaker open)"""
+        return not self.client.breaker.is_open
+
+
+class ScheddPool:
+    """Least loaded placement over a set of ScheddTargets"""
+
+    targets: list[ScheddTarget]
+    refresh_interval: float
+
+    def __init__(self, targets: list[ScheddTarget], refresh_interval: float = 10.0):
+        if not targets:
+            raise ValueError("a schedd pool needs at least one schedd")
+        self.targets = targets
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def create(
+        cls,
+        log_filename: str,
+        schedd_names: Optional[list[str]] = None,
+        schedd_factory: Optional[Callable[[Optional[str]], Any]] = None,
+        **kwargs,
+    ) -> "ScheddPool":
+        """Pool of the named schedds (`LOCAL_SCHEDD_NAME` for the local one)
+
+        Without `schedd_names` the pool only has the local schedd. The slots
+        of the named schedds are allocated in the DB. `schedd_factory` maps a
+        schedd name (None for the local schedd) to an HTCondorSchedd or a
+        stand-in (e.g. a fake schedd in tests).
+        """
+        if not schedd_names:
+            schedd_names = [LOCAL_SCHEDD_NAME]
+
+        targets = []
+        for schedd_name in schedd_names:
+            name = None if schedd_name == LOCAL_SCHEDD_NAME else schedd_name
+            if schedd_factory is not None:
+                factory = functools.partial(schedd_factory, name)
+            elif name is None:
+                factory = HTCondorSchedd
+            else:
+                factory = functools.partial(locate_schedd, name)
+            targets.append(
+                ScheddTarget(
+                    name=name,
+                    slot=0 if name is None else db_ops.get_schedd_slot(name),
+                    client=ScheddClient(schedd_factory=factory),
+                    log_filename=get_schedd_log_filename(log_filename, name),
+                )
+            )
+        return cls(targets, **kwargs)
+
+    def my_init(self, refresh_load: bool = False) -> None:
+        """Start the schedd clients and the load refresh thread (with several
+        schedds, or with `refresh_load`)"""
+
+        for target in self.targets:
+            target.client.my_init()
+        if len(self.targets) > 1 or refresh_load:
+            self._stop_event.clear()
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_loop, name="schedd-pool-refresh", daemon=True
+            )
+            self._refresh_thread.start()
+
+    def my_close(self) -> None:
+        """Stop the load refresh thread and the schedd clients"""
+
+        self._stop_event.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+        for target in self.targets:
+            target.client.my_close()
+
+    def refresh_load(self, target: ScheddTarget) -> None:
+        """Query the current load of `target`"""
+        try:
+            n_idle, n_running = target.client.call(get_schedd_load)
+        except ScheddUnavailableError as e:
+            print(f"schedd {target.name or LOCAL_SCHEDD_NAME} unavailable: {e}")
+            return
+        except htcondor.HTCondorException as e:
+            print(f"schedd {target.name or LOCAL_SCHEDD_NAME} load query failed: {e}")
+            return
+        with self._lock:
+            target.n_idle = n_idle
+            target.n_running = n_running
+            target.refresh_time = time.monotonic()
+
+    def _refresh_loop(self) -> None:
+        while not self._stop_event.is_set():
+            for target in self.targets:
+                if target.is_available:
+                    self.refresh_load(target)
+            self._stop_event.wait(self.refresh_interval)
+
+    def pick(self) -> Optional[ScheddTarget]:
+        """The least loaded available schedd, None if none is available"""
+        with self._lock:
+            available = [target for target in self.targets if target.is_available]
+            if not available:
+                return None
+            return min(available, key=lambda target: target.load)
+
+    def get_idle_jobs(self) -> int:
+        """Number of idle jobs of the available schedds"""
+        with self._lock:
+            return sum(target.n_idle for target in self.targets if target.is_available)
+
+    def add_submitted(self, target: ScheddTarget, num_procs: int) -> None:
+        """Count procs submitted to `target` until the next load refresh"""
+        with self._lock:
+            target.n_idle += num_procs
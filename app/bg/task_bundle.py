@@ -0,0 +1,111 @@
+"""
+Task bundles
+
+Packs tiny tasks (created with `bundleable`) into one HTCondor job, so that
+they pay the scheduling overhead of a single job. The job runs
+bundle_runner.py over a manifest of the tasks, written to a bundle dir under
+the task root, and the runner writes the exit code of each task to the results
+file of the bundle, read back by the tracker when the job terminates.
+
+The task root must therefore be on a filesystem shared by the submit and the
+execute nodes. Only the `executable`, `arguments`, `initialdir`, `output` and
+`error` submit params of a bundled task are used (without macro expansion).
+"""
+
+import json
+import os
+import shlex
+from typing import Optional
+import uuid
+
+from ..common.models import Task
+
+
+# submit param of a bundle job: the (quoted) path of its manifest
+BUNDLE_MANIFEST_PARAM = "MY.BundleManifest"
+
+BUNDLE_RUNNER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bundle_runner.py"
+)
+
+
+def make_bundle_entry(task: Task) -> dict:
+    """Manifest entry of a (prepared) task, with absolute paths"""
+    sub_params = task.sub_params or {}
+    initialdir = os.path.abspath(sub_params.get("initialdir") or os.getcwd())
+    entry = {
+        "taskId": task.id,
+        "args": [
+            os.path.join(initialdir, sub_params["executable"]),
+            *shlex.split(sub_params.get("arguments", "")),
+        ],
+        "initialdir": initialdir,
+    }
+    for key in ["output", "error"]:
+        if sub_params.get(key):
+            entry[key] = os.path.join(initialdir, sub_params[key])
+    return entry
+
+
+def write_bundle(
+    bundle_root_dir: str, tasks: list[Task], parallel: int, log_filename: str
+) -> Task:
+    """Write the manifest of a bundle of (prepared) tasks
+
+    Returns the bundle job as a task to submit (the tasks run `parallel` at a
+    time, on as many CPUs). Raises OSError if the bundle dir can't be written.
+    """
+    bundle_id = uuid.uuid4().hex
+    bundle_dir = os.path.abspath(os.path.join(bundle_root_dir, bundle_id))
+    os.makedirs(bundle_dir, exist_ok=True)
+    manifest_filename = os.path.join(bundle_dir, "manifest.json")
+    manifest = {
+        "parallel": parallel,
+        "results": os.path.join(bundle_dir, "results.jsonl"),
+        "tasks": [make_bundle_entry(task) for task in tasks],
+    }
+    with open(manifest_filename, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    return Task(
+        id=bundle_id,
+        sub_params={
+            "executable": "/usr/bin/env",
+            "arguments": f"python3 {BUNDLE_RUNNER} {manifest_filename}",
+            "transfer_executable": "false",
+            "initialdir": bundle_dir,
+            "output": "bundle.out",
+            "error": "bundle.err",
+            "log": log_filename,
+            "request_cpus": str(parallel),
+            BUNDLE_MANIFEST_PARAM: json.dumps(manifest_filename),
+        },
+    )
+
+
+def get_bundle_manifest_filename(sub_params: dict) -> Optional[str]:
+    """Manifest of a bundle job, None if the submit params are not a bundle's"""
+    value = sub_params.get(BUNDLE_MANIFEST_PARAM)
+    if not value:
+        return None
+    return json.loads(value)
+
+
+def read_bundle_exit_codes(manifest_filename: str) -> dict[str, Optional[int]]:
+    """Exit codes of the tasks of a bundle (the last result of each task, as
+    the job may have been restarted); the tasks that did not run are missing"""
+    exit_codes: dict[str, Optional[int]] = {}
+    try:
+        with open(manifest_filename, encoding="utf-8") as f:
+            results_filename = json.load(f)["results"]
+        with open(results_filename, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # a partial last line (the job was killed while writing)
+                    continue
+                exit_codes[result["taskId"]] = result["exitCode"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"{manifest_filename}: can't read the bundle results: {e}")
+    return exit_codes
@@ -1,9 +1,10 @@
 """
 The TaskExpirationTracker extension
 
-Periodically checks and updates task states.
+Resets the expired tasks, sleeping until the next known expiration date.
 """
 
+from datetime import datetime, timezone
 import logging
 import threading
 import time
@@ -16,11 +17,25 @@ class TaskExpirationTracker(threading.Thread):
     """TaskExpirationTracker background thread extension"""
 
     stop_event: threading.Event
+    wake_event: threading.Event
     logger: logging.Logger
-
-    def __init__(self, logger: Optional[logging.Logger] = None) -> None:
+    reconcile_interval: float
+    max_interval: float
+    min_interval: float
+
+    def __init__(
+        self,
+        logger: Optional[logging.Logger] = None,
+        reconcile_interval: float = 60,
+        max_interval: float = 60,
+        min_interval: float = 1,
+    ) -> None:
         super().__init__(daemon=False)
         self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.reconcile_interval = reconcile_interval
+        self.max_interval = max_interval
+        self.min_interval = min_interval
         if logger is None:
             logger = logging.getLogger(f"{self.__class__.__name__}.{self.name}")
         self.logger = logger
@@ -34,28 +49,53 @@ class TaskExpirationTracker(threading.Thread):
     def stop(self) -> None:
         """Stop the TaskExpirationTracker thread"""
         self.stop_event.set()
+        self.wake_event.set()
 
     def count_tasks(self) -> int:
         """Count tasks in the DB"""
 
         return db_ops.get_task_count()
 
-    def reset_expired_tasks(self) -> None:
-        """Reset expired tasks"""
+    def reset_expired_tasks(self) -> Optional[datetime]:
+        """Reset expired tasks, returns the next expiration date (if any)"""
+
+        return db_ops.reset_expired_tasks()
+
+    def reconcile_task_state_counters(self) -> None:
+        """Recount the tasks per state (see db_ops.TaskStateCounters)"""
 
-        db_ops.reset_expired_tasks()
+        db_ops.reconcile_task_state_counters()
+
+    def _get_timeout(
+        self, next_expiration_date: Optional[datetime], reconcile_at: float
+    ) -> float:
+        """Seconds until the next expiration date or reconciliation"""
+
+        timeout = min(self.max_interval, reconcile_at - time.monotonic())
+        if next_expiration_date is not None:
+            time_left = next_expiration_date - datetime.now(timezone.utc)
+            timeout = min(timeout, time_left.total_seconds())
+        return max(timeout, 0)
 
     def run(self) -> None:
         self.logger.debug("thread starting")
 
         self.stop_event.clear()
-        count_at = time.monotonic()
+        db_ops.expiration_dates_changed.connect(self.wake_event)
+        db_ops.task_state_counters.reconciled_in_process = True
+        reconcile_at = time.monotonic()
         while not self.stop_event.is_set():
-            time.sleep(1)
-            current_t = time.monotonic()
-            if current_t > count_at:
-                # self.count_tasks()
-                self.reset_expired_tasks()
-                count_at = time.monotonic() + 12
-
+            self.wake_event.clear()
+            next_expiration_date = self.reset_expired_tasks()
+            if time.monotonic() > reconcile_at:
+                self.reconcile_task_state_counters()
+                reconcile_at = time.monotonic() + self.reconcile_interval
+
+            # woken up early by db_ops.expiration_dates_changed
+            self.wake_event.wait(self._get_timeout(next_expiration_date, reconcile_at))
+            # coalesce bursts of wakeups (e.g. many submissions in a row)
+            self.stop_event.wait(self.min_interval)
+
+        db_ops.task_state_counters.reconciled_in_process = False
+        db_ops.expiration_dates_changed.disconnect(self.wake_event)
         self.logger.debug("thread exiting")
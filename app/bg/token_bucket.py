@@ -0,0 +1,57 @@
+"""
+Token bucket rate limiter (used to throttle the HTCondor submissions, see
+HTCTracker.take_submit_tokens)
+"""
+
+import math
+import time
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second, holds at most `burst` tokens
+
+    Not thread-safe, it is only used by the thread of its owner.
+    """
+
+    rate: float
+    burst: int
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def set_rate(self, rate: float) -> None:
+        """Change the refill rate (the tokens up to now refill at the old one)"""
+        self._refill()
+        self.rate = rate
+
+    def take(self, n: int) -> bool:
+        """Take `n` tokens if available, returns True if taken
+
+        More than `burst` tokens are taken once the bucket is full, leaving
+        it in debt until refilled.
+        """
+        self._refill()
+        if self._tokens < min(n, self.burst):
+            return False
+        self._tokens -= n
+        return True
+
+    def get_wait_time(self, n: int = 1) -> float:
+        """Seconds until `n` tokens are available (inf if the rate is 0)"""
+        self._refill()
+        missing = n - self._tokens
+        if missing <= 0:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return missing / self.rate
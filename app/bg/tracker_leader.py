@@ -0,0 +1,170 @@
+"""
+The TrackerLeader extension
+
+Runs background trackers (an HTCTracker partition, the TaskExpirationTracker)
+only while holding their lease in the DB, so that among the processes started
+with trackers exactly one runs them. The standby instances retry to acquire
+the lease every `poll_interval` seconds and take over when it is released
+(clean shutdown) or expires (the leader died or lost the DB for `lease_ttl`
+seconds).
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Optional
+import uuid
+
+from ..common import db_models as dbm
+from ..common import db_ops
+from .file_watcher import FileWatcher
+
+
+TASK_EXP_TRACKER_LEASE_NAME = "task-expiration-tracker"
+
+
+def get_htc_tracker_lease_name(partition: int) -> str:
+    """Lease name of the HTCTracker of `partition`"""
+    return f"htc-tracker-{partition}"
+
+
+def get_db_wake_filename() -> str:
+    """File written by the API processes without trackers when tasks are
+    queued or get an expiration date (see `wake_on_db_writes`)"""
+    return f"{dbm.db.get_db_filename()}-wake"
+
+
+def make_lease_holder_id() -> str:
+    """Unique id of this lease holder (host, pid, random suffix)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class TrackerLeader(threading.Thread):
+    """Starts the trackers when elected, stops them when the lease is lost
+
+    `tracker_factories` create new (not started) tracker threads for each
+    leadership term. With `wake_on_db_writes`, the signals sent by other
+    processes (API workers in the `serve` role) wake up the trackers through
+    the DB wake file (see get_db_wake_filename), as the in-process signals
+    (db_ops.tasks_queued, ...) do not cross processes. The other DB writes
+    (lease renewals, the commits of the trackers) do not wake them up.
+    """
+
+    stop_event: threading.Event
+    wake_event: threading.Event
+    tracker_factories: list[Callable[[], threading.Thread]]
+    lease_name: str
+    holder_id: str
+    lease_ttl: float
+    poll_interval: float
+    wake_on_db_writes: bool
+    logger: logging.Logger
+
+    def __init__(
+        self,
+        tracker_factories: list[Callable[[], threading.Thread]],
+        lease_name: str,
+        lease_ttl: float = 10.0,
+        poll_interval: float = 1.0,
+        wake_on_db_writes: bool = False,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        super().__init__(daemon=False)
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.tracker_factories = tracker_factories
+        self.lease_name = lease_name
+        self.holder_id = make_lease_holder_id()
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.wake_on_db_writes = wake_on_db_writes
+        if logger is None:
+            logger = logging.getLogger(f"{self.__class__.__name__}.{self.name}")
+        self.logger = logger
+        self._trackers: list[threading.Thread] = []
+
+    @property
+    def is_leader(self) -> bool:
+        """True while the trackers run in this process"""
+        return bool(self._trackers)
+
+    def stop(self) -> None:
+        """Request thread stop."""
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def acquire_lease(self) -> bool:
+        """Acquire or renew the lease, False if another holder has it"""
+        try:
+            return db_ops.acquire_lease(self.lease_name, self.holder_id, self.lease_ttl)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.logger.warning("%s lease update failed: %s", self.lease_name, e)
+            return False
+
+    def start_trackers(self) -> None:
+        """Start a new set of trackers"""
+        self.logger.info("elected %s leader (%s)", self.lease_name, self.holder_id)
+        self._trackers = [factory() for factory in self.tracker_factories]
+        for tracker in self._trackers:
+            tracker.start()
+
+    def stop_trackers(self) -> None:
+        """Stop the running trackers and wait for them"""
+        for tracker in self._trackers:
+            tracker.stop()  # type: ignore
+        for tracker in self._trackers:
+            tracker.join()
+        self._trackers = []
+
+    def wake_trackers(self) -> None:
+        """Wake up the trackers as if the changes were made in this process"""
+        db_ops.tasks_queued.send()
+        db_ops.expiration_dates_changed.send()
+
+    def run(self) -> None:
+        self.logger.debug("thread starting")
+
+        db_watcher = None
+        if self.wake_on_db_writes:
+            db_watcher = FileWatcher(get_db_wake_filename(), self.wake_event)
+            db_watcher.start()
+
+        # renew well before the expiration, so that a slow DB write does not
+        # lose the lease
+        renew_interval = self.lease_ttl / 3
+        renew_at = 0.0
+        while not self.stop_event.is_set():
+            if time.monotonic() >= renew_at:
+                if self.acquire_lease():
+                    renew_at = time.monotonic() + renew_interval
+                    if self.is_leader and not all(
+                        tracker.is_alive() for tracker in self._trackers
+                    ):
+                        self.logger.warning("a tracker died, restarting the trackers")
+                        self.stop_trackers()
+                    if not self.is_leader:
+                        self.start_trackers()
+                else:
+                    renew_at = time.monotonic() + self.poll_interval
+                    if self.is_leader:
+                        self.logger.warning(
+                            "%s lease lost, stopping trackers", self.lease_name
+                        )
+                        self.stop_trackers()
+
+            self.wake_event.wait(max(renew_at - time.monotonic(), 0))
+            if self.wake_event.is_set():
+                self.wake_event.clear()
+                if self.is_leader and not self.stop_event.is_set():
+                    self.wake_trackers()
+
+        if db_watcher is not None:
+            db_watcher.stop()
+            db_watcher.join()
+        if self.is_leader:
+            self.stop_trackers()
+            # hand over to a standby instance without waiting for the expiration
+            db_ops.release_lease(self.lease_name, self.holder_id)
+        self.logger.debug("thread exiting")
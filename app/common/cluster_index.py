@@ -0,0 +1,99 @@
+"""In-memory HTC cluster routing index
+
+Maps a cluster id to what the job event ingestion needs to route an event
+(owning task, proc range, cluster state), so that events of completed
+clusters or out-of-range procs are dropped without touching the DB. Bounded,
+least recently used entries are evicted. A miss means "unknown", never "no
+such cluster": the caller then reads the DB.
+
+The entries are updated by db_ops after the commits that change them. The
+index is per process: cluster updates made by API workers in another process
+(the `serve` role) are not seen by the tracker process until the next warm-up
+(`db_ops.warm_cluster_index`, at each tracker start).
+"""
+
+from collections import OrderedDict
+import dataclasses
+import threading
+from typing import Optional
+
+from .models import HTCClusterStates
+
+
+@dataclasses.dataclass(frozen=True)
+class ClusterRoute:
+    """Routing info of an HTC cluster"""
+
+    task_id: Optional[str]
+    first_proc: int
+    num_procs: int
+    cluster_state: Optional[int]
+
+    @property
+    def is_active(self) -> bool:
+        """True if the cluster can still have procs updated"""
+        return self.cluster_state in [
+            HTCClusterStates.CREATED,
+            HTCClusterStates.EXECUTING,
+        ]
+
+    def has_proc(self, proc_id: int) -> bool:
+        """True if `proc_id` belongs to the cluster"""
+        return self.first_proc <= proc_id < self.first_proc + self.num_procs
+
+
+class ClusterIndex:
+    """Bounded LRU map of cluster id to ClusterRoute"""
+
+    max_size: int
+
+    def __init__(self, max_size: int = 100_000) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._routes: OrderedDict[int, ClusterRoute] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def get(self, cluster_id: int) -> Optional[ClusterRoute]:
+        """The cluster route, None if it is not in the index"""
+        with self._lock:
+            route = self._routes.get(cluster_id)
+            if route is None:
+                self.misses += 1
+                return None
+            self._routes.move_to_end(cluster_id)
+            self.hits += 1
+            return route
+
+    def put(self, cluster_id: int, route: ClusterRoute) -> None:
+        """Add or replace the cluster route"""
+        with self._lock:
+            self._routes[cluster_id] = route
+            self._routes.move_to_end(cluster_id)
+            while len(self._routes) > self.max_size:
+                self._routes.popitem(last=False)
+
+    def set_state(self, cluster_id: int, cluster_state: Optional[int]) -> None:
+        """Update the state of an indexed cluster"""
+        with self._lock:
+            route = self._routes.get(cluster_id)
+            if route is not None:
+                self._routes[cluster_id] = dataclasses.replace(
+                    route, cluster_state=cluster_state
+                )
+
+    def discard(self, cluster_id: int) -> None:
+        """Remove the cluster route (e.g. after an update of the cluster)"""
+        with self._lock:
+            self._routes.pop(cluster_id, None)
+
+    def clear(self) -> None:
+        """Remove all the cluster routes"""
+        with self._lock:
+            self._routes.clear()
+
+
+cluster_index = ClusterIndex()
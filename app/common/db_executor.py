@@ -0,0 +1,138 @@
+"""Bounded executor for running the blocking DB operations from async code"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from typing import Any, Callable, Generic, Iterator, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+# end of iteration marker (see DBStream)
+_END = object()
+
+
+class DBBusyError(Exception):
+    """Raised when a DB call could not be queued within the queue timeout"""
+
+
+class DBExecutor:
+    """Runs db_ops calls on a dedicated thread pool
+
+    The async route handlers await `run()` instead of calling db_ops directly,
+    so a slow query or commit only occupies one worker thread, not the event
+    loop. At most `max_pending` calls are running or queued at a time, further
+    callers wait up to `queue_timeout` seconds for a slot and then fail with
+    DBBusyError (backpressure instead of an unbounded queue). A stream (see
+    `open_stream()`) counts as one call until it ends.
+
+    `max_workers` should not exceed the size of the engine connection pool.
+    """
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _semaphore: asyncio.Semaphore
+    queue_timeout: float
+
+    def my_init(
+        self, max_workers: int = 8, max_pending: int = 64, queue_timeout: float = 5.0
+    ) -> None:
+        """Start the worker threads"""
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="db-executor"
+        )
+        self._semaphore = asyncio.Semaphore(max_pending)
+        self.queue_timeout = queue_timeout
+
+    def my_close(self) -> None:
+        """Wait for the running calls and stop the worker threads"""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _acquire(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            raise RuntimeError("DBExecutor is not initialized")
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError as e:
+            raise DBBusyError("too many pending DB calls") from e
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run `func(*args, **kwargs)` on a worker thread"""
+
+        executor = await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self._semaphore.release()
+
+    async def open_stream(self, iterator: Iterator[T]) -> "DBStream[T]":
+        """Iterate `iterator` (e.g. a db_ops NDJSON stream) on the worker
+        threads, as one pending call until the stream is closed
+
+        Raises DBBusyError like `run()`, before the first item.
+        """
+
+        executor = await self._acquire()
+        return DBStream(executor, iterator, self._semaphore.release)
+
+
+class DBStream(Generic[T]):
+    """Async iterator over a blocking iterator, run on the DB executor
+
+    Holds its pending call slot until exhausted or closed (`aclose()` must be
+    called, even if the stream was never iterated).
+    """
+
+    def __init__(
+        self,
+        executor: ThreadPoolExecutor,
+        iterator: Iterator[T],
+        release: Callable[[], None],
+    ) -> None:
+        self._executor = executor
+        self._iterator = iterator
+        self._release = release
+        self._closed = False
+
+    def __aiter__(self) -> "DBStream[T]":
+        return self
+
+    async def __anext__(self) -> T:
+        if self._closed:
+            raise StopAsyncIteration
+        loop = asyncio.get_running_loop()
+        item = await loop.run_in_executor(self._executor, next, self._iterator, _END)
+        if item is _END:
+            await self.aclose()
+            raise StopAsyncIteration
+        return item  # type: ignore
+
+    async def aclose(self) -> None:
+        """Close the iterator (ending its DB session) and free the slot"""
+
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._iterator, "close", None)
+            if close is not None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._executor, close)
+        except ValueError:
+            # still running on a worker thread (the stream was cancelled), it
+            # is closed when garbage collected
+            pass
+        finally:
+            self._release()
+
+
+
+db_executor = DBExecutor()
@@ -0,0 +1,249 @@
+"""DB schema migrations
+
+The schema version is stored in the SQLite `user_version` pragma. A new
+(empty) DB is created from the current models and stamped with the latest
+version; an existing DB gets the migrations after its version applied in
+order, at startup (see `SQLAlchemy.my_init`).
+
+To change the schema, update the models and append a migration to
+MIGRATIONS. SQLite runs DDL outside of the surrounding transaction, so each
+migration must be idempotent (e.g. `checkfirst=True`, `IF NOT EXISTS`).
+"""
+
+import json
+from typing import Callable
+
+import sqlalchemy
+
+from . import models
+
+
+Migration = Callable[[sqlalchemy.Connection, sqlalchemy.MetaData], None]
+
+
+def _create_indexes(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData, names: list[str]
+) -> None:
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            if index.name in names:
+                index.create(connection, checkfirst=True)
+
+
+def _v1_create_missing_tables(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    """DBs created before migrations were added may lack some of the tables"""
+
+    metadata.create_all(connection, checkfirst=True)
+
+
+def _v2_add_hot_query_indexes(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _create_indexes(
+        connection,
+        metadata,
+        [
+            "ix_tasks_state_expiration_date",
+            "ix_tasks_creation_date_id",
+            "ix_tasks_cluster_id",
+            "ix_htc_cluster_task_id",
+            "ix_htc_job_events_cluster_id_id",
+        ],
+    )
+
+
+def _v3_add_htc_log_checkpoints(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    metadata.tables["htc_log_checkpoints"].create(connection, checkfirst=True)
+
+
+def _add_columns(
+    connection: sqlalchemy.Connection,
+    metadata: sqlalchemy.MetaData,
+    table_name: str,
+    names: list[str],
+) -> None:
+    existing = {
+        c["name"] for c in sqlalchemy.inspect(connection).get_columns(table_name)
+    }
+    table = metadata.tables[table_name]
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        column_ddl = column.type.compile(dialect=connection.dialect)
+        if column.server_default is not None:
+            # SQLite requires a default for added NOT NULL columns
+            column_ddl += f" DEFAULT {column.server_default.arg}"  # type: ignore
+            if not column.nullable:
+                column_ddl += " NOT NULL"
+        connection.exec_driver_sql(
+            f'ALTER TABLE "{table_name}" ADD COLUMN "{name}" {column_ddl}'
+        )
+
+
+def _v4_add_array_task_columns(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["num_items", "item_data_json"])
+
+
+def _v5_compact_htc_cluster_status(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    """Move the JSON cluster status to the compact per-proc state columns"""
+
+    _add_columns(
+        connection,
+        metadata,
+        "htc_cluster",
+        [
+            "cluster_state",
+            "proc_states",
+            "proc_exit_codes",
+            "n_procs_ok",
+            "n_procs_error",
+        ],
+    )
+    table = metadata.tables["htc_cluster"]
+    rows = connection.execute(
+        sqlalchemy.select(
+            table.c.id, table.c.first_proc, table.c.num_procs, table.c.status_json
+        ).where(table.c.status_json.is_not(None))
+    ).all()
+    for cluster_id, first_proc, num_procs, status_json in rows:
+        status = json.loads(status_json)
+        proc_states = models.HTCProcStates.from_procs(
+            first_proc or 0, num_procs or 0, status.get("procs")
+        )
+        connection.execute(
+            sqlalchemy.update(table)
+            .where(table.c.id == cluster_id)
+            .values(
+                cluster_state=status.get("clusterState"),
+                proc_states=proc_states.states_bytes(),
+                proc_exit_codes=proc_states.exit_codes_bytes(),
+                n_procs_ok=proc_states.n_ok,
+                n_procs_error=proc_states.n_error,
+                status_json=None,
+            )
+        )
+
+
+def _v6_add_row_versions(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["version"])
+    _add_columns(connection, metadata, "htc_cluster", ["version"])
+
+
+def _v7_add_leases(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    metadata.tables["leases"].create(connection, checkfirst=True)
+
+
+def _v8_add_task_shards(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["shard"])
+    table = metadata.tables["tasks"]
+    task_ids = connection.execute(
+        sqlalchemy.select(table.c.id).where(table.c.shard.is_(None))
+    ).scalars()
+    params = [
+        {"task_id": task_id, "shard": models.get_task_shard(task_id)}
+        for task_id in task_ids
+    ]
+    if params:
+        connection.execute(
+            sqlalchemy.update(table)
+            .where(table.c.id == sqlalchemy.bindparam("task_id"))
+            .values(shard=sqlalchemy.bindparam("shard")),
+            params,
+        )
+
+
+def _v9_add_schedds(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "htc_cluster", ["schedd_name"])
+    metadata.tables["htc_schedds"].create(connection, checkfirst=True)
+
+
+def _v10_add_task_backends(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["backend"])
+
+
+def _v11_add_bundleable_tasks(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["bundleable"])
+
+
+def _v12_add_task_results(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["result_key", "result_task_id"])
+    metadata.tables["task_results"].create(connection, checkfirst=True)
+
+
+def _v13_add_task_priorities(
+    connection: sqlalchemy.Connection, metadata: sqlalchemy.MetaData
+) -> None:
+    _add_columns(connection, metadata, "tasks", ["priority", "owner"])
+    _create_indexes(connection, metadata, ["ix_tasks_state_owner_priority"])
+
+
+MIGRATIONS: list[Migration] = [
+    _v1_create_missing_tables,
+    _v2_add_hot_query_indexes,
+    _v3_add_htc_log_checkpoints,
+    _v4_add_array_task_columns,
+    _v5_compact_htc_cluster_status,
+    _v6_add_row_versions,
+    _v7_add_leases,
+    _v8_add_task_shards,
+    _v9_add_schedds,
+    _v10_add_task_backends,
+    _v11_add_bundleable_tasks,
+    _v12_add_task_results,
+    _v13_add_task_priorities,
+]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection: sqlalchemy.Connection) -> int:
+    """Schema version of the DB"""
+
+    return connection.exec_driver_sql("PRAGMA user_version").scalar_one()
+
+
+def _set_version(connection: sqlalchemy.Connection, version: int) -> None:
+    connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def upgrade(engine: sqlalchemy.Engine, metadata: sqlalchemy.MetaData) -> None:
+    """Create or upgrade the DB schema to LATEST_VERSION"""
+
+    with engine.begin() as connection:
+        version = get_version(connection)
+        if version == 0 and not sqlalchemy.inspect(connection).get_table_names():
+            metadata.create_all(connection)
+            _set_version(connection, LATEST_VERSION)
+            return
+
+        if version > LATEST_VERSION:
+            raise RuntimeError(
+                f"DB schema version {version} is newer than {LATEST_VERSION}"
+            )
+
+        for index, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"migrating DB schema to version {index}")
+            migration(connection, metadata)
+            _set_version(connection, index)
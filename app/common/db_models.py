@@ -1,17 +1,28 @@
 """DB models"""
 
+from contextlib import contextmanager
 import dataclasses
 from datetime import datetime
 import json
+import os
 import threading
-from typing import Any, Optional
+from typing import Any, Iterator, Optional
 
 
 import sqlalchemy
-from sqlalchemy.orm import DeclarativeBase, Session, relationship, Query, Mapped
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Session,
+    relationship,
+    Query,
+    Mapped,
+    scoped_session,
+    sessionmaker,
+)
 from sqlalchemy.sql import func
 
 
+from . import db_migrations
 from . import models
 
 
@@ -46,35 +57,96 @@ class SQLAlchemy:
 
     Model = MyDeclarativeBase
     Column = sqlalchemy.Column
+    Boolean = sqlalchemy.Boolean
     DateTime = sqlalchemy.DateTime
     Double = sqlalchemy.Double
     ForeignKey = sqlalchemy.ForeignKey
+    Index = sqlalchemy.Index
     Integer = sqlalchemy.Integer
+    LargeBinary = sqlalchemy.LargeBinary
     String = sqlalchemy.String
     Text = sqlalchemy.Text
     engine: sqlalchemy.Engine
-    _session: Optional[Session] = None
+    _session_factory: sessionmaker
+    _scoped_session: scoped_session
+    _local: threading.local
+
+    def __init__(self) -> None:
+        # expire_on_commit=False keeps the loaded attributes usable after the
+        # unit of work ends and the session is removed
+        self._session_factory = sessionmaker(expire_on_commit=False)
+        self._scoped_session = scoped_session(self._session_factory)
+        self._local = threading.local()
 
     @property
     def session(self) -> Session:
-        """sqla session"""
+        """sqla session (scoped to the current thread)"""
+
+        return self._scoped_session()
+
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """Unit of work: yields the thread-scoped session
+
+        Scopes can be nested, the session is removed (closed, with any
+        uncommitted changes rolled back) when the outermost scope exits, so
+        that the next unit of work does not see stale identity-map entries.
+        """
+
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield self.session
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._scoped_session.remove()
 
-        if self._session is None:
-            self._session = Session(self.engine)
+    def create_session(self) -> Session:
+        """New session that is not registered for the current thread
 
-        return self._session
+        Used for units of work that are consumed across threads (e.g. rows
+        streamed to a response from the threadpool), the caller closes it.
+        """
 
-    # session: Session
+        return self._session_factory()
 
-    def my_init(self, echo: bool = False):
+    def my_init(
+        self, echo: bool = False, pool_size: int = 8, busy_timeout: float = 30.0
+    ):
         """sqla my_init"""
 
-        self.engine = sqlalchemy.create_engine("sqlite:///stapi_htc.db", echo=echo)
+        self.engine = sqlalchemy.create_engine(
+            "sqlite:///stapi_htc.db",
+            echo=echo,
+            pool_size=pool_size,
+            max_overflow=pool_size,
+            connect_args={"timeout": busy_timeout},
+        )
+        sqlalchemy.event.listen(self.engine, "connect", _set_sqlite_pragmas)
+        self._session_factory.configure(bind=self.engine)
+        db_migrations.upgrade(self.engine, self.Model.metadata)
+
+    def get_db_filename(self) -> str:
+        """Absolute path of the SQLite DB file"""
+
+        return os.path.abspath(self.engine.url.database)  # type: ignore
 
     def my_close(self):
         """sqla my_close"""
 
         print("closing sqla")
+        self._scoped_session.remove()
+        self.engine.dispose()
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+    """Enable WAL, so that readers do not wait for the writer (and vice versa)"""
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 
 db = SQLAlchemy()
@@ -82,8 +154,6 @@ db_rlock = threading.RLock()
 
 _global_dict["db"] = db
 
-job_state_lock = threading.Lock()
-
 
 def db_date_to_str(db_datetime: Optional[datetime]) -> Optional[str]:
     """Convert only valid db_datetime to str, otherwise use None"""
@@ -118,10 +188,31 @@ def del_nulls_if_not_nullable(d: dict, nullable: Optional[list] = None) -> None:
         del d[key]
 
 
+def _default_task_shard(context) -> int:
+    return models.get_task_shard(context.get_current_parameters()["id"])
+
+
 class Task(db.Model):
     """Task model"""
 
     __tablename__ = "tasks"
+    __table_args__ = (
+        # queued-task scan, expiration sweep and the per-state counts
+        db.Index("ix_tasks_state_expiration_date", "state", "expiration_date"),
+        # keyset pagination of the task list
+        db.Index("ix_tasks_creation_date_id", "creation_date", "id"),
+        db.Index("ix_tasks_cluster_id", "cluster_id"),
+        # queued-task scan, per owner in priority order (and the per-owner
+        # counts of a state)
+        db.Index(
+            "ix_tasks_state_owner_priority",
+            "state",
+            "owner",
+            sqlalchemy.desc("priority"),
+            "creation_date",
+            "id",
+        ),
+    )
 
     id = db.Column(db.String(32), primary_key=True)
     retries_left = db.Column(db.Integer)
@@ -138,6 +229,28 @@ class Task(db.Model):
     cluster_id = db.Column(db.Integer)
     proc_id = db.Column(db.Integer)
     expiration_date = db.Column(db.DateTime(timezone=True))
+    # array tasks: number of items (procs) and the per-item submit variables
+    num_items = db.Column(db.Integer)
+    item_data_json = db.Column(db.Text())
+    # execution backend (see models.TaskBackends), None is HTCondor
+    backend = db.Column(db.String(16))
+    # the task can be run in a bundle of tasks (see bg.task_bundle)
+    bundleable = db.Column(db.Boolean)
+    # result reuse (see result_cache): the key of the task's result, and the
+    # task whose result was reused instead of running this one
+    result_key = db.Column(db.String(64))
+    result_task_id = db.Column(db.String(32))
+    # higher first among the queued tasks of the owner (tenant)
+    priority = db.Column(db.Integer, nullable=False, server_default="0")
+    owner = db.Column(db.String(64))
+    # tracker partition key (see models.get_task_shard)
+    shard = db.Column(db.Integer, default=_default_task_shard)
+    # row version for optimistic concurrency control: incremented by every
+    # update (by the ORM for the entity updates, see __mapper_args__), the
+    # conditional updates in db_ops compare-and-swap on it
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+
+    __mapper_args__ = {"version_id_col": version}
 
     # log_entries = db.relationship("LogEntry2", back_populates="task")
     log_entries: Mapped[list["LogEntry2"]] = relationship(
@@ -147,23 +260,31 @@ class Task(db.Model):
     def __repr__(self):
         return f"<Task {self.id}>"
 
-    def _dump_camelcase_dict(self) -> dict:
-        return {
-            "id": self.id,
-            "creationDate": db_date_to_str(self.creation_date),  # type: ignore
-            "subParams": db_json_to_dict(self.sub_params_json),  # type: ignore
-            "state": self.state,
-            "stateDate": db_date_to_str(self.state_date),  # type: ignore
-            "retriesLeft": self.retries_left,
-            "clusterId": self.cluster_id,
-            "procId": self.proc_id,
-            "expirationDate": db_date_to_str(self.expiration_date),  # type: ignore
-        }
-
     def dump_obj(self) -> models.Task:
         """Dumps the DB entity as a Task python object"""
-        task_schema = models.SchemaInstances.get_task_schema()
-        return task_schema.load(self._dump_camelcase_dict())  # type: ignore
+        return models.Task(
+            id=self.id,  # type: ignore
+            creation_date=self.creation_date,  # type: ignore
+            sub_params=db_json_to_dict(self.sub_params_json),  # type: ignore
+            state=self.state,  # type: ignore
+            state_date=self.state_date,  # type: ignore
+            retries_left=self.retries_left,  # type: ignore
+            cluster_id=self.cluster_id,  # type: ignore
+            proc_id=self.proc_id,  # type: ignore
+            expiration_date=self.expiration_date,  # type: ignore
+            num_items=self.num_items,  # type: ignore
+            item_data=(
+                json.loads(self.item_data_json)  # type: ignore
+                if self.item_data_json
+                else None
+            ),
+            backend=self.backend,  # type: ignore
+            bundleable=self.bundleable,  # type: ignore
+            result_key=self.result_key,  # type: ignore
+            result_task_id=self.result_task_id,  # type: ignore
+            priority=self.priority,  # type: ignore
+            owner=self.owner,  # type: ignore
+        )
 
     @classmethod
     def obj_to_db_dict(cls, obj: models.Task, nullable: Optional[list] = None) -> dict:
@@ -181,6 +302,12 @@ class Task(db.Model):
         if "sub_params" in d:
             del d["sub_params"]
             d["sub_params_json"] = dict_to_db_json(obj.sub_params)
+        if "item_data" in d:
+            del d["item_data"]
+            d["item_data_json"] = json.dumps(obj.item_data)
+        # only used to compute the result key
+        d.pop("reuse_result", None)
+        d.pop("input_files", None)
         return d
 
     def update_from_obj(self, obj: models.Task, nullable: Optional[list] = None):
@@ -226,6 +353,7 @@ class HTCCluster(db.Model):
     """HTC Cluster DB model"""
 
     __tablename__ = "htc_cluster"
+    __table_args__ = (db.Index("ix_htc_cluster_task_id", "task_id"),)
 
     id = db.Column(db.Integer, primary_key=True)
     creation_date = db.Column(
@@ -237,22 +365,69 @@ class HTCCluster(db.Model):
     cluster_ad_json = db.Column(db.Text)
     first_proc = db.Column(db.Integer)
     num_procs = db.Column(db.Integer)
+    # legacy JSON status, moved to the columns below by the v5 migration
     status_json = db.Column(db.Text)
+    # status: cluster state and the compact per-proc states (see
+    # models.HTCProcStates), NULL if the cluster has no status
+    cluster_state = db.Column(db.Integer)
+    proc_states = db.Column(db.LargeBinary)
+    proc_exit_codes = db.Column(db.LargeBinary)
+    n_procs_ok = db.Column(db.Integer)
+    n_procs_error = db.Column(db.Integer)
+    # name of the schedd the cluster was submitted to, NULL for the local one
+    schedd_name = db.Column(db.String(256))
+    # row version for optimistic concurrency control (see Task.version)
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    def get_proc_states(self) -> Optional[models.HTCProcStates]:
+        """The per-proc states, None if the cluster has no status"""
+        if self.proc_states is None:
+            return None
+        return models.HTCProcStates.from_bytes(
+            self.first_proc or 0,  # type: ignore
+            self.proc_states,  # type: ignore
+            self.proc_exit_codes or b"",  # type: ignore
+            self.n_procs_ok or 0,  # type: ignore
+            self.n_procs_error or 0,  # type: ignore
+        )
 
-    def _status_json_to_obj(self) -> Optional[models.HTCClusterStatus]:
-        if self.status_json is None:
+    def set_proc_states(self, proc_states: Optional[models.HTCProcStates]) -> None:
+        """Store the per-proc states"""
+        if proc_states is None:
+            self.proc_states = None
+            self.proc_exit_codes = None
+            self.n_procs_ok = None
+            self.n_procs_error = None
+            return
+        self.proc_states = proc_states.states_bytes()
+        self.proc_exit_codes = proc_states.exit_codes_bytes()
+        self.n_procs_ok = proc_states.n_ok
+        self.n_procs_error = proc_states.n_error
+
+    def _get_status(self) -> Optional[models.HTCClusterStatus]:
+        proc_states = self.get_proc_states()
+        if proc_states is None:
             return None
-        status_partial = models.HTCClusterStatusPartial()
-        return status_partial.loads(self.status_json)  # type: ignore
+        return models.HTCClusterStatus(
+            cluster_state=self.cluster_state,  # type: ignore
+            procs=proc_states.to_procs(),
+        )
 
-    @classmethod
-    def _status_obj_to_json(
-        cls, status: Optional[models.HTCClusterStatus]
-    ) -> Optional[str]:
+    def _set_status(self, status: Optional[models.HTCClusterStatus]) -> None:
         if status is None:
-            return None
-        status_partial = models.HTCClusterStatusPartial()
-        return status_partial.dumps(status)
+            self.cluster_state = None
+            self.set_proc_states(None)
+            return
+        self.cluster_state = status.cluster_state
+        self.set_proc_states(
+            models.HTCProcStates.from_procs(
+                self.first_proc or 0,  # type: ignore
+                self.num_procs or 0,  # type: ignore
+                status.procs,
+            )
+        )
 
     def _dump_camelcase_dict(self) -> dict:
         return {
@@ -263,7 +438,8 @@ class HTCCluster(db.Model):
             "clusterAd": db_json_to_dict(self.cluster_ad_json),  # type: ignore
             "firstProc": self.first_proc,
             "numProcs": self.num_procs,
-            "status": self._status_json_to_obj(),
+            "status": self._get_status(),
+            "scheddName": self.schedd_name,
         }
 
     def dump_obj(self) -> models.HTCCluster:
@@ -276,7 +452,8 @@ class HTCCluster(db.Model):
             cluster_ad=db_json_to_dict(self.cluster_ad_json),  # type: ignore
             first_proc=self.first_proc,  # type: ignore
             num_procs=self.num_procs,  # type: ignore
-            status=self._status_json_to_obj(),  # type: ignore
+            status=self._get_status(),  # type: ignore
+            schedd_name=self.schedd_name,  # type: ignore
         )
 
     @classmethod
@@ -299,7 +476,15 @@ class HTCCluster(db.Model):
             d["cluster_ad_json"] = dict_to_db_json(obj.cluster_ad)
         if "status" in d:
             del d["status"]
-            d["status_json"] = cls._status_obj_to_json(obj.status)
+            status = obj.status
+            d["cluster_state"] = status.cluster_state  # type: ignore
+            proc_states = models.HTCProcStates.from_procs(
+                obj.first_proc or 0, obj.num_procs or 0, status.procs  # type: ignore
+            )
+            d["proc_states"] = proc_states.states_bytes()
+            d["proc_exit_codes"] = proc_states.exit_codes_bytes()
+            d["n_procs_ok"] = proc_states.n_ok
+            d["n_procs_error"] = proc_states.n_error
         return d
 
     def update_from_obj(self, obj: models.HTCCluster, nullable: Optional[list] = None):
@@ -318,7 +503,9 @@ class HTCCluster(db.Model):
         if obj.num_procs is not None or "num_procs" in nullable:
             self.num_procs = obj.num_procs
         if obj.status is not None or "status" in nullable:
-            self.status_json = self._status_obj_to_json(obj.status)
+            self._set_status(obj.status)
+        if obj.schedd_name is not None or "schedd_name" in nullable:
+            self.schedd_name = obj.schedd_name
 
     def update_from_db_dict(self, db_dict: dict):
         """Update the db row object from a dict"""
@@ -332,8 +519,16 @@ class HTCCluster(db.Model):
             self.first_proc = db_dict["first_proc"]
         if "num_procs" in db_dict:
             self.num_procs = db_dict["num_procs"]
-        if "status_json" in db_dict:
-            self.status_json = db_dict["status_json"]
+        for key in [
+            "cluster_state",
+            "proc_states",
+            "proc_exit_codes",
+            "n_procs_ok",
+            "n_procs_error",
+            "schedd_name",
+        ]:
+            if key in db_dict:
+                setattr(self, key, db_dict[key])
 
     def __get_attr__(self, _name: str) -> Any: ...
 
@@ -342,6 +537,9 @@ class HTCJobEvent(db.Model):
     """HTCJobEvent DB model"""
 
     __tablename__ = "htc_job_events"
+    __table_args__ = (
+        db.Index("ix_htc_job_events_cluster_id_id", "cluster_id", "id"),
+    )
 
     id = db.Column(db.String(64), primary_key=True)
     creation_date = db.Column(
@@ -359,30 +557,18 @@ class HTCJobEvent(db.Model):
     #     "HTCCluster", back_populates="job_events"
     # )
 
-    def _dump_camelcase_dict(self) -> dict:
-        if self.creation_date:  # type: ignore
-            creation_date = str(self.creation_date)
-        else:
-            creation_date = None
-        if self.details_json:  # type: ignore
-            details = json.loads(self.details_json)  # type: ignore
-        else:
-            details = None
-        return {
-            "id": self.id,
-            "creationDate": creation_date,
-            "clusterId": self.cluster_id,
-            "procId": self.proc_id,
-            "timestamp": self.timestamp,
-            "eventType": self.event_type,
-            "details": details,
-        }
-
     def dump_obj(self) -> models.HTCJobEvent:
         """Dumps the DB entity as an HTCJobEvent python object"""
 
-        htc_job_event_schema = models.SchemaInstances.get_htc_job_event_schema()
-        return htc_job_event_schema.load(self._dump_camelcase_dict())  # type: ignore
+        return models.HTCJobEvent(
+            id=self.id,  # type: ignore
+            creation_date=self.creation_date,  # type: ignore
+            cluster_id=self.cluster_id,  # type: ignore
+            proc_id=self.proc_id,  # type: ignore
+            timestamp=self.timestamp,  # type: ignore
+            event_type=self.event_type,  # type: ignore
+            details=db_json_to_dict(self.details_json) or {},  # type: ignore
+        )
 
     @classmethod
     def obj_to_db_dict(
@@ -397,3 +583,77 @@ class HTCJobEvent(db.Model):
             del d["details"]
             d["details_json"] = dict_to_db_json(obj.details)
         return d
+
+
+class HTCLogCheckpoint(db.Model):
+    """HTCLogCheckpoint DB model"""
+
+    __tablename__ = "htc_log_checkpoints"
+
+    log_filename = db.Column(db.String(1024), primary_key=True)
+    offset = db.Column(db.Integer, nullable=False)
+    file_id = db.Column(db.String(64))
+    fingerprint = db.Column(db.String(64))
+    last_event_id = db.Column(db.String(64))
+    update_date = db.Column(db.DateTime(timezone=True))
+
+    def dump_obj(self) -> models.HTCLogCheckpoint:
+        """Dumps the DB entity as an HTCLogCheckpoint python object"""
+
+        return models.HTCLogCheckpoint(
+            log_filename=self.log_filename,  # type: ignore
+            offset=self.offset,  # type: ignore
+            file_id=self.file_id,  # type: ignore
+            fingerprint=self.fingerprint,  # type: ignore
+            last_event_id=self.last_event_id,  # type: ignore
+            update_date=self.update_date,  # type: ignore
+        )
+
+
+class TaskResult(db.Model):
+    """TaskResult DB model: the cached result of each result key (see
+    result_cache)"""
+
+    __tablename__ = "task_results"
+    __table_args__ = (
+        # LRU eviction
+        db.Index("ix_task_results_last_used_date", "last_used_date"),
+    )
+
+    key = db.Column(db.String(64), primary_key=True)
+    task_id = db.Column(db.String(32), nullable=False)
+    completion_date = db.Column(db.DateTime(timezone=True), nullable=False)
+    last_used_date = db.Column(db.DateTime(timezone=True), nullable=False)
+    size = db.Column(db.Integer)
+
+    def dump_obj(self) -> models.TaskResult:
+        """Dumps the DB entity as a TaskResult python object"""
+
+        return models.TaskResult(
+            key=self.key,  # type: ignore
+            task_id=self.task_id,  # type: ignore
+            completion_date=self.completion_date,  # type: ignore
+            last_used_date=self.last_used_date,  # type: ignore
+            size=self.size,  # type: ignore
+        )
+
+
+class Lease(db.Model):
+    """Lease DB model (e.g. the tracker leader election, see db_ops.acquire_lease)"""
+
+    __tablename__ = "leases"
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(256), nullable=False)
+    expiration_date = db.Column(db.DateTime(timezone=True), nullable=False)
+    acquire_date = db.Column(db.DateTime(timezone=True))
+
+
+class HTCSchedd(db.Model):
+    """HTCSchedd DB model: the stable slot of each named schedd (see
+    models.make_cluster_id)"""
+
+    __tablename__ = "htc_schedds"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(256), nullable=False, unique=True)
@@ -3,30 +3,211 @@
 # pylint: disable=missing-function-docstring
 # pylint: disable=no-member
 
+import base64
+import dataclasses
+import functools
 from datetime import datetime, timedelta, timezone
 import json
-from typing import Optional
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional, TypeVar
 import uuid
 
 
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+import sqlalchemy.orm.exc
+
+
 from . import db_models as dbm
 from . import models
+from . import result_cache
+from . import serialization
+from .cluster_index import ClusterRoute, cluster_index
+from .signals import Signal
 from .models import (
     Task,
     TaskUpdateRequest,
     ServerStatus,
     TaskStates,
-    TaskListResponse,
+    TaskListQuery,
     HTCClusterStates,
     HTCCluster,
     HTCClusterStatus,
 )
 
 
+class TaskStateCounters:
+    """Number of tasks per state, maintained in memory
+
+    The counters are updated after each committed task state transition, and
+    periodically replaced by a `GROUP BY state` count (see
+    `reconcile_task_state_counters`), which also fixes any drift caused by
+    changes made outside of db_ops.
+
+    The state transitions made by other processes are not counted: a process
+    serving the API sets `max_age`, the counters are then reloaded when they
+    are older than `max_age` seconds, unless `reconciled_in_process` (the
+    TaskExpirationTracker, which reconciles them periodically, runs in this
+    process).
+    """
+
+    max_age: Optional[float]
+    reconciled_in_process: bool
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts: dict[Optional[int], int] = {}
+        self._valid = False
+        self._reset_at = 0.0
+        self.max_age = None
+        self.reconciled_in_process = False
+
+    @property
+    def valid(self) -> bool:
+        """True once the counters were loaded from the DB (and not too old)"""
+        if self.max_age is not None and not self.reconciled_in_process:
+            return self._valid and time.monotonic() - self._reset_at < self.max_age
+        return self._valid
+
+    def reset(self, counts: dict[Optional[int], int]) -> None:
+        with self._lock:
+            self._counts = dict(counts)
+            self._valid = True
+            self._reset_at = time.monotonic()
+
+    def move(self, old_state: Optional[int], new_state: Optional[int], n: int = 1):
+        """Record `n` tasks moving from `old_state` to `new_state`
+
+        Use None as `old_state` for created and as `new_state` for deleted tasks.
+        """
+        if old_state == new_state or n == 0:
+            return
+        with self._lock:
+            if old_state is not None:
+                self._counts[old_state] = self._counts.get(old_state, 0) - n
+            if new_state is not None:
+                self._counts[new_state] = self._counts.get(new_state, 0) + n
+
+    def get(self, state: int) -> int:
+        return max(self._counts.get(state, 0), 0)
+
+
+task_state_counters = TaskStateCounters()
+
+# max number of bound parameters used in an `IN (...)` filter
+_MAX_IN_PARAMS = 500
+
+# a submitted task is requeued (or timed out) if not completed within this
+# time per proc (see reset_expired_tasks)
+SUBMITTED_TASK_TTL = timedelta(minutes=2)
+
+# sent when a task gets a new expiration date (wakes up TaskExpirationTracker)
+expiration_dates_changed = Signal()
+# sent when tasks become QUEUED (created or requeued), wakes up the HTCTracker
+tasks_queued = Signal()
+
+# max number of attempts of a unit of work that lost an optimistic
+# concurrency race (see `_retry_on_conflict` and `_transition_task`)
+_MAX_CONFLICT_ATTEMPTS = 5
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class QueueFullError(Exception):
+    """Raised when a new task is not admitted, the queued tasks (of its owner)
+    being at the admission limit (see create_task)"""
+
+
+class TaskTooLargeError(Exception):
+    """Raised when a new task has more procs than the admission limit of the
+    queued tasks (see create_task)"""
+
+
+def _retry_on_conflict(func: F) -> F:
+    """Rerun the unit of work if a concurrent writer updated its rows first
+
+    The ORM updates of the versioned entities (dbm.Task, dbm.HTCCluster)
+    raise StaleDataError when the row version changed since the entity was
+    loaded; the transaction is then rolled back (by the session scope) and
+    `func` is called again with fresh data.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, _MAX_CONFLICT_ATTEMPTS + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlalchemy.orm.exc.StaleDataError:
+                if attempt == _MAX_CONFLICT_ATTEMPTS:
+                    raise
+                print(f"{func.__name__}: concurrent update, retrying")
+        return None
+
+    return wrapper  # type: ignore
+
+
+def _transition_task(
+    session: sqlalchemy.orm.Session,
+    task_id: str,
+    conditions: list,
+    values: dict,
+) -> Optional[int]:
+    """Conditional (compare-and-swap) task state transition
+
+    Reads the task state and row version and updates the row with `values`
+    only if the version is unchanged and `conditions` still hold, i.e.
+    `UPDATE tasks SET ..., version = version + 1 WHERE id = ? AND version = ?
+    AND <conditions>`. Re-reads and retries if a concurrent writer won.
+
+    Returns the previous state, None if the task does not exist or does not
+    match the conditions (no-op).
+    """
+
+    for _ in range(_MAX_CONFLICT_ATTEMPTS):
+        row = session.execute(
+            sqlalchemy.select(dbm.Task.state, dbm.Task.version).where(
+                dbm.Task.id == task_id, *conditions
+            )
+        ).one_or_none()
+        if row is None:
+            return None
+        result = session.execute(
+            sqlalchemy.update(dbm.Task)
+            .where(dbm.Task.id == task_id, dbm.Task.version == row.version, *conditions)
+            .values(**values, version=dbm.Task.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:  # type: ignore
+            return row.state
+    print(f"task {task_id}: too many concurrent updates, transition skipped")
+    return None
+
+
+def reconcile_task_state_counters() -> None:
+    """Reload the task state counters with a single `GROUP BY state` query
+
+    Runs under db_rlock, so that it does not race with another reconcile. The
+    state transitions are not serialized by db_rlock (they are conditional
+    updates on the row version), so the counters may be briefly off by the
+    transitions committed between the count and the reset, until the next
+    reconcile.
+    """
+
+    with dbm.db_rlock, dbm.db.session_scope() as session:
+        rows = session.execute(
+            sqlalchemy.select(
+                dbm.Task.state, sqlalchemy.func.count()  # pylint: disable=not-callable
+            ).group_by(dbm.Task.state)
+        ).all()
+        task_state_counters.reset({state: count for state, count in rows})
+
+
 def get_default_task_id() -> str:
     """Get the default task ID"""
 
-    with dbm.db_rlock:
+    with dbm.db_rlock, dbm.db.session_scope():
         task_id = "default"
         db_task: Optional[dbm.Task] = dbm.Task.query.get(task_id)
         if db_task is None:
@@ -44,98 +225,281 @@ def post_task():
     return {}
 
 
+@_retry_on_conflict
 def delete_task(task_id: str) -> bool:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_task = dbm.Task.query.get(task_id)
         if db_task is None:
             return False
+        state = db_task.state
         for db_log_entry in db_task.log_entries:  # type: ignore
             dbm.db.session.delete(db_log_entry)
         dbm.db.session.delete(db_task)
         dbm.db.session.commit()
+        task_state_counters.move(state, None)  # type: ignore
         return True
 
 
 def get_task_count() -> int:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         n_tasks = dbm.Task.query.count()
 
     return n_tasks
 
 
-def get_status():
-    with dbm.db_rlock:
-        utcnow = datetime.now(timezone.utc)
-        n_tasks_queued = dbm.Task.query.filter(
-            dbm.Task.state == TaskStates.QUEUED
-        ).count()
-        n_tasks_submitted = dbm.Task.query.filter(
-            dbm.Task.state == TaskStates.SUBMITTED
-        ).count()
-        n_tasks_completed = dbm.Task.query.filter(
-            dbm.Task.state == TaskStates.COMPLETED
-        ).count()
-        n_tasks_completed_error = dbm.Task.query.filter(
-            dbm.Task.state == TaskStates.COMPLETED_WITH_ERROR
-        ).count()
-        n_tasks_timed_out = dbm.Task.query.filter(
-            dbm.Task.state == TaskStates.TIMED_OUT
-        ).count()
-
-        return ServerStatus(
-            response_date=utcnow,
-            n_tasks_queued=n_tasks_queued,
-            n_tasks_submitted=n_tasks_submitted,
-            n_tasks_completed=n_tasks_completed,
-            n_tasks_completed_with_error=n_tasks_completed_error,
-            n_tasks_timed_out=n_tasks_timed_out,
+def get_status() -> ServerStatus:
+    """Server status from the in-memory task state counters"""
+
+    if not task_state_counters.valid:
+        reconcile_task_state_counters()
+
+    return ServerStatus(
+        response_date=datetime.now(timezone.utc),
+        n_tasks_queued=task_state_counters.get(TaskStates.QUEUED),
+        n_tasks_submitted=task_state_counters.get(TaskStates.SUBMITTED),
+        n_tasks_completed=task_state_counters.get(TaskStates.COMPLETED),
+        n_tasks_completed_with_error=task_state_counters.get(
+            TaskStates.COMPLETED_WITH_ERROR
+        ),
+        n_tasks_timed_out=task_state_counters.get(TaskStates.TIMED_OUT),
+    )
+
+
+# the task columns returned by the API (the array task item data can be big)
+_TASK_API_COLUMNS = [c for c in dbm.Task.__table__.c if c.name != "item_data_json"]
+
+
+# submission order of the queued tasks (of an owner)
+_TASK_QUEUE_ORDER = [dbm.Task.priority.desc(), dbm.Task.creation_date, dbm.Task.id]
+
+
+def _owner_tasks_filters(
+    state: int, partition: int, num_partitions: int
+) -> list[sqlalchemy.ColumnElement]:
+    filters = [dbm.Task.state == state]
+    if state == TaskStates.QUEUED:
+        filters.append(dbm.Task.retries_left > 0)
+    if num_partitions > 1:
+        filters.append(dbm.Task.shard % num_partitions == partition)
+    return filters
+
+
+# number of HTCondor procs of a task (the items of an array task)
+# pylint: disable-next=assignment-from-no-return
+_TASK_PROCS = sqlalchemy.func.coalesce(dbm.Task.num_items, 1)
+
+
+def get_owner_proc_counts(
+    state: int, partition: int = 0, num_partitions: int = 1
+) -> dict[Optional[str], int]:
+    """Number of procs of the tasks in `state` (queued: with retries left)
+    per owner, in the tracker partition `partition`"""
+
+    with dbm.db.session_scope() as session:
+        rows = session.execute(
+            sqlalchemy.select(dbm.Task.owner, sqlalchemy.func.sum(_TASK_PROCS))
+            .where(*_owner_tasks_filters(state, partition, num_partitions))
+            .group_by(dbm.Task.owner)
         )
+        return {owner: count for owner, count in rows}
+
+
+def get_owner_tasks_queued(
+    owner: Optional[str],
+    limit: int,
+    offset: int = 0,
+    partition: int = 0,
+    num_partitions: int = 1,
+) -> list[Task]:
+    """`limit` queued tasks (with retries left) of the owner in the tracker
+    partition `partition`, by decreasing priority, from the `offset`-th"""
+
+    with dbm.db.session_scope() as session:
+        if owner is None:
+            owner_filter = dbm.Task.owner.is_(None)
+        else:
+            owner_filter = dbm.Task.owner == owner
+        db_tasks = session.scalars(
+            sqlalchemy.select(dbm.Task)
+            .where(
+                *_owner_tasks_filters(TaskStates.QUEUED, partition, num_partitions),
+                owner_filter,
+            )
+            .order_by(*_TASK_QUEUE_ORDER)
+            .offset(offset)
+            .limit(limit)
+        )
+        return [db_task.dump_obj() for db_task in db_tasks]
+
 
+def get_tasks_queued_json() -> bytes:
+    """Queued tasks (with retries left) as a JSON TaskListResponse"""
 
-def get_tasks_queued():
-    with dbm.db_rlock:
+    with dbm.db.session_scope() as session:
         utcnow = datetime.now(timezone.utc)
+        rows = session.execute(
+            sqlalchemy.select(*_TASK_API_COLUMNS)
+            .where(dbm.Task.state == TaskStates.QUEUED, dbm.Task.retries_left > 0)
+            .order_by(*_TASK_QUEUE_ORDER)
+        )
+        items = [serialization.task_row_to_dict(row) for row in rows]
 
-        task_list = []
-        db_tasks = dbm.Task.query.filter(dbm.Task.state.in_([TaskStates.QUEUED])).all()
-        # db_tasks = dbm.Task.query.all()
-        for _task in db_tasks:
-            db_task: dbm.Task = _task
-            if db_task.retries_left <= 0:  # type: ignore
-                continue
-            task_list.append(db_task.dump_obj())
+    return serialization.dump_task_list_response(utcnow, items)
 
-    return TaskListResponse(utcnow, task_list)
 
+def get_tasks_completed_json() -> bytes:
+    """Completed tasks as a JSON TaskListResponse"""
 
-def get_tasks_completed():
-    with dbm.db_rlock:
+    with dbm.db.session_scope() as session:
         utcnow = datetime.now(timezone.utc)
+        rows = session.execute(
+            sqlalchemy.select(*_TASK_API_COLUMNS).where(
+                dbm.Task.state == TaskStates.COMPLETED
+            )
+        )
+        items = [serialization.task_row_to_dict(row) for row in rows]
 
-        task_list = []
-        db_tasks = dbm.Task.query.filter(dbm.Task.state == TaskStates.COMPLETED).all()
-        for _task in db_tasks:
-            db_task: dbm.Task = _task
-            task_list.append(db_task.dump_obj())
+    return serialization.dump_task_list_response(utcnow, items)
 
-    return TaskListResponse(utcnow, task_list)
 
+def _db_utc(value: datetime) -> datetime:
+    """Convert to the naive UTC datetime representation used in the DB"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
-def get_tasks_all():
-    with dbm.db_rlock:
+
+def _db_utc_text(value: datetime) -> str:
+    """`value` as a string comparable (as a string) with the DB dates
+
+    The dates are stored as text, without fraction when set by the DB
+    (`YYYY-MM-DD HH:MM:SS`) or with microseconds when set by the app. Without
+    its trailing zeros, the fraction of `value` compares right with both.
+    """
+    text = _db_utc(value).isoformat(sep=" ")
+    if "." in text:
+        text = text.rstrip("0")
+    return text
+
+
+def _encode_task_cursor(creation_date_raw: str, task_id: str) -> str:
+    data = json.dumps([creation_date_raw, task_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def _decode_task_cursor(cursor: str) -> tuple[str, str]:
+    """Decode a task list cursor, raises ValueError if the cursor is invalid"""
+    try:
+        creation_date_raw, task_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(creation_date_raw, str) or not isinstance(task_id, str):
+        raise ValueError("invalid cursor")
+    return creation_date_raw, task_id
+
+
+# keyset comparisons use the stored text, so that the rows created with the
+# server_default (no microseconds) are ordered the same way as SQLite orders them
+_TASK_CREATION_DATE_RAW = sqlalchemy.type_coerce(
+    dbm.Task.creation_date, sqlalchemy.String
+)
+_TASK_STATE_DATE_RAW = sqlalchemy.type_coerce(dbm.Task.state_date, sqlalchemy.String)
+
+
+def _task_list_filters(query: TaskListQuery) -> list:
+    """SQL filters of a task list query (including the cursor position)"""
+
+    filters = []
+    if query.states:
+        filters.append(dbm.Task.state.in_(query.states))
+    if query.cluster_id is not None:
+        filters.append(dbm.Task.cluster_id == query.cluster_id)
+    # compared as text, see _db_utc_text
+    if query.created_after is not None:
+        filters.append(_TASK_CREATION_DATE_RAW >= _db_utc_text(query.created_after))
+    if query.created_before is not None:
+        filters.append(_TASK_CREATION_DATE_RAW < _db_utc_text(query.created_before))
+    if query.state_date_after is not None:
+        filters.append(_TASK_STATE_DATE_RAW >= _db_utc_text(query.state_date_after))
+    if query.state_date_before is not None:
+        filters.append(_TASK_STATE_DATE_RAW < _db_utc_text(query.state_date_before))
+    if query.cursor:
+        cursor_date, cursor_id = _decode_task_cursor(query.cursor)
+        filters.append(
+            sqlalchemy.or_(
+                _TASK_CREATION_DATE_RAW > cursor_date,
+                sqlalchemy.and_(
+                    _TASK_CREATION_DATE_RAW == cursor_date, dbm.Task.id > cursor_id
+                ),
+            )
+        )
+    return filters
+
+
+def get_tasks_all_json(query: Optional[TaskListQuery] = None) -> bytes:
+    """Get a page of tasks ordered by (creation_date, id) as JSON
+
+    Filters are applied in SQL, the page position is a keyset cursor, so the
+    cost of a call does not depend on the number of tasks in the DB.
+    Raises ValueError if `query.cursor` is invalid.
+    """
+
+    if query is None:
+        query = TaskListQuery()
+
+    with dbm.db.session_scope() as session:
         utcnow = datetime.now(timezone.utc)
 
-        task_list = []
-        db_tasks = dbm.Task.query.all()
-        for _task in db_tasks:
-            db_task: dbm.Task = _task
-            task_list.append(db_task.dump_obj())
+        rows = session.execute(
+            sqlalchemy.select(
+                *_TASK_API_COLUMNS,
+                _TASK_CREATION_DATE_RAW.label("creation_date_raw"),
+            )
+            .filter(*_task_list_filters(query))
+            .order_by(dbm.Task.creation_date, dbm.Task.id)
+            .limit(query.limit + 1)
+        ).all()
+
+        next_cursor = None
+        if len(rows) > query.limit:
+            rows = rows[: query.limit]
+            next_cursor = _encode_task_cursor(
+                rows[-1].creation_date_raw, rows[-1].id
+            )
+
+        items = [serialization.task_row_to_dict(row) for row in rows]
 
-    return TaskListResponse(response_date=utcnow, items=task_list)
+    return serialization.dump_task_list_response(utcnow, items, next_cursor)
+
+
+def iter_tasks_ndjson(query: TaskListQuery, batch_size: int = 500) -> Iterator[bytes]:
+    """Stream all tasks matching `query` (its limit is ignored) as NDJSON
+
+    Rows are fetched with a server-side cursor, one chunk per batch, so memory
+    use is bounded by `batch_size`. The query is validated (and may raise
+    ValueError) before the first batch is fetched.
+    """
+
+    stmt = (
+        sqlalchemy.select(*_TASK_API_COLUMNS)
+        .filter(*_task_list_filters(query))
+        .order_by(dbm.Task.creation_date, dbm.Task.id)
+        .execution_options(yield_per=batch_size)
+    )
+
+    def _iter_chunks() -> Iterator[bytes]:
+        with dbm.db.create_session() as session:
+            for rows in session.execute(stmt).partitions():
+                yield serialization.dump_ndjson(
+                    serialization.TASK_ADAPTER,
+                    (serialization.task_row_to_dict(row) for row in rows),
+                )
+
+    return _iter_chunks()
 
 
 def get_task_by_id(task_id: str) -> Optional[Task]:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_task: dbm.Task = dbm.Task.query.get(task_id)
         if db_task is None:
             return None
@@ -145,20 +509,208 @@ def get_task_by_id(task_id: str) -> Optional[Task]:
     return task
 
 
-def create_task(task: Task) -> Task:
-    with dbm.db_rlock:
+def get_task_json(task_id: str) -> Optional[bytes]:
+    with dbm.db.session_scope() as session:
+        row = session.execute(
+            sqlalchemy.select(*_TASK_API_COLUMNS).where(dbm.Task.id == task_id)
+        ).first()
+    if row is None:
+        return None
+    return serialization.dump_task(serialization.task_row_to_dict(row))
+
+
+def _proc_states_page_columns(offset: int, limit: int) -> list:
+    """The proc states and exit codes of procs [offset, offset + limit)
+
+    Only that part of the proc state columns is read (substr on the blobs).
+    """
+
+    exit_code_size = models.HTCProcStates.EXIT_CODE_SIZE
+    return [
+        sqlalchemy.func.substr(dbm.HTCCluster.proc_states, offset + 1, limit),
+        sqlalchemy.func.substr(
+            dbm.HTCCluster.proc_exit_codes,
+            offset * exit_code_size + 1,
+            limit * exit_code_size,
+        ),
+    ]
+
+
+def get_task_item(task_id: str, index: int) -> Optional[models.TaskItem]:
+    """Status of one item of an array task, None if there is no such item
+
+    Only the item's entries of the task item data and of the cluster proc
+    states are extracted (by SQLite), not the whole JSON documents.
+    """
+
+    with dbm.db.session_scope() as session:
+        row = session.execute(
+            sqlalchemy.select(
+                dbm.Task.num_items,
+                dbm.Task.cluster_id,
+                sqlalchemy.func.json_extract(dbm.Task.item_data_json, f"$[{index}]"),
+            ).where(dbm.Task.id == task_id)
+        ).one_or_none()
+        if row is None:
+            return None
+        num_items, cluster_id, item_data_json = row
+        if index < 0 or index >= (num_items or 1):
+            return None
+
+        task_item = models.TaskItem(
+            index=index,
+            item_data=json.loads(item_data_json) if item_data_json else None,
+        )
+        if cluster_id is None:
+            return task_item
+
+        cluster_row = session.execute(
+            sqlalchemy.select(
+                dbm.HTCCluster.first_proc,
+                *_proc_states_page_columns(index, 1),
+            ).where(dbm.HTCCluster.id == cluster_id)
+        ).one_or_none()
+
+    if cluster_row is None:
+        return task_item
+    first_proc, states, exit_codes = cluster_row
+    task_item.proc_id = (first_proc or 0) + index
+    if states:
+        proc_states = models.HTCProcStates.from_bytes(0, states, exit_codes)
+        task_item.state = proc_states.states[0]
+        exit_code = proc_states.exit_codes[0]
+        if exit_code != models.HTCProcStates.PROC_EXIT_CODE_NONE:
+            task_item.exit_code = exit_code
+    return task_item
+
+
+def _use_task_result(session: sqlalchemy.orm.Session, result_key: str) -> Optional[str]:
+    """The task of the (fresh) cached result of `result_key`, which becomes
+    the most recently used one; None if there is none"""
+
+    utcnow = datetime.now(timezone.utc)
+    db_task_result = session.get(dbm.TaskResult, result_key)
+    if db_task_result is None or db_task_result.completion_date < _db_utc(
+        utcnow - result_cache.RESULT_REUSE_TTL
+    ):
+        return None
+    db_task_result.last_used_date = utcnow  # type: ignore
+    return db_task_result.task_id  # type: ignore
+
+
+def _add_task_result(session: sqlalchemy.orm.Session, task_id: str) -> None:
+    """Cache the result of the task (completed successfully) if it has a key,
+    replacing the one of an identical task"""
+
+    result_key = session.scalar(
+        sqlalchemy.select(dbm.Task.result_key).where(dbm.Task.id == task_id)
+    )
+    if result_key is None:
+        return
+    utcnow = datetime.now(timezone.utc)
+    session.merge(
+        dbm.TaskResult(
+            key=result_key,
+            task_id=task_id,
+            completion_date=utcnow,
+            last_used_date=utcnow,
+            size=None,
+        )
+    )
+
+
+def _count_queued_procs(
+    session: sqlalchemy.orm.Session,
+    limit: int,
+    owner: Optional[str] = None,
+    by_owner: bool = False,
+) -> int:
+    """Number of procs of the queued tasks (with retries left, of `owner` if
+    `by_owner`), counted over at most `limit` tasks (an index range scan
+    bounded by the limit, each task having at least one proc)"""
+    query = sqlalchemy.select(_TASK_PROCS.label("procs")).where(
+        dbm.Task.state == TaskStates.QUEUED, dbm.Task.retries_left > 0
+    )
+    if by_owner:
+        if owner is None:
+            query = query.where(dbm.Task.owner.is_(None))
+        else:
+            query = query.where(dbm.Task.owner == owner)
+    subquery = query.limit(limit).subquery()
+    return session.scalar(
+        sqlalchemy.select(
+            sqlalchemy.func.coalesce(sqlalchemy.func.sum(subquery.c.procs), 0)
+        )
+    )
+
+
+def _is_queue_full(queued_procs: int, new_procs: int, max_procs: int) -> bool:
+    """True if `new_procs` can't be queued after `queued_procs`"""
+    return queued_procs + new_procs > max_procs
+
+
+def create_task(
+    task: Task,
+    max_queued: Optional[int] = None,
+    owner_max_queued: Optional[int] = None,
+) -> Task:
+    """Create a task (queued, or completed with a cached result if it asks for
+    result reuse, see result_cache)
+
+    Raises QueueFullError if queuing the task would bring the queued procs
+    (an array task counts for its items) over `max_queued`, or the queued
+    procs of its owner over `owner_max_queued` (the tasks without an owner
+    counting as one owner), TaskTooLargeError if the task alone has more
+    procs than one of the limits. The limits are soft: concurrent creations
+    may exceed them by a few tasks.
+    """
+
+    result_key = None
+    if task.reuse_result:
+        result_key = result_cache.get_result_key(task)
+    with dbm.db.session_scope() as session:
         if task.id is None:
             task.id = str(uuid.uuid4())
+        task.result_key = result_key
+        if result_key is not None:
+            task.result_task_id = _use_task_result(session, result_key)
+            if task.result_task_id is not None:
+                task.state = TaskStates.COMPLETED
+        if task.result_task_id is None:
+            procs = task.num_items or 1
+            if any(
+                limit is not None and procs > limit
+                for limit in [max_queued, owner_max_queued]
+            ):
+                raise TaskTooLargeError("more procs than the queued tasks limit")
+            if max_queued is not None and _is_queue_full(
+                _count_queued_procs(session, max_queued), procs, max_queued
+            ):
+                raise QueueFullError("too many queued tasks")
+            if owner_max_queued is not None and _is_queue_full(
+                _count_queued_procs(
+                    session, owner_max_queued, task.owner, by_owner=True
+                ),
+                procs,
+                owner_max_queued,
+            ):
+                raise QueueFullError("too many queued tasks of the owner")
         db_task = dbm.Task(**dbm.Task.obj_to_db_dict(task))
         dbm.db.session.add(db_task)
         dbm.db.session.commit()
+        task_state_counters.move(None, db_task.state)  # type: ignore
+        if db_task.state == TaskStates.QUEUED:  # type: ignore
+            tasks_queued.send()
         task = db_task.dump_obj()
 
+    if task.result_task_id is not None and result_cache.has_task_root_result(task):
+        result_cache.link_cached_result(task.id, task.result_key)  # type: ignore
     return task
 
 
+@_retry_on_conflict
 def update_task(task_id: str, task_update_request: TaskUpdateRequest) -> Optional[Task]:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_task: Optional[dbm.Task] = dbm.Task.query.get(task_id)
         if db_task is None:
             return None
@@ -190,53 +742,109 @@ def update_task(task_id: str, task_update_request: TaskUpdateRequest) -> Optiona
         elif task_update_request.reset_expiration_date:
             nullable.append("expiration_date")
 
+        old_state = db_task.state
         db_task.update_from_obj(task, nullable)
         dbm.db.session.add(db_task)
         dbm.db.session.commit()
+        task_state_counters.move(old_state, db_task.state)  # type: ignore
+        if task.expiration_date is not None:
+            expiration_dates_changed.send()
+        if db_task.state == TaskStates.QUEUED:  # type: ignore
+            if old_state != TaskStates.QUEUED:
+                tasks_queued.send()
 
         return db_task.dump_obj()
 
 
-def reset_expired_tasks():
-    with dbm.db_rlock:
-        db_tasks = dbm.Task.query.filter(dbm.Task.state == TaskStates.SUBMITTED).all()
+def reset_expired_tasks() -> Optional[datetime]:
+    """Requeue (or time out, if no retries are left) the expired submitted tasks
 
+    Set-based: one UPDATE per outcome. Returns the earliest expiration date of
+    the tasks that are still submitted (None if there are none).
+    """
+
+    with dbm.db.session_scope() as session:
         utcnow = datetime.now(timezone.utc)
-        requeued_task_ids = []
-        timed_out_task_ids = []
-        tasks_updated_flag = False
-        for _db_task in db_tasks:
-            db_task: dbm.Task = _db_task
-            if db_task.expiration_date > utcnow:  # type: ignore
-                continue
-            if db_task.retries_left > 0:  # type: ignore
-                db_task.state = TaskStates.QUEUED
-                requeued_task_ids.append(db_task.id)
-            else:
-                db_task.state = TaskStates.TIMED_OUT
-                timed_out_task_ids.append(db_task.id)
-            db_task.state_date = utcnow
-            db_task.expiration_date = None
-            dbm.db.session.add(db_task)
-            tasks_updated_flag = True
+        # pylint: disable-next=assignment-from-no-return
+        retries_left = sqlalchemy.func.coalesce(dbm.Task.retries_left, 0)
+        expired = [
+            dbm.Task.state == TaskStates.SUBMITTED,
+            dbm.Task.expiration_date <= _db_utc(utcnow),
+        ]
+
+        def _update_expired(condition, new_state: int) -> list[str]:
+            return list(
+                session.scalars(
+                    sqlalchemy.update(dbm.Task)
+                    .where(*expired, condition)
+                    .values(
+                        state=new_state,
+                        state_date=utcnow,
+                        expiration_date=None,
+                        version=dbm.Task.version + 1,
+                    )
+                    .returning(dbm.Task.id)
+                    .execution_options(synchronize_session=False)
+                )
+            )
 
-        if tasks_updated_flag:
-            dbm.db.session.commit()
+        requeued_task_ids = _update_expired(retries_left > 0, TaskStates.QUEUED)
+        timed_out_task_ids = _update_expired(retries_left <= 0, TaskStates.TIMED_OUT)
+
+        if requeued_task_ids or timed_out_task_ids:
+            session.commit()
+            task_state_counters.move(
+                TaskStates.SUBMITTED, TaskStates.QUEUED, len(requeued_task_ids)
+            )
+            task_state_counters.move(
+                TaskStates.SUBMITTED, TaskStates.TIMED_OUT, len(timed_out_task_ids)
+            )
+
+        next_expiration_date = session.scalar(
+            sqlalchemy.select(
+                sqlalchemy.func.min(dbm.Task.expiration_date)
+            ).where(dbm.Task.state == TaskStates.SUBMITTED)
+        )
 
-        if len(requeued_task_ids) > 0:
-            print(f"requeued tasks:\n{requeued_task_ids}")
-        if len(timed_out_task_ids) > 0:
-            print(f"timed out tasks:\n{timed_out_task_ids}")
+    if len(requeued_task_ids) > 0:
+        print(f"requeued tasks:\n{requeued_task_ids}")
+        tasks_queued.send()
+    if len(timed_out_task_ids) > 0:
+        print(f"timed out tasks:\n{timed_out_task_ids}")
+
+    if next_expiration_date is None:
+        return None
+    return next_expiration_date.replace(tzinfo=timezone.utc)
+
+
+def set_task_submission_failed(task_id: str) -> None:
+    """Mark a (still queued) task that could not be submitted as completed
+    with error"""
+
+    with dbm.db.session_scope() as session:
+        old_state = _transition_task(
+            session,
+            task_id,
+            [dbm.Task.state == TaskStates.QUEUED],
+            {
+                "state": TaskStates.COMPLETED_WITH_ERROR,
+                "state_date": datetime.now(timezone.utc),
+            },
+        )
+        if old_state is None:
+            return
+        session.commit()
+        task_state_counters.move(old_state, TaskStates.COMPLETED_WITH_ERROR)
 
 
 def get_db_htc_cluster_by_id(cluster_id: int) -> Optional[dbm.HTCCluster]:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_htc_cluster = dbm.HTCCluster.query.get(cluster_id)
     return db_htc_cluster
 
 
 def get_or_create_db_htc_cluster_by_id(cluster_id: int) -> dbm.HTCCluster:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_htc_cluster = dbm.HTCCluster.query.get(cluster_id)
         if db_htc_cluster is None:
             db_htc_cluster = dbm.HTCCluster(
@@ -252,83 +860,340 @@ def get_or_create_db_htc_cluster_by_id(cluster_id: int) -> dbm.HTCCluster:
         return db_htc_cluster
 
 
+def _index_htc_cluster(db_htc_cluster: dbm.HTCCluster) -> None:
+    cluster_index.put(
+        db_htc_cluster.id,  # type: ignore
+        ClusterRoute(
+            task_id=db_htc_cluster.task_id,  # type: ignore
+            first_proc=db_htc_cluster.first_proc or 0,  # type: ignore
+            num_procs=db_htc_cluster.num_procs or 0,  # type: ignore
+            cluster_state=db_htc_cluster.cluster_state,  # type: ignore
+        ),
+    )
+
+
+def warm_cluster_index() -> int:
+    """Replace the cluster index content with the active (created or
+    executing) clusters
+
+    Run when the tracker starts (e.g. after winning the leader election, the
+    clusters may have changed in another process meanwhile). Returns the
+    number of clusters indexed (at most the index size, the most recent ones).
+    """
+
+    with dbm.db.session_scope() as session:
+        rows = session.execute(
+            sqlalchemy.select(
+                dbm.HTCCluster.id,
+                dbm.HTCCluster.task_id,
+                dbm.HTCCluster.first_proc,
+                dbm.HTCCluster.num_procs,
+                dbm.HTCCluster.cluster_state,
+            )
+            .where(
+                dbm.HTCCluster.cluster_state.in_(
+                    [HTCClusterStates.CREATED, HTCClusterStates.EXECUTING]
+                )
+            )
+            .order_by(dbm.HTCCluster.id.desc())
+            .limit(cluster_index.max_size)
+        ).all()
+
+    cluster_index.clear()
+    for row in reversed(rows):
+        cluster_index.put(
+            row.id,
+            ClusterRoute(
+                task_id=row.task_id,
+                first_proc=row.first_proc or 0,
+                num_procs=row.num_procs or 0,
+                cluster_state=row.cluster_state,
+            ),
+        )
+    return len(rows)
+
+
+def _set_cluster_task_submitted(
+    session: sqlalchemy.orm.Session,
+    cluster_id: int,
+    task_id: Optional[str],
+    num_procs: Optional[int] = None,
+) -> Optional[int]:
+    """Mark the cluster's task as submitted, returns its previous state if updated
+
+    Only a queued task is updated: a no-op for a task that completed or was
+    submitted to another cluster meanwhile (e.g. by a stale tracker during a
+    lease handover). An array task gets SUBMITTED_TASK_TTL per proc (as the
+    procs of a bundle, see HTCTracker.submit_bundle), so that it is not
+    requeued, and submitted again, while its cluster is still running.
+    """
+
+    if task_id is None or task_id == "-":
+        return None
+
+    utcnow = datetime.now(timezone.utc)
+    return _transition_task(
+        session,
+        task_id,
+        [
+            dbm.Task.state == TaskStates.QUEUED,
+            sqlalchemy.or_(
+                dbm.Task.cluster_id.is_(None), dbm.Task.cluster_id != cluster_id
+            ),
+        ],
+        {
+            "state": TaskStates.SUBMITTED,
+            "state_date": utcnow,
+            "cluster_id": cluster_id,
+            "retries_left": dbm.Task.retries_left - 1,
+            "expiration_date": utcnow + SUBMITTED_TASK_TTL * max(num_procs or 1, 1),
+        },
+    )
+
+
 def update_cluster_task(cluster_id: Optional[int]):
-    with dbm.db_rlock:
+    with dbm.db.session_scope() as session:
         db_htc_cluster: Optional[dbm.HTCCluster] = dbm.HTCCluster.query.get(cluster_id)
         if db_htc_cluster is None:
             return False
 
-        task_id = db_htc_cluster.task_id
-        if task_id is None or task_id == "-":  # type: ignore
-            return False
-        db_task: Optional[dbm.Task] = dbm.Task.query.get(task_id)
-        if db_task is None:
-            return False
-
-        if db_task.cluster_id == cluster_id:  # type: ignore
+        old_state = _set_cluster_task_submitted(
+            session,
+            cluster_id,  # type: ignore
+            db_htc_cluster.task_id,  # type: ignore
+            db_htc_cluster.num_procs,  # type: ignore
+        )
+        if old_state is None:
             return False
 
-        utcnow = datetime.now(timezone.utc)
-        db_task.state = TaskStates.SUBMITTED
-        db_task.state_date = utcnow
-        db_task.cluster_id = cluster_id
-        db_task.retries_left = db_task.retries_left - 1
-        db_task.expiration_date = utcnow + timedelta(seconds=2 * 60)
-        dbm.db.session.add(db_task)
         dbm.db.session.commit()
+        task_state_counters.move(old_state, TaskStates.SUBMITTED)
+        expiration_dates_changed.send()
 
         return True
 
 
+def _init_new_htc_cluster(new_htc_cluster: HTCCluster) -> None:
+    """Set the defaults (creation date, empty params, initial status)"""
+
+    new_htc_cluster.creation_date = datetime.now(timezone.utc)
+
+    if new_htc_cluster.sub_params is None:
+        new_htc_cluster.sub_params = {}
+
+    if new_htc_cluster.cluster_ad is None:
+        new_htc_cluster.cluster_ad = {}
+
+    if new_htc_cluster.status is None:
+        procs = []
+        if new_htc_cluster.num_procs > 0:  # type: ignore
+            for index in range(new_htc_cluster.num_procs):  # type: ignore
+                procs.append(
+                    {
+                        "index": new_htc_cluster.first_proc + index,  # type: ignore
+                        "state": -1,
+                        "exit_code": None,
+                    }
+                )
+        new_htc_cluster.status = HTCClusterStatus(
+            cluster_state=HTCClusterStates.CREATED, procs=procs
+        )
+
+
 def create_htc_cluster(new_htc_cluster: HTCCluster) -> HTCCluster:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_htc_cluster: Optional[dbm.HTCCluster] = dbm.HTCCluster.query.get(
             new_htc_cluster.id
         )
         if db_htc_cluster is not None:
             return db_htc_cluster.dump_obj()
 
-        print(f"request:\n{new_htc_cluster}")
+        _init_new_htc_cluster(new_htc_cluster)
+        db_htc_cluster = dbm.HTCCluster(
+            **dbm.HTCCluster.obj_to_db_dict(new_htc_cluster)
+        )
+        dbm.db.session.add(db_htc_cluster)
+        dbm.db.session.commit()
+        _index_htc_cluster(db_htc_cluster)
+
+        return db_htc_cluster.dump_obj()
 
-        new_htc_cluster.creation_date = datetime.now(timezone.utc)
 
-        if new_htc_cluster.sub_params is None:
-            new_htc_cluster.sub_params = {}
+def create_submitted_htc_clusters(new_htc_clusters: list[HTCCluster]) -> int:
+    """Create the clusters of a batch submission and mark their tasks submitted
 
-        if new_htc_cluster.cluster_ad is None:
-            new_htc_cluster.cluster_ad = {}
+    One transaction for the whole batch; clusters that already exist are
+    skipped. Returns the number of tasks marked as submitted.
+    """
 
-        if new_htc_cluster.status is None:
-            procs = []
-            if new_htc_cluster.num_procs > 0:  # type: ignore
-                for index in range(new_htc_cluster.num_procs):  # type: ignore
-                    procs.append(
-                        {
-                            "index": new_htc_cluster.first_proc + index,  # type: ignore
-                            "state": -1,
-                            "exit_code": None,
-                        }
+    with dbm.db.session_scope() as session:
+        cluster_ids = [c.id for c in new_htc_clusters]
+        existing_ids = set()
+        for offset in range(0, len(cluster_ids), _MAX_IN_PARAMS):
+            existing_ids.update(
+                session.scalars(
+                    sqlalchemy.select(dbm.HTCCluster.id).where(
+                        dbm.HTCCluster.id.in_(
+                            cluster_ids[offset : offset + _MAX_IN_PARAMS]
+                        )
                     )
-            new_htc_cluster.status = HTCClusterStatus(
-                cluster_state=HTCClusterStates.CREATED, procs=procs
+                )
             )
-            print(f"updated status:\n{new_htc_cluster.status}")
-
-        print(f"updated request:\n{new_htc_cluster}")
 
+        old_states = []
+        db_htc_clusters = []
+        for new_htc_cluster in new_htc_clusters:
+            if new_htc_cluster.id in existing_ids:
+                continue
+            existing_ids.add(new_htc_cluster.id)
+            _init_new_htc_cluster(new_htc_cluster)
+            db_htc_cluster = dbm.HTCCluster(
+                **dbm.HTCCluster.obj_to_db_dict(new_htc_cluster)
+            )
+            session.add(db_htc_cluster)
+            db_htc_clusters.append(db_htc_cluster)
+            old_state = _set_cluster_task_submitted(
+                session,
+                new_htc_cluster.id,  # type: ignore
+                new_htc_cluster.task_id,
+                new_htc_cluster.num_procs,
+            )
+            if old_state is not None:
+                old_states.append(old_state)
+
+        session.commit()
+        for db_htc_cluster in db_htc_clusters:
+            _index_htc_cluster(db_htc_cluster)
+        for old_state in old_states:
+            task_state_counters.move(old_state, TaskStates.SUBMITTED)
+        if old_states:
+            expiration_dates_changed.send()
+
+    return len(old_states)
+
+
+def create_submitted_bundle(
+    new_htc_cluster: HTCCluster, task_ids: list[str], ttl: timedelta
+) -> int:
+    """Create the cluster of a task bundle and mark its tasks submitted
+
+    The tasks get the bundle cluster id and their index in the bundle as proc
+    id, and expire after `ttl`. Returns the number of tasks marked as
+    submitted (0 if the cluster already exists).
+    """
+
+    with dbm.db.session_scope() as session:
+        if session.get(dbm.HTCCluster, new_htc_cluster.id) is not None:
+            return 0
+        _init_new_htc_cluster(new_htc_cluster)
         db_htc_cluster = dbm.HTCCluster(
             **dbm.HTCCluster.obj_to_db_dict(new_htc_cluster)
         )
-        dbm.db.session.add(db_htc_cluster)
-        dbm.db.session.commit()
+        session.add(db_htc_cluster)
 
-        return db_htc_cluster.dump_obj()
+        utcnow = datetime.now(timezone.utc)
+        old_states = []
+        for proc_id, task_id in enumerate(task_ids):
+            old_state = _transition_task(
+                session,
+                task_id,
+                [dbm.Task.state == TaskStates.QUEUED],
+                {
+                    "state": TaskStates.SUBMITTED,
+                    "state_date": utcnow,
+                    "cluster_id": new_htc_cluster.id,
+                    "proc_id": proc_id,
+                    "retries_left": dbm.Task.retries_left - 1,
+                    "expiration_date": utcnow + ttl,
+                },
+            )
+            if old_state is not None:
+                old_states.append(old_state)
+
+        session.commit()
+        _index_htc_cluster(db_htc_cluster)
+        for old_state in old_states:
+            task_state_counters.move(old_state, TaskStates.SUBMITTED)
+        if old_states:
+            expiration_dates_changed.send()
+
+    return len(old_states)
+
+
+def get_taskless_htc_cluster_sub_params(cluster_ids: list[int]) -> dict[int, dict]:
+    """Submit params of the clusters (among `cluster_ids`) not owned by a
+    single task, e.g. the task bundles"""
+
+    sub_params = {}
+    with dbm.db.session_scope() as session:
+        for offset in range(0, len(cluster_ids), _MAX_IN_PARAMS):
+            ids = cluster_ids[offset : offset + _MAX_IN_PARAMS]
+            rows = session.execute(
+                sqlalchemy.select(
+                    dbm.HTCCluster.id, dbm.HTCCluster.sub_params_json
+                ).where(dbm.HTCCluster.id.in_(ids), dbm.HTCCluster.task_id == "-")
+            )
+            for cluster_id, sub_params_json in rows:
+                sub_params[cluster_id] = dbm.db_json_to_dict(sub_params_json) or {}
+    return sub_params
+
+
+def complete_bundled_tasks(
+    cluster_id: int, exit_codes: dict[str, Optional[int]]
+) -> int:
+    """Complete the tasks still submitted to the bundle `cluster_id`
+
+    A task completes with error unless its exit code is 0. A task missing
+    from `exit_codes` did not run (e.g. the job was removed or evicted before
+    reaching it): it is requeued if it has retries left, otherwise completed
+    with error. Returns the number of completed or requeued tasks.
+    """
+
+    with dbm.db.session_scope() as session:
+        rows = session.execute(
+            sqlalchemy.select(dbm.Task.id, dbm.Task.retries_left).where(
+                dbm.Task.cluster_id == cluster_id,
+                dbm.Task.state == TaskStates.SUBMITTED,
+            )
+        ).all()
+        utcnow = datetime.now(timezone.utc)
+        task_state_moves = []
+        for task_id, retries_left in rows:
+            values: dict[str, Any] = {"state_date": utcnow, "expiration_date": None}
+            if exit_codes.get(task_id) == 0:
+                values["state"] = TaskStates.COMPLETED
+            elif task_id not in exit_codes and (retries_left or 0) > 0:
+                values.update(state=TaskStates.QUEUED, cluster_id=None, proc_id=None)
+            else:
+                values["state"] = TaskStates.COMPLETED_WITH_ERROR
+            old_state = _transition_task(
+                session,
+                task_id,
+                [
+                    dbm.Task.state == TaskStates.SUBMITTED,
+                    dbm.Task.cluster_id == cluster_id,
+                ],
+                values,
+            )
+            if old_state is not None:
+                task_state_moves.append((old_state, values["state"]))
+                if values["state"] == TaskStates.COMPLETED:
+                    _add_task_result(session, task_id)
+
+        session.commit()
+        for old_state, new_state in task_state_moves:
+            task_state_counters.move(old_state, new_state)
+        if any(new_state == TaskStates.QUEUED for _, new_state in task_state_moves):
+            tasks_queued.send()
+
+    return len(task_state_moves)
 
 
+@_retry_on_conflict
 def update_htc_cluster(
     cluster_id: int, upd_htc_cluster: HTCCluster
 ) -> Optional[HTCCluster]:
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_htc_cluster: Optional[dbm.HTCCluster] = dbm.HTCCluster.query.get(cluster_id)
         if db_htc_cluster is None:
             return None
@@ -337,51 +1202,27 @@ def update_htc_cluster(
 
         dbm.db.session.add(db_htc_cluster)
         dbm.db.session.commit()
+        cluster_index.discard(cluster_id)
 
         return db_htc_cluster.dump_obj()
 
 
+@_retry_on_conflict
 def update_cluster_status(cluster_id: int, status: dict):
-    with dbm.db_rlock:
+    with dbm.db.session_scope():
         db_htc_cluster = get_or_create_db_htc_cluster_by_id(cluster_id)
-        db_htc_cluster.status_json = json.dumps(status)
+        status_obj: HTCClusterStatus = models.HTCClusterStatusPartial().load(
+            status
+        )  # type: ignore
+        db_htc_cluster.update_from_obj(HTCCluster(status=status_obj))
         dbm.db.session.add(db_htc_cluster)
         dbm.db.session.commit()
+        cluster_index.discard(cluster_id)
 
 
-def on_cluster_completion(htc_cluster: models.HTCCluster):
-    if not htc_cluster or not htc_cluster.task_id or htc_cluster.task_id == "-":
-        return
-
-    cluster_state = htc_cluster.status.cluster_state  # type: ignore
-
-    with dbm.db_rlock:
-        db_task: Optional[Task] = dbm.Task.query.get(htc_cluster.task_id)
-        if db_task is None:
-            return
-        if db_task.state != TaskStates.SUBMITTED:
-            return
-
-        utcnow = datetime.now(timezone.utc)
-
-        if cluster_state == HTCClusterStates.COMPLETED_OK:
-            db_task.state = TaskStates.COMPLETED
-            db_task.state_date = utcnow
-        elif cluster_state == HTCClusterStates.COMPLETED_ERROR:
-            db_task.state = TaskStates.COMPLETED_WITH_ERROR
-            db_task.state_date = utcnow
-        db_task.expiration_date = None
-        dbm.db.session.add(db_task)
-        dbm.db.session.commit()
-
-
-def on_job_termination(htc_job_event: models.HTCJobEvent):
-    if htc_job_event is None or htc_job_event.event_type != "JOB_TERMINATED":
-        return
+def _get_job_termination_state(details: dict) -> tuple[int, Optional[int]]:
+    """Proc state and exit code of a JOB_TERMINATED event"""
 
-    cluster_id = htc_job_event.cluster_id
-    proc_id = htc_job_event.proc_id
-    details = htc_job_event.details
     exit_code = None
     if "TerminatedNormally" not in details or not details["TerminatedNormally"]:
         job_state = HTCClusterStates.COMPLETED_ERROR
@@ -394,80 +1235,547 @@ def on_job_termination(htc_job_event: models.HTCJobEvent):
         else:
             job_state = HTCClusterStates.COMPLETED_OK
             exit_code = details["ReturnValue"]
+    return job_state, exit_code
 
-    db_htc_cluster = get_or_create_db_htc_cluster_by_id(cluster_id)
-    proc_id_range = (
-        db_htc_cluster.first_proc,
-        db_htc_cluster.first_proc + db_htc_cluster.num_procs,  # type: ignore
-    )
-    if proc_id < proc_id_range[0] or proc_id >= proc_id_range[1]:  # type: ignore
-        return
 
-    htc_cluster = db_htc_cluster.dump_obj()
-    status = htc_cluster.status
-    if status is None:
-        return
+def _skip_job_termination(htc_job_event: models.HTCJobEvent) -> bool:
+    """True if the cluster index tells the event can't change any proc"""
+
+    route = cluster_index.get(htc_job_event.cluster_id)
+    if route is None:
+        return False
+    return not route.is_active or not route.has_proc(htc_job_event.proc_id)
+
+
+@dataclasses.dataclass
+class _ClusterBatchEntry:
+    """An HTC cluster row and its proc states, updated by a batch of events"""
+
+    db_htc_cluster: dbm.HTCCluster
+    proc_states: Optional[models.HTCProcStates]
+    cluster_state: Optional[int]
+    status_updated: bool = False
+
+
+def _get_cluster_batch_entry(
+    session: sqlalchemy.orm.Session,
+    clusters: dict[int, _ClusterBatchEntry],
+    cluster_id: int,
+) -> _ClusterBatchEntry:
+    entry = clusters.get(cluster_id)
+    if entry is None:
+        db_htc_cluster = session.get(dbm.HTCCluster, cluster_id)
+        if db_htc_cluster is None:
+            db_htc_cluster = dbm.HTCCluster(
+                id=cluster_id,
+                task_id="-",
+                sub_params_json="{}",
+                cluster_ad_json="{}",
+                first_proc=0,
+                num_procs=0,
+            )
+            session.add(db_htc_cluster)
+        else:
+            _index_htc_cluster(db_htc_cluster)
+        entry = _ClusterBatchEntry(
+            db_htc_cluster=db_htc_cluster,
+            proc_states=db_htc_cluster.get_proc_states(),
+            cluster_state=db_htc_cluster.cluster_state,  # type: ignore
+        )
+        clusters[cluster_id] = entry
+    return entry
+
+
+def _on_job_termination(
+    session: sqlalchemy.orm.Session,
+    clusters: dict[int, _ClusterBatchEntry],
+    htc_job_event: models.HTCJobEvent,
+) -> bool:
+    """Update the proc state in the (batch-cached) cluster proc states
+
+    O(1): the proc is updated in place and the completed procs are counted
+    by HTCProcStates. Returns True if the event completed the cluster.
+    """
+
+    job_state, exit_code = _get_job_termination_state(htc_job_event.details)
+    entry = _get_cluster_batch_entry(session, clusters, htc_job_event.cluster_id)
+    proc_states = entry.proc_states
+    if proc_states is None:
+        return False
 
-    if status.cluster_state not in [
+    if entry.cluster_state not in [
         HTCClusterStates.CREATED,
         HTCClusterStates.EXECUTING,
     ]:
-        return
+        return False
 
-    proc_status_updated = False
-    for proc_status in status.procs:  # type: ignore
-        if proc_status["index"] != proc_id:
-            continue
-        if proc_status["state"] == job_state:
-            break
-
-        proc_status["state"] = job_state
-        proc_status["exit_code"] = exit_code
-        proc_status_updated = True
-
-    if proc_status_updated:
-        n_ok = 0
-        n_error = 0
-        for proc_status in status.procs:  # type: ignore
-            if proc_status["state"] == HTCClusterStates.COMPLETED_OK:
-                n_ok += 1
-            if proc_status["state"] == HTCClusterStates.COMPLETED_ERROR:
-                n_error += 1
-        cluster_state_updated = False
-        if n_ok + n_error >= htc_cluster.num_procs:  # type: ignore
-            if n_error > 0:
-                status.cluster_state = HTCClusterStates.COMPLETED_ERROR
-            else:
-                status.cluster_state = HTCClusterStates.COMPLETED_OK
-            cluster_state_updated = True
+    if not proc_states.set_proc(htc_job_event.proc_id, job_state, exit_code):
+        return False
+    entry.status_updated = True
+
+    if proc_states.n_completed >= proc_states.num_procs:
+        if proc_states.n_error > 0:
+            entry.cluster_state = HTCClusterStates.COMPLETED_ERROR
+        else:
+            entry.cluster_state = HTCClusterStates.COMPLETED_OK
+        return True
+    return False
+
+
+def _on_cluster_completion(
+    session: sqlalchemy.orm.Session,
+    cluster_id: int,
+    task_id: Optional[str],
+    cluster_state: int,
+) -> Optional[int]:
+    """Complete the cluster's task (if it is still submitted to this cluster)
+
+    Returns the new task state if updated.
+    """
+
+    if not task_id or task_id == "-":
+        return None
+
+    if cluster_state == HTCClusterStates.COMPLETED_OK:
+        new_state = TaskStates.COMPLETED
+    else:
+        new_state = TaskStates.COMPLETED_WITH_ERROR
+    old_state = _transition_task(
+        session,
+        task_id,
+        [dbm.Task.state == TaskStates.SUBMITTED, dbm.Task.cluster_id == cluster_id],
+        {
+            "state": new_state,
+            "state_date": datetime.now(timezone.utc),
+            "expiration_date": None,
+        },
+    )
+    if old_state is None:
+        return None
+    if new_state == TaskStates.COMPLETED:
+        _add_task_result(session, task_id)
+    return new_state
 
-        db_htc_cluster.update_from_obj(HTCCluster(status=status))
-        dbm.db.session.add(db_htc_cluster)
-        dbm.db.session.commit()
 
-        if cluster_state_updated:
-            on_cluster_completion(db_htc_cluster.dump_obj())
+def get_htc_log_checkpoint(log_filename: str) -> Optional[models.HTCLogCheckpoint]:
+    """Saved read position in the job event log, None if there is none"""
+
+    with dbm.db.session_scope() as session:
+        db_checkpoint: Optional[dbm.HTCLogCheckpoint] = session.get(
+            dbm.HTCLogCheckpoint, log_filename
+        )
+        if db_checkpoint is None:
+            return None
+        return db_checkpoint.dump_obj()
+
+
+def _save_htc_log_checkpoint(
+    session: sqlalchemy.orm.Session, checkpoint: models.HTCLogCheckpoint
+) -> None:
+    checkpoint.update_date = datetime.now(timezone.utc)
+    session.merge(dbm.HTCLogCheckpoint(**dataclasses.asdict(checkpoint)))
+
+
+@_retry_on_conflict
+def post_htc_job_events(
+    new_htc_job_events: list[models.HTCJobEvent],
+    checkpoint: Optional[models.HTCLogCheckpoint] = None,
+) -> list[models.HTCJobEvent]:
+    """Ingest a batch of job events in a single transaction
+
+    Events that are duplicated in the batch or already in the DB are skipped,
+    the new ones are bulk-inserted, and the resulting cluster and task state
+    transitions are applied before the commit. If given, the job event log
+    `checkpoint` (the read position after the batch) is saved in the same
+    transaction. Returns the inserted events.
+    """
+
+    with dbm.db.session_scope() as session:
+        utcnow = datetime.now(timezone.utc)
+
+        events_by_id: dict[str, models.HTCJobEvent] = {}
+        for htc_job_event in new_htc_job_events:
+            events_by_id.setdefault(htc_job_event.gen_entry_id(), htc_job_event)
+
+        entry_ids = list(events_by_id)
+        for offset in range(0, len(entry_ids), _MAX_IN_PARAMS):
+            for entry_id in session.scalars(
+                sqlalchemy.select(dbm.HTCJobEvent.id).where(
+                    dbm.HTCJobEvent.id.in_(entry_ids[offset : offset + _MAX_IN_PARAMS])
+                )
+            ):
+                del events_by_id[entry_id]
+
+        inserted = list(events_by_id.values())
+        if checkpoint is not None:
+            _save_htc_log_checkpoint(session, checkpoint)
+        if not inserted:
+            session.commit()
+            return []
+
+        for htc_job_event in inserted:
+            htc_job_event.creation_date = utcnow
+        session.execute(
+            sqlalchemy.insert(dbm.HTCJobEvent),
+            [dbm.HTCJobEvent.obj_to_db_dict(e) for e in inserted],
+        )
+
+        clusters: dict[int, _ClusterBatchEntry] = {}
+        completed_cluster_ids = []
+        for htc_job_event in inserted:
+            if htc_job_event.event_type != "JOB_TERMINATED":
+                continue
+            if htc_job_event.cluster_id not in clusters and _skip_job_termination(
+                htc_job_event
+            ):
+                continue
+            if _on_job_termination(session, clusters, htc_job_event):
+                completed_cluster_ids.append(htc_job_event.cluster_id)
+
+        for entry in clusters.values():
+            if entry.status_updated:
+                entry.db_htc_cluster.set_proc_states(entry.proc_states)
+                entry.db_htc_cluster.cluster_state = entry.cluster_state
+
+        task_state_moves = []
+        for cluster_id in completed_cluster_ids:
+            entry = clusters[cluster_id]
+            new_state = _on_cluster_completion(
+                session,
+                cluster_id,
+                entry.db_htc_cluster.task_id,  # type: ignore
+                entry.cluster_state,  # type: ignore
+            )
+            if new_state is not None:
+                task_state_moves.append((TaskStates.SUBMITTED, new_state))
+
+        session.commit()
+        for old_state, new_state in task_state_moves:
+            task_state_counters.move(old_state, new_state)
+        for cluster_id, entry in clusters.items():
+            if entry.status_updated:
+                cluster_index.set_state(cluster_id, entry.cluster_state)
+
+    print(f"ingested {len(inserted)} job events")
+    return inserted
 
 
 def post_htc_job_event(new_log_entry: models.HTCJobEvent) -> models.HTCJobEvent:
-    with dbm.db_rlock:
-        entry_id = new_log_entry.gen_entry_id()
-        db_htc_job_event: Optional[dbm.HTCJobEvent] = dbm.HTCJobEvent.query.get(
-            entry_id
+    """Ingest a single job event, returns the stored one if it is a duplicate"""
+
+    inserted = post_htc_job_events([new_log_entry])
+    if inserted:
+        return inserted[0]
+
+    with dbm.db.session_scope() as session:
+        db_htc_job_event: dbm.HTCJobEvent = session.get(
+            dbm.HTCJobEvent, new_log_entry.gen_entry_id()
+        )  # type: ignore
+        htc_job_event = db_htc_job_event.dump_obj()
+    # as returned by a first insert (SQLite drops the time zone)
+    if htc_job_event.creation_date is not None:
+        htc_job_event.creation_date = htc_job_event.creation_date.replace(
+            tzinfo=timezone.utc
         )
-        if db_htc_job_event is not None:
-            return db_htc_job_event.dump_obj()
+    return htc_job_event
+
+
+def _encode_htc_job_event_cursor(entry_id: str) -> str:
+    return base64.urlsafe_b64encode(entry_id.encode("utf-8")).decode("ascii")
+
+
+def _decode_htc_job_event_cursor(cursor: str) -> str:
+    """Decode a job event list cursor, raises ValueError if it is invalid"""
+    try:
+        return base64.urlsafe_b64decode(cursor).decode("utf-8")
+    except ValueError as e:
+        raise ValueError("invalid cursor") from e
+
+
+def _htc_job_event_filters(
+    cluster_id: Optional[int] = None, cursor: Optional[str] = None
+) -> list:
+    filters = []
+    if cluster_id is not None:
+        filters.append(dbm.HTCJobEvent.cluster_id == cluster_id)
+    if cursor:
+        filters.append(dbm.HTCJobEvent.id > _decode_htc_job_event_cursor(cursor))
+    return filters
+
+
+def get_htc_job_events_json(
+    cluster_id: Optional[int] = None, cursor: Optional[str] = None, limit: int = 100
+) -> bytes:
+    """Get a page of job events ordered by id as JSON
+
+    Raises ValueError if `cursor` is invalid.
+    """
+
+    with dbm.db.session_scope() as session:
+        utcnow = datetime.now(timezone.utc)
+
+        rows = session.execute(
+            sqlalchemy.select(*dbm.HTCJobEvent.__table__.c)
+            .filter(*_htc_job_event_filters(cluster_id, cursor))
+            .order_by(dbm.HTCJobEvent.id)
+            .limit(limit + 1)
+        ).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_htc_job_event_cursor(rows[-1].id)
+
+        items = [serialization.htc_job_event_row_to_dict(row) for row in rows]
+
+    return serialization.dump_htc_job_event_list_response(utcnow, items, next_cursor)
+
+
+def iter_htc_job_events_ndjson(
+    cluster_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    batch_size: int = 500,
+) -> Iterator[bytes]:
+    """Stream all job events (ordered by id) as NDJSON, see `iter_tasks_ndjson`"""
+
+    stmt = (
+        sqlalchemy.select(*dbm.HTCJobEvent.__table__.c)
+        .filter(*_htc_job_event_filters(cluster_id, cursor))
+        .order_by(dbm.HTCJobEvent.id)
+        .execution_options(yield_per=batch_size)
+    )
+
+    def _iter_chunks() -> Iterator[bytes]:
+        with dbm.db.create_session() as session:
+            for rows in session.execute(stmt).partitions():
+                yield serialization.dump_ndjson(
+                    serialization.HTC_JOB_EVENT_ADAPTER,
+                    (serialization.htc_job_event_row_to_dict(row) for row in rows),
+                )
+
+    return _iter_chunks()
+
+
+def get_htc_cluster_procs_json(
+    cluster_id: int, offset: int = 0, limit: int = 1000
+) -> Optional[bytes]:
+    """A page of the cluster's proc states as a JSON HTCClusterProcListResponse"""
+
+    with dbm.db.session_scope() as session:
+        utcnow = datetime.now(timezone.utc)
+        row = session.execute(
+            sqlalchemy.select(
+                dbm.HTCCluster.id,
+                dbm.HTCCluster.first_proc,
+                dbm.HTCCluster.num_procs,
+                dbm.HTCCluster.cluster_state,
+                dbm.HTCCluster.n_procs_ok,
+                dbm.HTCCluster.n_procs_error,
+                *_proc_states_page_columns(offset, limit),
+            ).where(dbm.HTCCluster.id == cluster_id)
+        ).first()
+    if row is None:
+        return None
+
+    states, exit_codes = row[-2:]
+    proc_states = models.HTCProcStates.from_bytes(
+        (row.first_proc or 0) + offset, states or b"", exit_codes or b""
+    )
+    return serialization.dump_htc_cluster_proc_list_response(
+        utcnow, row, offset, proc_states
+    )
+
+
+def get_htc_cluster_with_task_json(cluster_id: int) -> Optional[bytes]:
+    """The cluster and its task (if any) as a JSON HTCClusterWithTask"""
 
-        new_log_entry.creation_date = datetime.now(timezone.utc)
-        print(new_log_entry)
-        db_htc_job_event = dbm.HTCJobEvent(
-            **dbm.HTCJobEvent.obj_to_db_dict(new_log_entry)
+    with dbm.db.session_scope() as session:
+        cluster_row = session.execute(
+            sqlalchemy.select(*dbm.HTCCluster.__table__.c).where(
+                dbm.HTCCluster.id == cluster_id
+            )
+        ).first()
+        if cluster_row is None:
+            return None
+
+        task_row = None
+        if cluster_row.task_id is not None and cluster_row.task_id != "-":
+            task_row = session.execute(
+                sqlalchemy.select(*_TASK_API_COLUMNS).where(
+                    dbm.Task.id == cluster_row.task_id
+                )
+            ).first()
+
+    return serialization.dump_htc_cluster_with_task(
+        serialization.htc_cluster_row_to_dict(cluster_row),
+        serialization.task_row_to_dict(task_row) if task_row is not None else None,
+    )
+
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Acquire or renew the lease `name` for `ttl` seconds
+
+    Succeeds if the lease is free, expired, or already held by `holder`. The
+    check and the update are a single conditional UPDATE (or INSERT for a new
+    lease), so at most one holder has an unexpired lease at a time. Expiration
+    dates are wall clock times, the holders must have synchronized clocks.
+    """
+
+    with dbm.db.session_scope() as session:
+        utcnow = datetime.now(timezone.utc)
+        expiration_date = utcnow + timedelta(seconds=ttl)
+        result = session.execute(
+            sqlalchemy.update(dbm.Lease)
+            .where(
+                dbm.Lease.name == name,
+                sqlalchemy.or_(
+                    dbm.Lease.holder == holder, dbm.Lease.expiration_date < utcnow
+                ),
+            )
+            .values(
+                holder=holder,
+                expiration_date=expiration_date,
+                acquire_date=sqlalchemy.case(
+                    (dbm.Lease.holder == holder, dbm.Lease.acquire_date),
+                    else_=utcnow,
+                ),
+            )
+            .execution_options(synchronize_session=False)
         )
-        dbm.db.session.add(db_htc_job_event)
-        dbm.db.session.commit()
+        if result.rowcount == 0:  # type: ignore
+            if session.get(dbm.Lease, name) is not None:
+                return False
+            session.add(
+                dbm.Lease(
+                    name=name,
+                    holder=holder,
+                    expiration_date=expiration_date,
+                    acquire_date=utcnow,
+                )
+            )
+        try:
+            session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # another holder created the lease first
+            return False
+        return True
 
-        if new_log_entry.event_type == "JOB_TERMINATED":
-            # update cluster
-            on_job_termination(db_htc_job_event.dump_obj())
 
-        return db_htc_job_event.dump_obj()
+def release_lease(name: str, holder: str) -> None:
+    """Expire the lease `name` now if it is held by `holder`"""
+
+    with dbm.db.session_scope() as session:
+        session.execute(
+            sqlalchemy.update(dbm.Lease)
+            .where(dbm.Lease.name == name, dbm.Lease.holder == holder)
+            .values(expiration_date=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+
+def get_schedd_slot(schedd_name: str) -> int:
+    """Stable slot (> 0) of the named schedd, allocated on first use"""
+
+    with dbm.db.session_scope() as session:
+        for _ in range(2):
+            slot = session.execute(
+                sqlalchemy.select(dbm.HTCSchedd.id).where(
+                    dbm.HTCSchedd.name == schedd_name
+                )
+            ).scalar_one_or_none()
+            if slot is not None:
+                return slot
+            db_schedd = dbm.HTCSchedd(name=schedd_name)
+            session.add(db_schedd)
+            try:
+                session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # allocated concurrently (by another tracker), read it
+                session.rollback()
+                continue
+            return db_schedd.id  # type: ignore
+    raise RuntimeError(f"can't allocate a slot for schedd {schedd_name}")
+
+
+def get_last_cluster_id(schedd_slot: int) -> int:
+    """Largest ClusterId of the clusters of the schedd `schedd_slot`, 0 if none"""
+
+    with dbm.db.session_scope() as session:
+        cluster_id = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.max(dbm.HTCCluster.id)).where(
+                dbm.HTCCluster.id >= models.make_cluster_id(schedd_slot, 0),
+                dbm.HTCCluster.id < models.make_cluster_id(schedd_slot + 1, 0),
+            )
+        )
+    if cluster_id is None:
+        return 0
+    return models.split_cluster_id(cluster_id)[1]
+
+
+def get_unstored_task_results() -> list[models.TaskResult]:
+    """The cached results whose result dir is not copied yet"""
+
+    with dbm.db.session_scope() as session:
+        return [
+            db_task_result.dump_obj()
+            for db_task_result in session.scalars(
+                sqlalchemy.select(dbm.TaskResult).where(dbm.TaskResult.size.is_(None))
+            )
+        ]
+
+
+def set_task_result_size(task_result: models.TaskResult, size: int) -> bool:
+    """Record the size of the stored copy of the result, False if the cached
+    result was replaced or evicted meanwhile"""
+
+    with dbm.db.session_scope() as session:
+        result = session.execute(
+            sqlalchemy.update(dbm.TaskResult)
+            .where(
+                dbm.TaskResult.key == task_result.key,
+                dbm.TaskResult.task_id == task_result.task_id,
+            )
+            .values(size=size)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount == 1  # type: ignore
+
+
+def get_stored_task_results() -> list[models.TaskResult]:
+    """The cached results with a stored copy, most recently used first"""
+
+    with dbm.db.session_scope() as session:
+        return [
+            db_task_result.dump_obj()
+            for db_task_result in session.scalars(
+                sqlalchemy.select(dbm.TaskResult)
+                .where(dbm.TaskResult.size.is_not(None))
+                .order_by(dbm.TaskResult.last_used_date.desc())
+            )
+        ]
+
+
+def delete_task_results(
+    task_results: list[models.TaskResult],
+) -> list[models.TaskResult]:
+    """Evict cached results, unless used or replaced (by a newer result)
+    meanwhile; returns the evicted ones"""
+
+    evicted = []
+    with dbm.db.session_scope() as session:
+        for task_result in task_results:
+            result = session.execute(
+                sqlalchemy.delete(dbm.TaskResult)
+                .where(
+                    dbm.TaskResult.key == task_result.key,
+                    dbm.TaskResult.task_id == task_result.task_id,
+                    dbm.TaskResult.last_used_date == task_result.last_used_date,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:  # type: ignore
+                evicted.append(task_result)
+        session.commit()
+    return evicted
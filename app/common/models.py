@@ -2,10 +2,13 @@
 
 # pylint: disable=too-few-public-methods
 
+import array
 import json
 import dataclasses
 from datetime import datetime
+import sys
 from typing import Optional
+import zlib
 
 
 from marshmallow import Schema, fields, validate, post_load
@@ -49,6 +52,33 @@ def camelcase(key: str) -> str:
     return next(parts) + "".join(i.title() for i in parts)
 
 
+# HTCondor cluster ids are only unique per schedd: the clusters of the schedd
+# with the slot s > 0 are stored with the id `s << SCHEDD_SLOT_SHIFT | ClusterId`
+# (the local schedd has the slot 0, so its clusters keep their ClusterId)
+SCHEDD_SLOT_SHIFT = 32
+
+
+def make_cluster_id(schedd_slot: int, htc_cluster_id: int) -> int:
+    """Cluster id (unique across the schedds) of a schedd's ClusterId"""
+    return (schedd_slot << SCHEDD_SLOT_SHIFT) | htc_cluster_id
+
+
+def split_cluster_id(cluster_id: int) -> tuple[int, int]:
+    """The schedd slot and the schedd's ClusterId of a cluster id"""
+    return (
+        cluster_id >> SCHEDD_SLOT_SHIFT,
+        cluster_id & ((1 << SCHEDD_SLOT_SHIFT) - 1),
+    )
+
+
+def get_task_shard(task_id: str) -> int:
+    """Stable hash of the task id (the same in every process)
+
+    A task belongs to the tracker partition `shard % num_partitions`.
+    """
+    return zlib.crc32(task_id.encode("utf-8"))
+
+
 class OrderedCamelCaseSchema(Schema):
     """Schema that uses camel-case for its external representation
     and snake-case for its internal representation.
@@ -86,6 +116,14 @@ class TaskStates:
     IGNORED = -1
 
 
+class TaskBackends:
+    """Execution backends of the tasks (Task.backend, None is HTCondor)"""
+
+    HTCONDOR = "htcondor"
+    # local processes of the tracker (see bg.local_backend), for short tasks
+    LOCAL = "local"
+
+
 class SubmissionSchema(OrderedCamelCaseSchema):
     """Submission schema definition."""
 
@@ -149,6 +187,20 @@ class Task:
     cluster_id: Optional[int] = None
     proc_id: Optional[int] = None
     expiration_date: Optional[datetime] = None
+    num_items: Optional[int] = None
+    item_data: Optional[list[dict]] = None
+    backend: Optional[str] = None
+    bundleable: Optional[bool] = None
+    # result reuse (see result_cache): the request and the declared input
+    # files (not stored), the result key, and the task whose result was reused
+    reuse_result: Optional[bool] = None
+    input_files: Optional[list[str]] = None
+    result_key: Optional[str] = None
+    result_task_id: Optional[str] = None
+    # queued-task scan order: the tasks of an owner by decreasing priority,
+    # the owners by weighted fair share (see bg.fair_share)
+    priority: Optional[int] = None
+    owner: Optional[str] = None
 
 
 class TaskSchema(OrderedCamelCaseSchema):
@@ -164,6 +216,12 @@ class TaskSchema(OrderedCamelCaseSchema):
     proc_id = fields.Integer(allow_none=True)
     expiration_date = fields.DateTime(allow_none=True)
     latest_sub_id = fields.String()
+    num_items = fields.Integer(allow_none=True)
+    backend = fields.String(allow_none=True)
+    bundleable = fields.Boolean(allow_none=True)
+    result_task_id = fields.String(allow_none=True)
+    priority = fields.Integer(allow_none=True)
+    owner = fields.String(allow_none=True)
 
     @post_load
     def convert_sub_params(self, data, **_kwargs):
@@ -180,13 +238,47 @@ class TaskCreateSchema(OrderedCamelCaseSchema):
     state = fields.Integer(load_default=TaskStates.QUEUED)
     sub_params = fields.Dict(fields.String(), fields.String())
     retries_left = fields.Integer(load_default=2)
+    count = fields.Integer(allow_none=True, validate=validate.Range(min=1))
+    item_data = fields.List(
+        fields.Dict(fields.String(), fields.String()), allow_none=True
+    )
+    backend = fields.String(
+        allow_none=True,
+        validate=validate.OneOf([TaskBackends.HTCONDOR, TaskBackends.LOCAL]),
+    )
+    bundleable = fields.Boolean(allow_none=True)
+    reuse_result = fields.Boolean(allow_none=True)
+    input_files = fields.List(fields.String(), allow_none=True)
+    priority = fields.Integer(allow_none=True)
+    owner = fields.String(allow_none=True, validate=validate.Length(max=64))
 
     @post_load
     def make_dataclass_object(self, data, **_kwargs):
-        """Convert dict to a Task python object"""
+        """Convert dict to a Task python object
+
+        An array task (`count` procs, or one proc per `item_data` item) is
+        submitted as a single HTCondor cluster.
+        """
+        count = data.pop("count", None)
+        if data.get("item_data"):
+            data["num_items"] = len(data["item_data"])
+        else:
+            data.pop("item_data", None)
+            data["num_items"] = count
         return Task(**data)
 
 
+@dataclasses.dataclass
+class TaskItem:
+    """Status of one item (proc) of an array task"""
+
+    index: int
+    proc_id: Optional[int] = None
+    state: int = -1
+    exit_code: Optional[int] = None
+    item_data: Optional[dict] = None
+
+
 @dataclasses.dataclass
 class TaskUpdateRequest:
     """Task update request"""
@@ -229,6 +321,7 @@ class TaskListResponse:
 
     response_date: datetime
     items: list[Task]
+    next_cursor: Optional[str] = None
 
 
 class TaskListResponseSchema(OrderedCamelCaseSchema):
@@ -237,6 +330,7 @@ class TaskListResponseSchema(OrderedCamelCaseSchema):
     kind = ConstField("hpctask-list")
     response_date = fields.DateTime()
     items = fields.List(fields.Nested(TaskSchema), required=True)
+    next_cursor = fields.String(allow_none=True)
 
     @post_load
     def make_dataclass_object(self, data, **_kwargs):
@@ -244,6 +338,23 @@ class TaskListResponseSchema(OrderedCamelCaseSchema):
         return TaskListResponse(**data)
 
 
+@dataclasses.dataclass
+class TaskListQuery:
+    """Task list filters and the (creation_date, id) keyset page position
+
+    Date bounds are inclusive for `*_after` and exclusive for `*_before`.
+    """
+
+    states: Optional[list[int]] = None
+    cluster_id: Optional[int] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    state_date_after: Optional[datetime] = None
+    state_date_before: Optional[datetime] = None
+    cursor: Optional[str] = None
+    limit: int = 100
+
+
 class HTCClusterStates:
     """HTCClusterStates"""
 
@@ -261,6 +372,161 @@ class HTCClusterStatus:
     procs: Optional[list[dict]] = None
 
 
+class HTCProcStates:
+    """Compact per-proc states of an HTC cluster
+
+    One signed byte per proc for the state and one little-endian int32 for
+    the exit code (PROC_EXIT_CODE_NONE if there is none), indexed by
+    `proc_id - first_proc`, plus the numbers of procs completed ok and with
+    error. Updating a proc is O(1).
+    """
+
+    PROC_STATE_NONE = -1
+    PROC_EXIT_CODE_NONE = -(2**31)
+    EXIT_CODE_SIZE = 4
+
+    first_proc: int
+    states: array.array
+    exit_codes: array.array
+    n_ok: int
+    n_error: int
+
+    def __init__(
+        self,
+        first_proc: int,
+        states: array.array,
+        exit_codes: array.array,
+        n_ok: int = 0,
+        n_error: int = 0,
+    ) -> None:
+        self.first_proc = first_proc
+        self.states = states
+        self.exit_codes = exit_codes
+        self.n_ok = n_ok
+        self.n_error = n_error
+
+    @classmethod
+    def new(cls, first_proc: int, num_procs: int) -> "HTCProcStates":
+        """All procs without state"""
+        return cls(
+            first_proc,
+            array.array("b", [cls.PROC_STATE_NONE]) * num_procs,
+            array.array("i", [cls.PROC_EXIT_CODE_NONE]) * num_procs,
+        )
+
+    @classmethod
+    def from_procs(
+        cls, first_proc: int, num_procs: int, procs: Optional[list[dict]]
+    ) -> "HTCProcStates":
+        """From a list of `{"index", "state", "exit_code"}` dicts"""
+        proc_states = cls.new(first_proc, num_procs)
+        for proc in procs or []:
+            proc_states.set_proc(
+                proc["index"], proc.get("state", -1), proc.get("exit_code")
+            )
+        return proc_states
+
+    @classmethod
+    def decode_states(cls, data: bytes) -> array.array:
+        """Proc states from their DB bytes"""
+        states = array.array("b")
+        states.frombytes(data)
+        return states
+
+    @classmethod
+    def decode_exit_codes(cls, data: bytes) -> array.array:
+        """Proc exit codes from their DB bytes"""
+        exit_codes = array.array("i")
+        exit_codes.frombytes(data)
+        if sys.byteorder == "big":
+            exit_codes.byteswap()
+        return exit_codes
+
+    @classmethod
+    def from_bytes(
+        cls,
+        first_proc: int,
+        states: bytes,
+        exit_codes: bytes,
+        n_ok: int = 0,
+        n_error: int = 0,
+    ) -> "HTCProcStates":
+        """From the DB columns"""
+        return cls(
+            first_proc,
+            cls.decode_states(states),
+            cls.decode_exit_codes(exit_codes),
+            n_ok,
+            n_error,
+        )
+
+    def states_bytes(self) -> bytes:
+        """Proc states as DB bytes"""
+        return self.states.tobytes()
+
+    def exit_codes_bytes(self) -> bytes:
+        """Proc exit codes as DB bytes"""
+        if sys.byteorder == "big":
+            exit_codes = array.array("i", self.exit_codes)
+            exit_codes.byteswap()
+            return exit_codes.tobytes()
+        return self.exit_codes.tobytes()
+
+    @property
+    def num_procs(self) -> int:
+        """Number of procs"""
+        return len(self.states)
+
+    @property
+    def n_completed(self) -> int:
+        """Number of procs completed (ok or with error)"""
+        return self.n_ok + self.n_error
+
+    def _count(self, state: int, n: int) -> None:
+        if state == HTCClusterStates.COMPLETED_OK:
+            self.n_ok += n
+        elif state == HTCClusterStates.COMPLETED_ERROR:
+            self.n_error += n
+
+    def set_proc(self, proc_id: int, state: int, exit_code: Optional[int]) -> bool:
+        """Set the state of a proc, returns False if it is out of range or
+        already in that state"""
+        index = proc_id - self.first_proc
+        if index < 0 or index >= len(self.states):
+            return False
+        old_state = self.states[index]
+        if old_state == state:
+            return False
+        self._count(old_state, -1)
+        self._count(state, 1)
+        self.states[index] = state
+        self.exit_codes[index] = (
+            self.PROC_EXIT_CODE_NONE if exit_code is None else exit_code
+        )
+        return True
+
+    @classmethod
+    def proc_to_dict(cls, proc_id: int, state: int, exit_code: int) -> dict:
+        """Proc state in the `{"index", "state", "exit_code"}` form"""
+        return {
+            "index": proc_id,
+            "state": state,
+            "exit_code": None if exit_code == cls.PROC_EXIT_CODE_NONE else exit_code,
+        }
+
+    def to_procs(self, offset: int = 0, limit: Optional[int] = None) -> list[dict]:
+        """Proc states (from `offset`, at most `limit`) as dicts"""
+        end = len(self.states) if limit is None else offset + limit
+        return [
+            self.proc_to_dict(self.first_proc + index, state, exit_code)
+            for index, state, exit_code in zip(
+                range(offset, end),
+                self.states[offset:end],
+                self.exit_codes[offset:end],
+            )
+        ]
+
+
 class HTCClusterStatusPartial(OrderedCamelCaseSchema):
     """HTCClusterStatuc partial schema"""
 
@@ -285,6 +551,7 @@ class HTCCluster:
     first_proc: Optional[int] = None
     num_procs: Optional[int] = None
     status: Optional[HTCClusterStatus] = None
+    schedd_name: Optional[str] = None
 
     def __post_init__(self):
         if isinstance(self.status, dict):
@@ -302,6 +569,7 @@ class HTCClusterSchema(OrderedCamelCaseSchema):
     first_proc = fields.Integer()
     num_procs = fields.Integer()
     status = fields.Nested(HTCClusterStatusPartial)
+    schedd_name = fields.String(allow_none=True)
 
     @post_load
     def make_dataclass_object(self, data, **_kwargs):
@@ -319,6 +587,7 @@ class HTCClusterCreateSchema(OrderedCamelCaseSchema):
     first_proc = fields.Integer(load_default=0)
     num_procs = fields.Integer()
     status = fields.Nested(HTCClusterStatusPartial)
+    schedd_name = fields.String(allow_none=True)
 
     @post_load
     def make_dataclass_object(self, data, **_kwargs):
@@ -396,6 +665,30 @@ class HTCJobEventPostSchema(OrderedCamelCaseSchema):
         return HTCJobEvent(**data)
 
 
+@dataclasses.dataclass
+class HTCLogCheckpoint:
+    """Read position of the tracker in an HTCondor job event log"""
+
+    log_filename: str
+    offset: int = 0
+    file_id: Optional[str] = None
+    fingerprint: Optional[str] = None
+    last_event_id: Optional[str] = None
+    update_date: Optional[datetime] = None
+
+
+@dataclasses.dataclass
+class TaskResult:
+    """Cached result of a completed task, reused by the identical tasks"""
+
+    key: str
+    task_id: str
+    completion_date: Optional[datetime] = None
+    last_used_date: Optional[datetime] = None
+    # bytes of the stored copy of the result dir, None until it is stored
+    size: Optional[int] = None
+
+
 @dataclasses.dataclass
 class LogEntryCreate:
     """LogEntryCreate"""
@@ -0,0 +1,93 @@
+"""
+Task result reuse
+
+A task created with `reuse_result` gets a result key: the digest of its
+normalized submit params, array items and declared input files (content
+digests). A new task with the key of a task that completed successfully less
+than RESULT_REUSE_TTL ago is completed at creation instead of being run (see
+db_ops.create_task), and its task dir links to the cached copy of that task's
+result dir, `<task root>/_results/<key>`.
+
+The copies are made, and evicted (least recently used first) when over the
+disk budget, by the ResultCacheTracker.
+"""
+
+from datetime import timedelta
+import hashlib
+import json
+import os
+from typing import Optional
+
+from .models import Task
+
+
+# how long a completed task's result is reused
+RESULT_REUSE_TTL = timedelta(days=1)
+
+TASK_ROOT_DIR = "./taskroot"
+RESULTS_DIR_NAME = "_results"
+
+
+def get_file_digest(filename: str) -> str:
+    """SHA-256 of the file content"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_result_key(task: Task) -> Optional[str]:
+    """Result key of the task, None if an input file can't be read
+
+    The submit params are normalized as HTCondor reads them (case-insensitive
+    names, surrounding whitespace ignored).
+    """
+    try:
+        input_digests = {
+            os.path.abspath(filename): get_file_digest(filename)
+            for filename in task.input_files or []
+        }
+    except OSError as e:
+        print(f"task {task.id}: result not reusable, {e}")
+        return None
+    identity = {
+        "subParams": {
+            key.strip().lower(): str(value).strip()
+            for key, value in (task.sub_params or {}).items()
+        },
+        "numItems": task.num_items or 1,
+        "itemData": task.item_data,
+        "inputFiles": input_digests,
+    }
+    data = json.dumps(identity, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get_results_dir(task_root_dir: str = TASK_ROOT_DIR) -> str:
+    """Dir of the cached result copies"""
+    return os.path.join(task_root_dir, RESULTS_DIR_NAME)
+
+
+def has_task_root_result(task: Task) -> bool:
+    """True if the results of the task are in its dir under the task root
+    (its initialdir is not set by the client)"""
+    return "initialdir" not in (task.sub_params or {})
+
+
+def link_cached_result(
+    task_id: str, result_key: str, task_root_dir: str = TASK_ROOT_DIR
+) -> None:
+    """Make the task dir a link to the cached result of `result_key`
+
+    The cached copy may not be stored yet (the link then dangles until it is).
+    """
+    try:
+        os.makedirs(task_root_dir, exist_ok=True)
+        os.symlink(
+            os.path.join(RESULTS_DIR_NAME, result_key),
+            os.path.join(task_root_dir, task_id),
+            target_is_directory=True,
+        )
+    except OSError as e:
+        print(f"task {task_id}: can't link the cached result: {e}")
@@ -0,0 +1,357 @@
+"""Direct DB row to JSON serialization
+
+The API responses are built from the DB rows (ORM entities or Core rows with
+the same column names) as plain camel-case dicts, and encoded by pydantic-core
+using TypeAdapters that are compiled once at import time. This skips the
+marshmallow load/dump round trip and the response_model validation.
+
+The TypedDicts mirror the Pydantic response models in `app.api.schemas`.
+"""
+
+# pylint: disable=missing-class-docstring
+
+from datetime import datetime
+import json
+from typing import Any, Iterable, Literal, Optional
+
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict
+
+from . import models
+
+
+class TaskDict(TypedDict):
+    id: str
+    creationDate: Optional[datetime]
+    subParams: Optional[dict[str, str]]
+    state: Optional[int]
+    stateDate: Optional[datetime]
+    retriesLeft: Optional[int]
+    clusterId: Optional[int]
+    procId: Optional[int]
+    expirationDate: Optional[datetime]
+    latestSubId: Optional[str]
+    numItems: Optional[int]
+    backend: Optional[str]
+    bundleable: Optional[bool]
+    resultTaskId: Optional[str]
+    priority: Optional[int]
+    owner: Optional[str]
+
+
+class TaskItemDict(TypedDict):
+    index: int
+    procId: Optional[int]
+    state: int
+    exitCode: Optional[int]
+    itemData: Optional[dict[str, str]]
+
+
+class TaskListResponseDict(TypedDict):
+    kind: Literal["hpctask-list"]
+    responseDate: datetime
+    items: list[TaskDict]
+    nextCursor: Optional[str]
+
+
+class HTCClusterDict(TypedDict):
+    id: int
+    creationDate: Optional[datetime]
+    taskId: Optional[str]
+    subParams: Optional[dict[str, Any]]
+    clusterAd: Optional[dict[str, Any]]
+    firstProc: Optional[int]
+    numProcs: Optional[int]
+    status: Optional[dict[str, Any]]
+    scheddName: Optional[str]
+
+
+class HTCProcDict(TypedDict):
+    index: int
+    state: int
+    exitCode: Optional[int]
+
+
+class HTCClusterProcListResponseDict(TypedDict):
+    kind: Literal["htc-cluster-proc-list"]
+    responseDate: datetime
+    clusterId: int
+    clusterState: Optional[int]
+    firstProc: int
+    numProcs: int
+    nProcsOk: int
+    nProcsError: int
+    offset: int
+    items: list[HTCProcDict]
+
+
+class HTCClusterWithTaskDict(TypedDict):
+    kind: Literal["htc-cluster-with-task"]
+    cluster: HTCClusterDict
+    task: Optional[TaskDict]
+    extra: dict[str, Any]
+
+
+class HTCJobEventDict(TypedDict):
+    id: str
+    creationDate: Optional[datetime]
+    clusterId: int
+    procId: int
+    timestamp: float
+    eventType: str
+    details: dict[str, Any]
+
+
+class HTCJobEventListResponseDict(TypedDict):
+    kind: Literal["htc-job-event-list"]
+    responseDate: datetime
+    items: list[HTCJobEventDict]
+    nextCursor: Optional[str]
+
+
+TASK_ADAPTER = TypeAdapter(TaskDict)
+TASK_ITEM_ADAPTER = TypeAdapter(TaskItemDict)
+TASK_LIST_RESPONSE_ADAPTER = TypeAdapter(TaskListResponseDict)
+HTC_CLUSTER_ADAPTER = TypeAdapter(HTCClusterDict)
+HTC_CLUSTER_WITH_TASK_ADAPTER = TypeAdapter(HTCClusterWithTaskDict)
+HTC_CLUSTER_PROC_LIST_RESPONSE_ADAPTER = TypeAdapter(HTCClusterProcListResponseDict)
+HTC_JOB_EVENT_ADAPTER = TypeAdapter(HTCJobEventDict)
+HTC_JOB_EVENT_LIST_RESPONSE_ADAPTER = TypeAdapter(HTCJobEventListResponseDict)
+SERVER_STATUS_ADAPTER = TypeAdapter(models.ServerStatus)
+
+
+def _json_or_none(db_json: Optional[str]) -> Optional[dict]:
+    if db_json:
+        return json.loads(db_json)
+    return None
+
+
+def task_row_to_dict(row: Any) -> TaskDict:
+    """Task DB row (or entity) as the API dict"""
+    return {
+        "id": row.id,
+        "creationDate": row.creation_date,
+        "subParams": _json_or_none(row.sub_params_json),
+        "state": row.state,
+        "stateDate": row.state_date,
+        "retriesLeft": row.retries_left,
+        "clusterId": row.cluster_id,
+        "procId": row.proc_id,
+        "expirationDate": row.expiration_date,
+        "latestSubId": None,
+        "numItems": row.num_items,
+        "backend": row.backend,
+        "bundleable": row.bundleable,
+        "resultTaskId": row.result_task_id,
+        "priority": row.priority,
+        "owner": row.owner,
+    }
+
+
+def task_obj_to_dict(task: models.Task) -> TaskDict:
+    """Task python object as the API dict"""
+    return {
+        "id": task.id,  # type: ignore
+        "creationDate": task.creation_date,
+        "subParams": task.sub_params,
+        "state": task.state,
+        "stateDate": task.state_date,
+        "retriesLeft": task.retries_left,
+        "clusterId": task.cluster_id,
+        "procId": task.proc_id,
+        "expirationDate": task.expiration_date,
+        "latestSubId": None,
+        "numItems": task.num_items,
+        "backend": task.backend,
+        "bundleable": task.bundleable,
+        "resultTaskId": task.result_task_id,
+        "priority": task.priority,
+        "owner": task.owner,
+    }
+
+
+def task_item_obj_to_dict(task_item: models.TaskItem) -> TaskItemDict:
+    """TaskItem python object as the API dict"""
+    return {
+        "index": task_item.index,
+        "procId": task_item.proc_id,
+        "state": task_item.state,
+        "exitCode": task_item.exit_code,
+        "itemData": task_item.item_data,
+    }
+
+
+def _htc_cluster_row_status(row: Any) -> Optional[dict[str, Any]]:
+    if row.proc_states is None:
+        return None
+    proc_states = models.HTCProcStates.from_bytes(
+        row.first_proc or 0, row.proc_states, row.proc_exit_codes or b""
+    )
+    return {"clusterState": row.cluster_state, "procs": proc_states.to_procs()}
+
+
+def htc_cluster_row_to_dict(row: Any) -> HTCClusterDict:
+    """HTCCluster DB row (or entity) as the API dict"""
+    return {
+        "id": row.id,
+        "creationDate": row.creation_date,
+        "taskId": row.task_id,
+        "subParams": _json_or_none(row.sub_params_json),
+        "clusterAd": _json_or_none(row.cluster_ad_json),
+        "firstProc": row.first_proc,
+        "numProcs": row.num_procs,
+        "status": _htc_cluster_row_status(row),
+        "scheddName": row.schedd_name,
+    }
+
+
+def htc_cluster_obj_to_dict(htc_cluster: models.HTCCluster) -> HTCClusterDict:
+    """HTCCluster python object as the API dict"""
+    status = None
+    if htc_cluster.status is not None:
+        status = {
+            "clusterState": htc_cluster.status.cluster_state,
+            "procs": htc_cluster.status.procs,
+        }
+    return {
+        "id": htc_cluster.id,  # type: ignore
+        "creationDate": htc_cluster.creation_date,
+        "taskId": htc_cluster.task_id,
+        "subParams": htc_cluster.sub_params,
+        "clusterAd": htc_cluster.cluster_ad,
+        "firstProc": htc_cluster.first_proc,
+        "numProcs": htc_cluster.num_procs,
+        "status": status,
+        "scheddName": htc_cluster.schedd_name,
+    }
+
+
+def htc_job_event_row_to_dict(row: Any) -> HTCJobEventDict:
+    """HTCJobEvent DB row (or entity) as the API dict"""
+    return {
+        "id": row.id,
+        "creationDate": row.creation_date,
+        "clusterId": row.cluster_id,
+        "procId": row.proc_id,
+        "timestamp": row.timestamp,
+        "eventType": row.event_type,
+        # empty details are stored as NULL (see db_models.dict_to_db_json)
+        "details": _json_or_none(row.details_json) or {},
+    }
+
+
+def htc_job_event_obj_to_dict(htc_job_event: models.HTCJobEvent) -> HTCJobEventDict:
+    """HTCJobEvent python object as the API dict"""
+    return {
+        "id": htc_job_event.id,  # type: ignore
+        "creationDate": htc_job_event.creation_date,
+        "clusterId": htc_job_event.cluster_id,
+        "procId": htc_job_event.proc_id,
+        "timestamp": htc_job_event.timestamp,
+        "eventType": htc_job_event.event_type,
+        "details": htc_job_event.details,
+    }
+
+
+def dump_task(task: TaskDict) -> bytes:
+    """Encode a task as JSON"""
+    return TASK_ADAPTER.dump_json(task)
+
+
+def dump_task_item(task_item: TaskItemDict) -> bytes:
+    """Encode an array task item as JSON"""
+    return TASK_ITEM_ADAPTER.dump_json(task_item)
+
+
+def dump_task_list_response(
+    response_date: datetime, items: list[TaskDict], next_cursor: Optional[str] = None
+) -> bytes:
+    """Encode a TaskListResponse as JSON"""
+    return TASK_LIST_RESPONSE_ADAPTER.dump_json(
+        {
+            "kind": "hpctask-list",
+            "responseDate": response_date,
+            "items": items,
+            "nextCursor": next_cursor,
+        }
+    )
+
+
+def dump_htc_cluster(htc_cluster: HTCClusterDict) -> bytes:
+    """Encode an HTC cluster as JSON"""
+    return HTC_CLUSTER_ADAPTER.dump_json(htc_cluster)
+
+
+def dump_htc_cluster_with_task(
+    htc_cluster: HTCClusterDict, task: Optional[TaskDict]
+) -> bytes:
+    """Encode an HTCClusterWithTask as JSON"""
+    return HTC_CLUSTER_WITH_TASK_ADAPTER.dump_json(
+        {
+            "kind": "htc-cluster-with-task",
+            "cluster": htc_cluster,
+            "task": task,
+            "extra": {},
+        }
+    )
+
+
+def dump_htc_cluster_proc_list_response(
+    response_date: datetime,
+    row: Any,
+    offset: int,
+    proc_states: models.HTCProcStates,
+) -> bytes:
+    """Encode a page of the cluster procs as an HTCClusterProcListResponse
+
+    `row` has the cluster columns, `proc_states` the procs of the page.
+    """
+    items: list[HTCProcDict] = [
+        {"index": proc["index"], "state": proc["state"], "exitCode": proc["exit_code"]}
+        for proc in proc_states.to_procs()
+    ]
+    return HTC_CLUSTER_PROC_LIST_RESPONSE_ADAPTER.dump_json(
+        {
+            "kind": "htc-cluster-proc-list",
+            "responseDate": response_date,
+            "clusterId": row.id,
+            "clusterState": row.cluster_state,
+            "firstProc": row.first_proc or 0,
+            "numProcs": row.num_procs or 0,
+            "nProcsOk": row.n_procs_ok or 0,
+            "nProcsError": row.n_procs_error or 0,
+            "offset": offset,
+            "items": items,
+        }
+    )
+
+
+def dump_htc_job_event(htc_job_event: HTCJobEventDict) -> bytes:
+    """Encode an HTC job event as JSON"""
+    return HTC_JOB_EVENT_ADAPTER.dump_json(htc_job_event)
+
+
+def dump_htc_job_event_list_response(
+    response_date: datetime,
+    items: list[HTCJobEventDict],
+    next_cursor: Optional[str] = None,
+) -> bytes:
+    """Encode an HTCJobEventListResponse as JSON"""
+    return HTC_JOB_EVENT_LIST_RESPONSE_ADAPTER.dump_json(
+        {
+            "kind": "htc-job-event-list",
+            "responseDate": response_date,
+            "items": items,
+            "nextCursor": next_cursor,
+        }
+    )
+
+
+def dump_server_status(status: models.ServerStatus) -> bytes:
+    """Encode the server status as JSON"""
+    return SERVER_STATUS_ADAPTER.dump_json(status)
+
+
+def dump_ndjson(adapter: TypeAdapter, items: Iterable[Any]) -> bytes:
+    """Encode items as newline-delimited JSON"""
+    return b"".join(adapter.dump_json(item) + b"\n" for item in items)
@@ -0,0 +1,53 @@
+"""In-process signals
+
+Lets the DB operations wake up the background threads (which wait on a
+threading.Event) as soon as there is work for them, instead of waiting for
+their next polling interval. A signal can also touch a wake file, to wake up
+the threads of other processes watching it (see TrackerLeader).
+"""
+
+import threading
+import time
+from typing import Optional
+
+
+class Signal:
+    """Sets every connected threading.Event when sent
+
+    Several sends before the receiver wakes up coalesce into a single wakeup.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._events: list[threading.Event] = []
+        self._wake_filename: Optional[str] = None
+
+    def connect(self, event: threading.Event) -> None:
+        """Set `event` on every send"""
+        with self._lock:
+            if event not in self._events:
+                self._events.append(event)
+
+    def disconnect(self, event: threading.Event) -> None:
+        """Stop setting `event`"""
+        with self._lock:
+            if event in self._events:
+                self._events.remove(event)
+
+    def set_wake_file(self, filename: Optional[str]) -> None:
+        """Also write `filename` on every send (None to stop)"""
+        self._wake_filename = filename
+
+    def send(self) -> None:
+        """Set the connected events (and write the wake file)"""
+        with self._lock:
+            events = list(self._events)
+        for event in events:
+            event.set()
+        wake_filename = self._wake_filename
+        if wake_filename is not None:
+            try:
+                with open(wake_filename, "w", encoding="utf-8") as f:
+                    f.write(f"{time.time()}\n")
+            except OSError:
+                pass
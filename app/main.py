@@ -1,25 +1,138 @@
 """simple-task-api-htc.main"""
 
+import argparse
 import asyncio
 from contextlib import asynccontextmanager
+import functools
 import json
 import logging
+import multiprocessing
 import os
-from typing import cast
+import signal
+import sys
+from typing import Optional, cast
 
 from fastapi import FastAPI
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+from hypercorn.run import run as hypercorn_run
 from hypercorn.typing import Framework
 
 from .api import router as api_router
 from .api.schemas import OPENAPI_TAGS
 from .bg.htc_tracker import HTCTracker
+from .bg.local_backend import LocalBackend
+from .bg.result_cache_tracker import ResultCacheTracker
+from .bg.schedd_pool import LOCAL_SCHEDD_NAME
 from .bg.task_expiration_tracker import TaskExpirationTracker
+from .bg.tracker_leader import (
+    TASK_EXP_TRACKER_LEASE_NAME,
+    TrackerLeader,
+    get_db_wake_filename,
+    get_htc_tracker_lease_name,
+)
 from .common import db_models
+from .common.db_executor import db_executor
+from .common.db_ops import expiration_dates_changed, task_state_counters, tasks_queued
 from .version import __version__
 
 
+# how long the task state counters of an API process are used before reloading
+# them, unless it runs the TaskExpirationTracker (the transitions are made by
+# the tracker processes)
+SERVE_COUNTERS_MAX_AGE = 2.0
+
+
+def create_htc_tracker(
+    partition: int = 0,
+    num_partitions: int = 1,
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+) -> HTCTracker:
+    """New (not started) HTCTracker of `partition`, with its own user log(s)
+
+    The tasks opted in to the local backend run on `local_workers` processes
+    at a time (default: the number of CPUs, 0 disables the local backend).
+    The HTCondor submissions are throttled when the schedds have idle jobs,
+    and stopped at `max_idle_jobs` (default: not throttled).
+    """
+
+    backends = []
+    if local_workers != 0:
+        backends.append(LocalBackend.create(partition, max_workers=local_workers))
+    htc_tracker = HTCTracker()
+    htc_tracker.init_app(
+        log_filename=f"{os.getcwd()}/htc-log/{partition}.log",
+        schedd_names=schedd_names,
+        partition=partition,
+        num_partitions=num_partitions,
+        backends=backends,
+        max_idle_jobs=max_idle_jobs,
+    )
+    return htc_tracker
+
+
+def create_task_exp_tracker() -> TaskExpirationTracker:
+    """New (not started) TaskExpirationTracker"""
+
+    task_exp_tracker = TaskExpirationTracker()
+    task_exp_tracker.logger.addHandler(logging.StreamHandler())
+    task_exp_tracker.logger.setLevel(logging.DEBUG)
+    return task_exp_tracker
+
+
+def create_result_cache_tracker() -> ResultCacheTracker:
+    """New (not started) ResultCacheTracker"""
+
+    result_cache_tracker = ResultCacheTracker()
+    result_cache_tracker.logger.addHandler(logging.StreamHandler())
+    result_cache_tracker.logger.setLevel(logging.INFO)
+    return result_cache_tracker
+
+
+def create_tracker_leaders(
+    partitions: list[int],
+    num_partitions: int = 1,
+    wake_on_db_writes: bool = False,
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+) -> list[TrackerLeader]:
+    """TrackerLeaders running the TaskExpirationTracker (and the
+    ResultCacheTracker) and the HTCTrackers of `partitions` (each one with its
+    own lease)"""
+
+    tracker_leaders = [
+        TrackerLeader(
+            [create_task_exp_tracker, create_result_cache_tracker],
+            TASK_EXP_TRACKER_LEASE_NAME,
+            wake_on_db_writes=wake_on_db_writes,
+        )
+    ]
+    for partition in partitions:
+        tracker_leaders.append(
+            TrackerLeader(
+                [
+                    functools.partial(
+                        create_htc_tracker,
+                        partition,
+                        num_partitions,
+                        schedd_names,
+                        local_workers,
+                        max_idle_jobs,
+                    )
+                ],
+                get_htc_tracker_lease_name(partition),
+                wake_on_db_writes=wake_on_db_writes,
+            )
+        )
+    for tracker_leader in tracker_leaders:
+        tracker_leader.logger.addHandler(logging.StreamHandler())
+        tracker_leader.logger.setLevel(logging.INFO)
+    return tracker_leaders
+
+
 @asynccontextmanager
 async def fastapi_lifespan(app: FastAPI):
     """app lifespan"""
@@ -27,31 +140,60 @@ async def fastapi_lifespan(app: FastAPI):
     print(f"lifespan init {app}")
     # init db
     db_models.db.my_init()
+    db_executor.my_init()
 
-    htc_tracker = HTCTracker()
-    htc_tracker.init_app(log_filename=f"{os.getcwd()}/htc-log/0.log")
-    htc_tracker.start()
-
-    task_exp_tracker = TaskExpirationTracker()
-    task_exp_tracker.logger.addHandler(logging.StreamHandler())
-    task_exp_tracker.logger.setLevel(logging.DEBUG)
-    task_exp_tracker.start()
+    task_state_counters.max_age = SERVE_COUNTERS_MAX_AGE
+    tracker_leaders = []
+    if app.state.with_trackers:
+        tracker_leaders = create_tracker_leaders(
+            [0],
+            schedd_names=app.state.schedd_names,
+            local_workers=app.state.local_workers,
+            max_idle_jobs=app.state.max_idle_jobs,
+        )
+        for tracker_leader in tracker_leaders:
+            tracker_leader.start()
+    else:
+        # wake up the trackers of the tracker processes
+        tasks_queued.set_wake_file(get_db_wake_filename())
+        expiration_dates_changed.set_wake_file(get_db_wake_filename())
 
     yield
 
-    htc_tracker.stop()
-    htc_tracker.join()
+    tasks_queued.set_wake_file(None)
+    expiration_dates_changed.set_wake_file(None)
 
-    task_exp_tracker.stop()
-    task_exp_tracker.join()
+    for tracker_leader in tracker_leaders:
+        tracker_leader.stop()
+    for tracker_leader in tracker_leaders:
+        tracker_leader.join()
 
     # close db
     print(f"lifespan close {app}")
+    db_executor.my_close()
     db_models.db.my_close()
 
 
-def create_app() -> FastAPI:
-    """FastAPI app factory"""
+def create_app(
+    with_trackers: bool = True,
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+    max_queued_tasks: Optional[int] = None,
+    owner_max_queued_tasks: Optional[int] = None,
+) -> FastAPI:
+    """FastAPI app factory
+
+    With `with_trackers`, the app process also runs the background trackers
+    (if it wins the tracker leader election, see TrackerLeader), submitting to
+    `schedd_names` (default: the local schedd) up to `max_idle_jobs` and
+    running the local backend tasks on `local_workers` processes (see
+    create_htc_tracker).
+
+    New tasks are rejected (429) over `max_queued_tasks` queued procs, or
+    over `owner_max_queued_tasks` queued procs of their owner (default: no
+    limit, see db_ops.create_task).
+    """
 
     app = FastAPI(
         title="TaskAPI for HTCondor",
@@ -62,25 +204,52 @@ def create_app() -> FastAPI:
         openapi_tags=OPENAPI_TAGS,
         lifespan=fastapi_lifespan,
     )
+    app.state.with_trackers = with_trackers
+    app.state.schedd_names = schedd_names
+    app.state.local_workers = local_workers
+    app.state.max_idle_jobs = max_idle_jobs
+    app.state.max_queued_tasks = max_queued_tasks
+    app.state.owner_max_queued_tasks = owner_max_queued_tasks
     app.include_router(api_router, prefix="/api")
     return app
 
 
-def get_config() -> Config:
+def get_config(
+    bind: str = "localhost:8080", workers: int = 1, use_reloader: bool = False
+) -> Config:
     """get FastAPI config"""
 
     config = Config()
-    config.bind = ["localhost:8080"]
-    config.use_reloader = True
+    config.bind = [bind]
+    config.workers = workers
+    config.use_reloader = use_reloader
     return config
 
 
-def cli() -> None:
-    """routine called from cli (when installed as a package)"""
+def write_openapi_spec(app: FastAPI) -> None:
+    """Write the OpenAPI spec to ./generated-spec/openapi.json"""
 
-    app = create_app()
     with open("./generated-spec/openapi.json", "w", encoding="utf-8") as f:
         f.write(json.dumps(app.openapi(), indent=2))
+
+
+def run_all(
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+    max_queued_tasks: Optional[int] = None,
+    owner_max_queued_tasks: Optional[int] = None,
+) -> None:
+    """Run the API and the background trackers in a single process"""
+
+    app = create_app(
+        schedd_names=schedd_names,
+        local_workers=local_workers,
+        max_idle_jobs=max_idle_jobs,
+        max_queued_tasks=max_queued_tasks,
+        owner_max_queued_tasks=owner_max_queued_tasks,
+    )
+    write_openapi_spec(app)
     shutdown_event = asyncio.Event()
     asyncio.run(
         serve(
@@ -89,3 +258,216 @@ def cli() -> None:
             shutdown_trigger=shutdown_event.wait,
         )
     )
+
+
+def run_serve(
+    bind: str,
+    workers: int,
+    use_reloader: bool,
+    max_queued_tasks: Optional[int] = None,
+    owner_max_queued_tasks: Optional[int] = None,
+) -> None:
+    """Run `workers` API worker processes without the background trackers"""
+
+    write_openapi_spec(create_app(with_trackers=False))
+    # migrate the DB schema once, before the workers start
+    db_models.db.my_init()
+    db_models.db.my_close()
+
+    config = get_config(bind, workers, use_reloader)
+    config.application_path = (
+        f"{__name__}:create_app(with_trackers=False, "
+        f"max_queued_tasks={max_queued_tasks!r}, "
+        f"owner_max_queued_tasks={owner_max_queued_tasks!r})"
+    )
+    sys.exit(hypercorn_run(config))
+
+
+def run_tracker(
+    partitions: list[int],
+    num_partitions: int,
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+) -> None:
+    """Run the background trackers of `partitions` (once elected leader)
+    without the API"""
+
+    db_models.db.my_init()
+    tracker_leaders = create_tracker_leaders(
+        partitions,
+        num_partitions,
+        wake_on_db_writes=True,
+        schedd_names=schedd_names,
+        local_workers=local_workers,
+        max_idle_jobs=max_idle_jobs,
+    )
+
+    def _stop(*_args) -> None:
+        for tracker_leader in tracker_leaders:
+            tracker_leader.stop()
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    for tracker_leader in tracker_leaders:
+        tracker_leader.start()
+    # join with a timeout, so that the signal handlers run
+    for tracker_leader in tracker_leaders:
+        while tracker_leader.is_alive():
+            tracker_leader.join(timeout=1.0)
+    db_models.db.my_close()
+
+
+def run_partitioned_trackers(
+    num_partitions: int,
+    schedd_names: Optional[list[str]] = None,
+    local_workers: Optional[int] = None,
+    max_idle_jobs: Optional[int] = None,
+) -> None:
+    """Run the tracker partitions in `num_partitions` processes"""
+
+    # migrate the DB schema once, before the processes start
+    db_models.db.my_init()
+    db_models.db.my_close()
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(
+            target=run_tracker,
+            args=(
+                [partition], num_partitions, schedd_names, local_workers, max_idle_jobs
+            ),
+        )
+        for partition in range(1, num_partitions)
+    ]
+    for process in processes:
+        process.start()
+    run_tracker([0], num_partitions, schedd_names, local_workers, max_idle_jobs)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def cli(argv: Optional[list[str]] = None) -> None:
+    """routine called from cli (when installed as a package)"""
+
+    schedd_help = (
+        "submit to this schedd (repeat for a pool of schedds; "
+        f"'{LOCAL_SCHEDD_NAME}' for the local one, the default)"
+    )
+    local_workers_help = (
+        "max number of local backend processes of a tracker "
+        "(default: the number of CPUs, 0 disables the local backend)"
+    )
+    max_idle_jobs_help = (
+        "throttle the submissions when the schedds have idle jobs, "
+        "stop them at this number of idle jobs (default: not throttled)"
+    )
+    max_queued_tasks_help = (
+        "reject new tasks (429) over this number of queued procs "
+        "(an array task counts for its items)"
+    )
+    owner_max_queued_tasks_help = (
+        "reject the new tasks of an owner (429) over this number of its queued procs"
+    )
+    parser = argparse.ArgumentParser(prog="simple-task-api-htc")
+    parser.add_argument("--schedd", dest="schedds", action="append", help=schedd_help)
+    parser.add_argument("--local-workers", type=int, help=local_workers_help)
+    parser.add_argument("--max-idle-jobs", type=int, help=max_idle_jobs_help)
+    parser.add_argument("--max-queued-tasks", type=int, help=max_queued_tasks_help)
+    parser.add_argument(
+        "--owner-max-queued-tasks", type=int, help=owner_max_queued_tasks_help
+    )
+    subparsers = parser.add_subparsers(dest="role")
+    serve_parser = subparsers.add_parser(
+        "serve", help="run the API workers only (no background trackers)"
+    )
+    serve_parser.add_argument("--bind", default="localhost:8080")
+    serve_parser.add_argument("--workers", type=int, default=1)
+    serve_parser.add_argument("--reload", action="store_true")
+    serve_parser.add_argument(
+        "--max-queued-tasks",
+        type=int,
+        default=argparse.SUPPRESS,
+        help=max_queued_tasks_help,
+    )
+    serve_parser.add_argument(
+        "--owner-max-queued-tasks",
+        type=int,
+        default=argparse.SUPPRESS,
+        help=owner_max_queued_tasks_help,
+    )
+    tracker_parser = subparsers.add_parser(
+        "tracker", help="run the background trackers only (leader-elected)"
+    )
+    tracker_parser.add_argument(
+        "--partitions",
+        type=int,
+        default=1,
+        help="number of task partitions (one HTCTracker process each)",
+    )
+    tracker_parser.add_argument(
+        "--partition",
+        type=int,
+        help="run only this partition (default: all, in separate processes)",
+    )
+    tracker_parser.add_argument(
+        "--schedd",
+        dest="schedds",
+        action="append",
+        default=argparse.SUPPRESS,
+        help=schedd_help,
+    )
+    tracker_parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=argparse.SUPPRESS,
+        help=local_workers_help,
+    )
+    tracker_parser.add_argument(
+        "--max-idle-jobs",
+        type=int,
+        default=argparse.SUPPRESS,
+        help=max_idle_jobs_help,
+    )
+    args = parser.parse_args(argv)
+    if args.local_workers is not None and args.local_workers < 0:
+        parser.error("--local-workers must be at least 0")
+    for name in ["max_idle_jobs", "max_queued_tasks", "owner_max_queued_tasks"]:
+        if getattr(args, name) is not None and getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+
+    if args.role == "serve":
+        run_serve(
+            args.bind,
+            args.workers,
+            args.reload,
+            args.max_queued_tasks,
+            args.owner_max_queued_tasks,
+        )
+    elif args.role == "tracker":
+        if args.partitions < 1:
+            parser.error("--partitions must be at least 1")
+        if args.partition is not None and not 0 <= args.partition < args.partitions:
+            parser.error("--partition must be in [0, --partitions)")
+        if args.partition is not None:
+            run_tracker(
+                [args.partition],
+                args.partitions,
+                args.schedds,
+                args.local_workers,
+                args.max_idle_jobs,
+            )
+        else:
+            run_partitioned_trackers(
+                args.partitions, args.schedds, args.local_workers, args.max_idle_jobs
+            )
+    else:
+        run_all(
+            args.schedds,
+            args.local_workers,
+            args.max_idle_jobs,
+            args.max_queued_tasks,
+            args.owner_max_queued_tasks,
+        )
@@ -0,0 +1,113 @@
+"""Microbenchmark: per-task serialization cost of the task list responses
+
+Compares the previous path (marshmallow load of the camel-case row dict,
+marshmallow dump, response_model validation and encoding by Pydantic) with
+the direct row to JSON path in `app.common.serialization`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_serialization
+"""
+
+from datetime import datetime, timezone
+import json
+import timeit
+from types import SimpleNamespace
+from typing import Any
+
+import sqlalchemy
+
+from app.api.schemas import TaskListResponse
+from app.common import db_models as dbm
+from app.common import serialization
+from app.common.models import SchemaInstances
+
+
+N_TASKS = 1000
+N_REPEAT = 5
+
+
+def get_column_default(column: sqlalchemy.Column) -> Any:
+    """Value of the column in a new row: its literal server default, or None"""
+    server_default = column.server_default
+    if server_default is None or not isinstance(server_default.arg, str):
+        return None
+    return column.type.python_type(server_default.arg)
+
+
+def make_rows(n_tasks: int) -> list[SimpleNamespace]:
+    """Rows with (all) the columns of the `tasks` table"""
+    now = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    defaults = {
+        column.name: get_column_default(column) for column in dbm.Task.__table__.c
+    }
+    rows = []
+    for index in range(n_tasks):
+        values = dict(
+            id=f"41a694e0-5b66-4e79-9abd-{index:012d}",
+            creation_date=now,
+            sub_params_json=json.dumps(
+                {
+                    "executable": "/home/condoruser/test-retry-02/myscript.sh",
+                    "initialdir": "/home/condoruser/testlog",
+                    "arguments": f"5 {index}",
+                }
+            ),
+            state=1,
+            state_date=now,
+            retries_left=1,
+            cluster_id=100 + index,
+            proc_id=None,
+            expiration_date=now,
+        )
+        rows.append(SimpleNamespace(**{**defaults, **values}))
+    return rows
+
+
+def previous_path(rows: list[SimpleNamespace]) -> bytes:
+    """row -> camel-case dict -> marshmallow load -> dump -> Pydantic"""
+    task_schema = SchemaInstances.get_task_schema()
+    items = []
+    for row in rows:
+        items.append(
+            task_schema.load(
+                {
+                    "id": row.id,
+                    "creationDate": str(row.creation_date),
+                    "subParams": json.loads(row.sub_params_json),
+                    "state": row.state,
+                    "stateDate": str(row.state_date),
+                    "retriesLeft": row.retries_left,
+                    "clusterId": row.cluster_id,
+                    "procId": row.proc_id,
+                    "expirationDate": str(row.expiration_date),
+                }
+            )
+        )
+    dumped = SchemaInstances.get_task_list_response_schema().dump(
+        {"response_date": datetime.now(timezone.utc), "items": items}
+    )
+    return TaskListResponse.model_validate(dumped).model_dump_json().encode("utf-8")
+
+
+def direct_path(rows: list[SimpleNamespace]) -> bytes:
+    """row -> dict -> precompiled TypeAdapter"""
+    return serialization.dump_task_list_response(
+        datetime.now(timezone.utc),
+        [serialization.task_row_to_dict(row) for row in rows],
+    )
+
+
+def main() -> None:
+    """Run the benchmark and print the per-task cost of each path"""
+    rows = make_rows(N_TASKS)
+    results = {}
+    for name, func in [("previous", previous_path), ("direct", direct_path)]:
+        best = min(timeit.repeat(lambda f=func: f(rows), number=1, repeat=N_REPEAT))
+        results[name] = best
+        print(f"{name:>8}: {best / N_TASKS * 1e6:8.2f} us/task")
+    print(f" speedup: {results['previous'] / results['direct']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
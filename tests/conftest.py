@@ -0,0 +1,14 @@
+"""Shared fixtures"""
+
+import pytest
+
+from app.common import db_models
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh DB in a temporary instance dir (the working dir)"""
+    monkeypatch.chdir(tmp_path)
+    db_models.db.my_init()
+    yield db_models.db
+    db_models.db.my_close()
@@ -0,0 +1,60 @@
+"""A local fake schedd (stand-in for app.bg.schedd_client.HTCondorSchedd)"""
+
+from datetime import datetime, timezone
+import threading
+from typing import Optional
+
+import htcondor
+
+from app.bg.schedd_client import SubmitResult
+
+
+class FakeSchedd:
+    """Numbers the submitted clusters and records them, with a settable load
+
+    `fail_with` is raised by the calls while set, the calls block while
+    `hang` is set and not released, and the submissions fail with a
+    connection error once `fail_after` clusters were submitted.
+    """
+
+    def __init__(self, n_idle: int = 0, n_running: int = 0) -> None:
+        self.n_idle = n_idle
+        self.n_running = n_running
+        self.next_cluster_id = 1
+        self.submitted: list[dict] = []
+        self.n_calls = 0
+        self.fail_with: Optional[Exception] = None
+        self.hang: Optional[threading.Event] = None
+        self.fail_after: Optional[int] = None
+
+    def _enter(self) -> None:
+        self.n_calls += 1
+        if self.hang is not None:
+            self.hang.wait()
+        if self.fail_with is not None:
+            raise self.fail_with
+
+    def submit(
+        self, sub_params: dict, count: int = 1, item_data: Optional[list[dict]] = None
+    ) -> SubmitResult:
+        self._enter()
+        if self.fail_after is not None and len(self.submitted) >= self.fail_after:
+            raise htcondor.HTCondorIOError("connection to the fake schedd lost")
+        if "executable" not in sub_params:
+            raise htcondor.HTCondorValueError("no executable")
+        num_procs = len(item_data) if item_data else count
+        cluster_id = self.next_cluster_id
+        self.next_cluster_id += 1
+        self.submitted.append(sub_params)
+        self.n_idle += num_procs
+        return SubmitResult(
+            creation_date=datetime.now(timezone.utc),
+            cluster_id=cluster_id,
+            cluster_ad={"ClusterId": cluster_id},
+            first_proc=0,
+            num_procs=num_procs,
+        )
+
+    def get_load(self) -> tuple[int, int]:
+        self._enter()
+        return self.n_idle, self.n_running
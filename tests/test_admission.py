@@ -0,0 +1,98 @@
+"""Admission control, fair share and submit throttling, weighted by procs"""
+
+import math
+
+import pytest
+
+from app.bg.fair_share import allocate_fair_share
+from app.bg.htc_tracker import HTCTracker
+from app.bg.token_bucket import TokenBucket
+from app.common import db_ops
+from app.common.models import SchemaInstances
+
+
+def create_limited_task(task_id: str, limits: tuple, **kwargs):
+    task = SchemaInstances.get_task_create_schema().load(
+        {"id": task_id, "subParams": {"executable": "/bin/true"}, **kwargs}
+    )
+    return db_ops.create_task(task, *limits)
+
+
+def test_admission_counts_procs(db):
+    create_limited_task("arr", (10, None), count=8)
+    create_limited_task("t1", (10, None))
+    create_limited_task("t2", (10, None))
+    with pytest.raises(db_ops.QueueFullError):
+        create_limited_task("t3", (10, None))
+    with pytest.raises(db_ops.QueueFullError):
+        create_limited_task("arr2", (100, None), count=100)
+
+
+def test_admission_of_a_task_over_the_limit(db):
+    # rejected even in an empty queue
+    with pytest.raises(db_ops.TaskTooLargeError):
+        create_limited_task("big", (10, None), count=50)
+    with pytest.raises(db_ops.TaskTooLargeError):
+        create_limited_task("big", (None, 10), owner="A", count=11)
+    create_limited_task("max", (10, 10), owner="A", count=10)
+
+
+def test_owner_admission_counts_procs(db):
+    create_limited_task("a", (None, 5), owner="A", count=5)
+    with pytest.raises(db_ops.QueueFullError, match="owner"):
+        create_limited_task("a2", (None, 5), owner="A")
+    create_limited_task("b", (None, 5), owner="B")
+    create_limited_task("n", (None, 5))
+
+
+def test_fair_share_weights_costs():
+    queues = {"A": [("a", 10)] * 3, "B": [("b", 1)] * 30}
+    picks = allocate_fair_share(
+        queues, {}, None, 15, get_cost=lambda item: item[1], max_usage=None
+    )
+    # one array of A weighs as much as 10 tasks of B
+    assert [name for name, _ in picks].count("a") == 2
+    assert [name for name, _ in picks].count("b") == 13
+
+
+def test_fair_share_cap():
+    queues = {"A": [("a", 3)] * 5, "B": [("b", 20)]}
+    picks = allocate_fair_share(
+        queues, {"A": 2}, None, 10, get_cost=lambda item: item[1], max_usage=8
+    )
+    # B is over the cap by itself, but has no usage
+    assert picks == [("b", 20), ("a", 3), ("a", 3)]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=0.0, burst=4)
+    assert bucket.take(3)
+    assert not bucket.take(2)
+    assert bucket.take(1)
+    assert bucket.get_wait_time() == math.inf
+
+    # a take over the burst drains a full bucket into debt
+    bucket = TokenBucket(rate=10.0, burst=4)
+    assert bucket.take(10)
+    assert not bucket.take(1)
+    assert bucket.get_wait_time() == pytest.approx(0.7, abs=0.05)
+
+
+class FakePool:
+    n_idle = 0
+
+    def get_idle_jobs(self) -> int:
+        return self.n_idle
+
+
+def test_submit_tokens_count_procs():
+    tracker = HTCTracker()
+    tracker.init_app(
+        "htc-log/0.log",
+        schedd_pool=FakePool(),  # type: ignore
+        max_submit_batch_size=10,
+        max_idle_jobs=100,
+        submit_rate=0.0,
+    )
+    assert tracker.take_submit_tokens([4, 4, 4]) == 2
+    assert tracker._submit_throttled
@@ -0,0 +1,60 @@
+"""DBExecutor: bounded calls and streams"""
+
+import asyncio
+
+import pytest
+
+from app.common.db_executor import DBBusyError, DBExecutor
+
+
+def run_with_executor(func) -> None:
+    async def _run() -> None:
+        executor = DBExecutor()
+        executor.my_init(max_workers=2, max_pending=1, queue_timeout=0.05)
+        try:
+            await func(executor)
+        finally:
+            executor.my_close()
+
+    asyncio.run(_run())
+
+
+def test_stream_holds_a_pending_call():
+    closed = []
+
+    def rows():
+        try:
+            yield from [b"1\n", b"2\n"]
+        finally:
+            closed.append(True)
+
+    async def check(executor: DBExecutor) -> None:
+        stream = await executor.open_stream(rows())
+        # the stream is the one pending call
+        with pytest.raises(DBBusyError):
+            await executor.run(sum, [1, 2])
+        assert [chunk async for chunk in stream] == [b"1\n", b"2\n"]
+        assert closed
+        assert await executor.run(sum, [1, 2]) == 3
+
+    run_with_executor(check)
+
+
+def test_stream_closed_before_the_end():
+    closed = []
+
+    def rows():
+        try:
+            yield b"1\n"
+        finally:
+            closed.append(True)
+
+    async def check(executor: DBExecutor) -> None:
+        iterator = rows()
+        next(iterator)
+        stream = await executor.open_stream(iterator)
+        await stream.aclose()
+        assert closed
+        assert await executor.run(sum, [1, 2]) == 3
+
+    run_with_executor(check)
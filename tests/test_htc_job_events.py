@@ -0,0 +1,20 @@
+"""Job event ingestion"""
+
+from datetime import timezone
+
+from app.common import db_ops, models
+
+
+def make_job_event() -> models.HTCJobEvent:
+    return models.HTCJobEvent(
+        cluster_id=1, proc_id=0, timestamp=1700000000.0, event_type="SUBMIT", details={}
+    )
+
+
+def test_duplicate_job_event_creation_date(db):
+    inserted = db_ops.post_htc_job_event(make_job_event())
+    duplicate = db_ops.post_htc_job_event(make_job_event())
+    assert duplicate.id == inserted.id
+    assert inserted.creation_date.tzinfo == timezone.utc
+    assert duplicate.creation_date.tzinfo == timezone.utc
+    assert duplicate.creation_date == inserted.creation_date
@@ -0,0 +1,83 @@
+"""Job event log checkpoints"""
+
+import htcondor
+import pytest
+
+from app.bg.htc_tracker import (
+    HTCTracker,
+    get_jel_offset,
+    get_log_file_id,
+    get_log_fingerprint,
+    set_jel_offset,
+)
+from app.common import db_ops
+from app.common.models import HTCLogCheckpoint
+
+
+EVENTS = [
+    "000 (001.000.000) 2024-01-01 00:00:00 Job submitted from host: "
+    "<127.0.0.1:9618>\n...\n",
+    "001 (001.000.000) 2024-01-01 00:00:01 Job executing on host: "
+    "<127.0.0.1:9618>\n...\n",
+]
+
+
+@pytest.fixture
+def log_filename(tmp_path) -> str:
+    log_path = tmp_path / "0.log"
+    log_path.write_text("".join(EVENTS))
+    return str(log_path)
+
+
+def read_event_types(jel: htcondor.JobEventLog) -> list[str]:
+    return [str(event.type) for event in jel.events(stop_after=0)]
+
+
+def test_jel_offset(log_filename):
+    jel = htcondor.JobEventLog(log_filename)
+    next(jel.events(stop_after=0))
+    offset = get_jel_offset(jel)
+    assert offset == len(EVENTS[0])
+
+    jel = htcondor.JobEventLog(log_filename)
+    assert set_jel_offset(jel, offset)
+    assert read_event_types(jel) == ["EXECUTE"]
+
+
+class OtherStateJobEventLog:
+    """A JobEventLog of bindings with another pickle state layout"""
+
+    def __getstate__(self):
+        return {"offset": 105}
+
+
+def test_jel_offset_of_unknown_state():
+    jel = OtherStateJobEventLog()
+    assert get_jel_offset(jel) is None  # type: ignore
+    assert not set_jel_offset(jel, 0)  # type: ignore
+
+
+def save_checkpoint(log_filename: str, offset: int) -> None:
+    db_ops.post_htc_job_events(
+        [],
+        HTCLogCheckpoint(
+            log_filename=log_filename,
+            offset=offset,
+            file_id=get_log_file_id(log_filename),
+            fingerprint=get_log_fingerprint(log_filename, offset),
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "offset, event_types",
+    [
+        (len(EVENTS[0]), ["EXECUTE"]),
+        # not an event start: read from the beginning
+        (len(EVENTS[0]) - 1, ["SUBMIT", "EXECUTE"]),
+    ],
+)
+def test_open_job_event_log_at_checkpoint(db, log_filename, offset, event_types):
+    save_checkpoint(log_filename, offset)
+    jel = HTCTracker().open_job_event_log(log_filename)
+    assert read_event_types(jel) == event_types
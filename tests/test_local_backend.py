@@ -0,0 +1,28 @@
+"""Local backend: running the procs like HTCondor does"""
+
+import stat
+
+from app.bg.local_backend import expand_macros, run_proc
+
+
+def test_expand_macros():
+    assert expand_macros("$(Cluster).$(Process).$(x)", {"Cluster": "1"}) == (
+        "1.$(Process).$(x)"
+    )
+
+
+def test_executable_relative_to_initialdir(tmp_path, monkeypatch):
+    job_dir = tmp_path / "job"
+    job_dir.mkdir()
+    script = job_dir / "run.sh"
+    script.write_text("#!/bin/sh\necho $1 > out.txt\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    # the tracker runs elsewhere
+    monkeypatch.chdir(tmp_path)
+
+    details = run_proc(
+        {"executable": "run.sh", "arguments": "hello", "initialdir": str(job_dir)},
+        max_run_time=10.0,
+    )
+    assert details == {"TerminatedNormally": True, "ReturnValue": 0}
+    assert (job_dir / "out.txt").read_text() == "hello\n"
@@ -0,0 +1,147 @@
+"""ScheddClient: circuit breaker, call timeout, reconnect, submissions"""
+
+import threading
+import time
+
+import htcondor
+import pytest
+
+from app.bg.htc_tracker import htc_submit_tasks
+from app.bg.schedd_client import ScheddClient, ScheddUnavailableError
+from app.bg.schedd_pool import get_schedd_load
+from app.common.models import Task
+
+from .fake_schedd import FakeSchedd
+
+
+@pytest.fixture
+def fake():
+    return FakeSchedd(n_idle=2, n_running=3)
+
+
+@pytest.fixture
+def make_client(fake):
+    clients = []
+
+    def _make_client(**kwargs) -> ScheddClient:
+        client = ScheddClient(schedd_factory=lambda: fake, **kwargs)
+        client.my_init()
+        clients.append(client)
+        return client
+
+    yield _make_client
+    if fake.hang is not None:
+        fake.hang.set()
+    for client in clients:
+        client.my_close()
+
+
+def make_task(task_id: str, **sub_params) -> Task:
+    return Task(id=task_id, sub_params={"executable": "/bin/true", **sub_params})
+
+
+def test_call(make_client):
+    client = make_client()
+    assert client.call(get_schedd_load) == (2, 3)
+
+
+def test_breaker_opens_after_repeated_failures(make_client, fake):
+    client = make_client(failure_threshold=2, reset_timeout=60.0)
+    fake.fail_with = htcondor.HTCondorIOError("schedd down")
+    for _ in range(2):
+        with pytest.raises(ScheddUnavailableError):
+            client.call(get_schedd_load)
+    assert client.breaker.is_open
+
+    # rejected without calling the schedd
+    with pytest.raises(ScheddUnavailableError, match="circuit breaker"):
+        client.call(get_schedd_load)
+    assert fake.n_calls == 2
+
+
+def test_breaker_half_open_probe(make_client, fake):
+    client = make_client(failure_threshold=1, reset_timeout=0.05)
+    fake.fail_with = htcondor.HTCondorIOError("schedd down")
+    with pytest.raises(ScheddUnavailableError):
+        client.call(get_schedd_load)
+    assert client.breaker.is_open
+
+    # a failed probe opens the breaker again
+    time.sleep(0.06)
+    with pytest.raises(ScheddUnavailableError):
+        client.call(get_schedd_load)
+    assert fake.n_calls == 2
+    assert client.breaker.is_open
+
+    # a successful probe closes it
+    fake.fail_with = None
+    time.sleep(0.06)
+    assert client.call(get_schedd_load) == (2, 3)
+    assert not client.breaker.is_open
+
+
+def test_submission_errors_are_not_schedd_failures(make_client, fake):
+    client = make_client(failure_threshold=1)
+    fake.fail_with = htcondor.HTCondorValueError("bad submit description")
+    for _ in range(2):
+        with pytest.raises(htcondor.HTCondorValueError):
+            client.call(get_schedd_load)
+    assert not client.breaker.is_open
+
+
+def test_call_timeout_and_reconnect(fake):
+    schedds = [fake, FakeSchedd(n_idle=7)]
+    client = ScheddClient(schedd_factory=lambda: schedds.pop(0), call_timeout=0.05)
+    client.my_init()
+    try:
+        fake.hang = threading.Event()
+        with pytest.raises(ScheddUnavailableError, match="timed out"):
+            client.call(get_schedd_load)
+
+        # the hanging handle was dropped, the schedd is located again
+        assert client.call(get_schedd_load) == (7, 0)
+        assert not schedds
+    finally:
+        fake.hang.set()
+        client.my_close()
+
+
+def test_hanging_calls_hold_the_workers(make_client, fake):
+    client = make_client(max_workers=1, call_timeout=0.05, failure_threshold=5)
+    fake.hang = threading.Event()
+    with pytest.raises(ScheddUnavailableError, match="timed out"):
+        client.call(get_schedd_load)
+    with pytest.raises(ScheddUnavailableError, match="no free schedd worker"):
+        client.call(get_schedd_load)
+
+
+def test_submit_tasks(make_client, fake):
+    client = make_client()
+    tasks = [make_task("a"), Task(id="bad", sub_params={}), make_task("c")]
+    results = client.call(htc_submit_tasks, tasks)
+
+    # a bad task only fails itself
+    assert [result and result.cluster_id for result in results] == [1, None, 2]
+    assert len(fake.submitted) == 2
+
+
+def test_submit_array_task(make_client):
+    client = make_client()
+    task = make_task("arr")
+    task.item_data = [{"x": "1"}, {"x": "2"}, {"x": "3"}]
+    (result,) = client.call(htc_submit_tasks, [task])
+    assert result.num_procs == 3
+
+
+def test_submit_tasks_connection_lost(make_client, fake):
+    client = make_client()
+    tasks = [make_task("a"), make_task("b"), make_task("c")]
+
+    # the clusters submitted before the failure are returned
+    fake.fail_after = 1
+    results = client.call(htc_submit_tasks, tasks)
+    assert [result.cluster_id for result in results] == [1]
+
+    # the failure of the first submission is a schedd failure
+    with pytest.raises(ScheddUnavailableError):
+        client.call(htc_submit_tasks, tasks)
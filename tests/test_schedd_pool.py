@@ -0,0 +1,156 @@
+"""ScheddPool: least loaded placement, schedd slots and cluster ids"""
+
+import json
+import threading
+
+import htcondor
+import pytest
+
+from app.bg.htc_tracker import HTCTracker
+from app.bg.schedd_pool import ScheddPool
+from app.common import db_ops
+from app.common.models import (
+    SCHEDD_SLOT_SHIFT,
+    SchemaInstances,
+    TaskStates,
+    make_cluster_id,
+    split_cluster_id,
+)
+
+from .fake_schedd import FakeSchedd
+
+
+@pytest.fixture
+def fakes():
+    return {
+        None: FakeSchedd(n_idle=5, n_running=5),
+        "s2": FakeSchedd(n_idle=1),
+        "s3": FakeSchedd(n_idle=3),
+    }
+
+
+@pytest.fixture
+def pool(db, fakes):
+    pool = ScheddPool.create(
+        "htc-log/0.log",
+        ["local", "s2", "s3"],
+        schedd_factory=lambda name: fakes[name],
+        refresh_interval=3600.0,
+    )
+    pool.my_init()
+    for target in pool.targets:
+        pool.refresh_load(target)
+    yield pool
+    pool.my_close()
+
+
+def get_target(pool: ScheddPool, name):
+    return next(target for target in pool.targets if target.name == name)
+
+
+def test_pick_least_loaded(pool):
+    assert pool.pick().name == "s2"
+
+    # the submitted procs count until the next refresh
+    pool.add_submitted(get_target(pool, "s2"), 5)
+    assert pool.pick().name == "s3"
+
+
+def test_pick_skips_unavailable(pool, fakes):
+    for name in ["s2", "s3"]:
+        fakes[name].fail_with = htcondor.HTCondorIOError("schedd down")
+        target = get_target(pool, name)
+        for _ in range(target.client.breaker.failure_threshold):
+            pool.refresh_load(target)
+        assert not target.is_available
+    assert pool.pick().name is None
+
+    fakes[None].fail_with = htcondor.HTCondorIOError("schedd down")
+    target = get_target(pool, None)
+    for _ in range(target.client.breaker.failure_threshold):
+        pool.refresh_load(target)
+    assert pool.pick() is None
+
+
+def test_schedd_slots(pool):
+    slots = {target.name: target.slot for target in pool.targets}
+    assert slots == {None: 0, "s2": 1, "s3": 2}
+    assert pool.get_idle_jobs() == 9
+
+    # the slot of a schedd name is kept across restarts
+    assert db_ops.get_schedd_slot("s3") == 2
+    assert db_ops.get_schedd_slot("s4") == 3
+
+
+def test_cluster_id_encoding():
+    assert make_cluster_id(0, 123) == 123
+    cluster_id = make_cluster_id(2, 123)
+    assert cluster_id == (2 << SCHEDD_SLOT_SHIFT) + 123
+    assert split_cluster_id(cluster_id) == (2, 123)
+    assert split_cluster_id(make_cluster_id(1, (1 << SCHEDD_SLOT_SHIFT) - 1)) == (
+        1,
+        (1 << SCHEDD_SLOT_SHIFT) - 1,
+    )
+
+
+def test_tracker_submits_to_least_loaded(pool, fakes, tmp_path):
+    task_create_schema = SchemaInstances.get_task_create_schema()
+    for task_id in ["t1", "t2"]:
+        db_ops.create_task(
+            task_create_schema.load(
+                {"id": task_id, "subParams": {"executable": "/bin/true"}}
+            )
+        )
+
+    tracker = HTCTracker()
+    tracker.init_app(
+        f"{tmp_path}/htc-log/0.log",
+        task_root_dir=f"{tmp_path}/taskroot",
+        schedd_pool=pool,
+    )
+    tracker.check_for_new_tasks()
+
+    assert len(fakes["s2"].submitted) == 2
+    for cluster_id, task_id in [(1, "t1"), (2, "t2")]:
+        task = db_ops.get_task_by_id(task_id)
+        assert task.state == TaskStates.SUBMITTED
+        assert task.cluster_id == make_cluster_id(1, cluster_id)
+        htc_cluster = json.loads(
+            db_ops.get_htc_cluster_with_task_json(task.cluster_id)
+        )["cluster"]
+        assert htc_cluster["scheddName"] == "s2"
+    assert get_target(pool, "s2").load == 3
+
+
+def test_late_submission_is_recorded(pool, fakes, tmp_path):
+    db_ops.create_task(
+        SchemaInstances.get_task_create_schema().load(
+            {"id": "t1", "subParams": {"executable": "/bin/true"}}
+        )
+    )
+    tracker = HTCTracker()
+    tracker.init_app(
+        f"{tmp_path}/htc-log/0.log",
+        task_root_dir=f"{tmp_path}/taskroot",
+        schedd_pool=pool,
+    )
+    target = get_target(pool, "s2")
+    target.client.call_timeout = 0.1
+    fakes["s2"].hang = threading.Event()
+    try:
+        tracker.check_for_new_tasks()
+        assert db_ops.get_task_by_id("t1").state == TaskStates.QUEUED
+
+        # not submitted again while the timed out submission may complete
+        tracker.check_for_new_tasks()
+        assert not fakes[None].submitted and not fakes["s3"].submitted
+    finally:
+        fakes["s2"].hang.set()
+
+    assert tracker.wake_event.wait(5.0)
+    tracker.check_for_new_tasks()
+    assert len(fakes["s2"].submitted) == 1
+    assert not fakes[None].submitted and not fakes["s3"].submitted
+    task = db_ops.get_task_by_id("t1")
+    assert task.state == TaskStates.SUBMITTED
+    assert task.cluster_id == make_cluster_id(1, 1)
@@ -0,0 +1,49 @@
+"""Task bundles: completion of the bundled tasks"""
+
+from datetime import timedelta
+
+from app.common import db_ops
+from app.common.models import HTCCluster, SchemaInstances, TaskStates
+
+
+def create_bundle(retries_left: int) -> None:
+    task_create_schema = SchemaInstances.get_task_create_schema()
+    for task_id in ["ok", "failed", "not-run"]:
+        db_ops.create_task(
+            task_create_schema.load(
+                {
+                    "id": task_id,
+                    "subParams": {"executable": "/bin/true"},
+                    "retriesLeft": retries_left,
+                    "bundleable": True,
+                }
+            )
+        )
+    db_ops.create_submitted_bundle(
+        HTCCluster(id=7, task_id="-", first_proc=0, num_procs=1),
+        ["ok", "failed", "not-run"],
+        timedelta(minutes=2),
+    )
+
+
+def test_complete_bundled_tasks(db):
+    create_bundle(retries_left=2)
+    assert db_ops.complete_bundled_tasks(7, {"ok": 0, "failed": 1}) == 3
+    assert db_ops.get_task_by_id("ok").state == TaskStates.COMPLETED
+    assert db_ops.get_task_by_id("failed").state == TaskStates.COMPLETED_WITH_ERROR
+
+    # the job did not reach it
+    task = db_ops.get_task_by_id("not-run")
+    assert task.state == TaskStates.QUEUED
+    assert task.cluster_id is None and task.proc_id is None
+    assert task.retries_left == 1
+
+    # a no-op once completed
+    assert db_ops.complete_bundled_tasks(7, {}) == 0
+
+
+def test_not_run_without_retries(db):
+    create_bundle(retries_left=1)
+    db_ops.complete_bundled_tasks(7, {"ok": 0, "failed": 1})
+    task = db_ops.get_task_by_id("not-run")
+    assert task.state == TaskStates.COMPLETED_WITH_ERROR
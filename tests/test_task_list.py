@@ -0,0 +1,47 @@
+"""Task list filters"""
+
+from datetime import timedelta, timezone
+import json
+
+from app.common import db_ops
+from app.common.models import HTCCluster, SchemaInstances, TaskListQuery
+
+
+def create_task(task_id: str):
+    return db_ops.create_task(
+        SchemaInstances.get_task_create_schema().load(
+            {"id": task_id, "subParams": {"executable": "/bin/true"}}
+        )
+    )
+
+
+def list_task_ids(**filters) -> list[str]:
+    page = json.loads(db_ops.get_tasks_all_json(TaskListQuery(**filters)))
+    return [task["id"] for task in page["items"]]
+
+
+def test_creation_date_bounds(db):
+    create_task("t1")
+    # as returned by the API
+    creation_date = db_ops.get_task_by_id("t1").creation_date.replace(
+        tzinfo=timezone.utc
+    )
+    assert list_task_ids(created_after=creation_date) == ["t1"]
+    assert list_task_ids(created_before=creation_date) == []
+    second = timedelta(seconds=1)
+    assert list_task_ids(created_after=creation_date + second) == []
+    assert list_task_ids(created_before=creation_date + second) == ["t1"]
+
+
+def test_state_date_bounds(db):
+    create_task("t1")
+    db_ops.create_submitted_htc_clusters(
+        [HTCCluster(id=1, task_id="t1", first_proc=0, num_procs=1)]
+    )
+    # with microseconds
+    state_date = db_ops.get_task_by_id("t1").state_date.replace(tzinfo=timezone.utc)
+    microsecond = timedelta(microseconds=1)
+    assert list_task_ids(state_date_after=state_date) == ["t1"]
+    assert list_task_ids(state_date_before=state_date) == []
+    assert list_task_ids(state_date_after=state_date + microsecond) == []
+    assert list_task_ids(state_date_before=state_date + microsecond) == ["t1"]
@@ -0,0 +1,56 @@
+"""Task state counters of the status endpoint"""
+
+import pytest
+import sqlalchemy
+
+from app.common import db_models as dbm
+from app.common import db_ops
+from app.common.models import SchemaInstances, TaskStates
+
+
+@pytest.fixture
+def counters(db):
+    counters = db_ops.task_state_counters
+    yield counters
+    counters.max_age = None
+    counters.reconciled_in_process = False
+
+
+def complete_in_other_process(task_id: str) -> None:
+    """A transition not seen by the counters of this process"""
+    with dbm.db.session_scope() as session:
+        session.execute(
+            sqlalchemy.update(dbm.Task)
+            .where(dbm.Task.id == task_id)
+            .values(state=TaskStates.COMPLETED)
+        )
+        session.commit()
+
+
+def test_counters_reloaded_after_max_age(counters):
+    db_ops.create_task(
+        SchemaInstances.get_task_create_schema().load(
+            {"id": "t1", "subParams": {"executable": "/bin/true"}}
+        )
+    )
+    counters.max_age = 0.0
+    assert db_ops.get_status().n_tasks_queued == 1
+
+    complete_in_other_process("t1")
+    status = db_ops.get_status()
+    assert status.n_tasks_queued == 0
+    assert status.n_tasks_completed == 1
+
+
+def test_counters_reconciled_in_process(counters):
+    db_ops.create_task(
+        SchemaInstances.get_task_create_schema().load(
+            {"id": "t1", "subParams": {"executable": "/bin/true"}}
+        )
+    )
+    counters.max_age = 0.0
+    db_ops.reconcile_task_state_counters()
+    # the TaskExpirationTracker of this process reconciles them
+    counters.reconciled_in_process = True
+    complete_in_other_process("t1")
+    assert db_ops.get_status().n_tasks_queued == 1
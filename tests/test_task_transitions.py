@@ -0,0 +1,83 @@
+"""Conditional task state transitions and conflict retries"""
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm.exc
+
+from app.common import db_models as dbm
+from app.common import db_ops
+from app.common.models import HTCCluster, SchemaInstances, TaskStates
+
+
+def create_task(task_id: str):
+    return db_ops.create_task(
+        SchemaInstances.get_task_create_schema().load(
+            {"id": task_id, "subParams": {"executable": "/bin/true"}, "retriesLeft": 3}
+        )
+    )
+
+
+def submit_cluster(cluster_id: int, task_id: str) -> int:
+    return db_ops.create_submitted_htc_clusters(
+        [HTCCluster(id=cluster_id, task_id=task_id, first_proc=0, num_procs=1)]
+    )
+
+
+def set_task_state(task_id: str, state: int) -> None:
+    with dbm.db.session_scope() as session:
+        session.execute(
+            sqlalchemy.update(dbm.Task)
+            .where(dbm.Task.id == task_id)
+            .values(state=state)
+        )
+        session.commit()
+
+
+def test_submit_queued_task(db):
+    create_task("t1")
+    assert submit_cluster(1, "t1") == 1
+    task = db_ops.get_task_by_id("t1")
+    assert task.state == TaskStates.SUBMITTED
+    assert task.cluster_id == 1
+    assert task.retries_left == 2
+
+
+def test_submit_is_noop_for_task_submitted_elsewhere(db):
+    create_task("t1")
+    submit_cluster(1, "t1")
+    # e.g. a stale tracker recording its own submission of the task
+    assert submit_cluster(2, "t1") == 0
+    task = db_ops.get_task_by_id("t1")
+    assert task.cluster_id == 1
+    assert task.retries_left == 2
+
+
+def test_submit_is_noop_for_completed_task(db):
+    create_task("t1")
+    submit_cluster(1, "t1")
+    set_task_state("t1", TaskStates.COMPLETED)
+    assert submit_cluster(2, "t1") == 0
+    assert not db_ops.update_cluster_task(2)
+    task = db_ops.get_task_by_id("t1")
+    assert task.state == TaskStates.COMPLETED
+    assert task.cluster_id == 1
+    assert task.retries_left == 2
+
+
+def test_retry_on_conflict():
+    calls = []
+
+    @db_ops._retry_on_conflict
+    def update(fail_times: int) -> str:
+        calls.append(1)
+        if len(calls) <= fail_times:
+            raise sqlalchemy.orm.exc.StaleDataError("row version changed")
+        return "done"
+
+    assert update(2) == "done"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(sqlalchemy.orm.exc.StaleDataError):
+        update(db_ops._MAX_CONFLICT_ATTEMPTS)
+    assert len(calls) == db_ops._MAX_CONFLICT_ATTEMPTS
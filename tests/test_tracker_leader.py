@@ -0,0 +1,68 @@
+"""TrackerLeader: wakeups of the trackers by the other processes"""
+
+import threading
+import time
+
+from app.bg.tracker_leader import TrackerLeader, get_db_wake_filename
+from app.common import db_ops
+from app.common.signals import Signal
+
+
+def test_signal_writes_wake_file(tmp_path):
+    signal = Signal()
+    event = threading.Event()
+    signal.connect(event)
+    wake_filename = tmp_path / "wake"
+    signal.set_wake_file(str(wake_filename))
+    signal.send()
+    assert event.is_set()
+    assert wake_filename.exists()
+
+    wake_filename.unlink()
+    signal.set_wake_file(None)
+    signal.send()
+    assert not wake_filename.exists()
+
+
+class IdleTracker(threading.Thread):
+    def __init__(self) -> None:
+        super().__init__()
+        self.stop_event = threading.Event()
+
+    def run(self) -> None:
+        self.stop_event.wait()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+def wait_for(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_wake_on_db_writes(db):
+    tracker_leader = TrackerLeader(
+        [IdleTracker], "test-tracker", lease_ttl=0.3, wake_on_db_writes=True
+    )
+    woken = threading.Event()
+    db_ops.tasks_queued.connect(woken)
+    tracker_leader.start()
+    try:
+        assert wait_for(lambda: tracker_leader.is_leader)
+        # the lease renewals (DB writes) do not wake up the trackers
+        assert not woken.wait(0.5)
+
+        # a task queued by another process
+        other_process_signal = Signal()
+        other_process_signal.set_wake_file(get_db_wake_filename())
+        other_process_signal.send()
+        assert woken.wait(5.0)
+    finally:
+        db_ops.tasks_queued.disconnect(woken)
+        tracker_leader.stop()
+        tracker_leader.join()